@@ -0,0 +1,248 @@
+"""
+会话分析计算（基于 NumPy 的向量化实现）
+
+会话以列式数组表示（SessionArrays）：设备编号、开始和结束时间。时间为“本地时间按 UTC
+换算”的秒数，即 SQLite strftime('%s', start_time) 的结果。这样整除 86400 和 3600
+就能直接得到本地日期和小时，按星期和小时分桶时无需处理时区。
+"""
+
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+import numpy as np
+
+import archive
+
+# 只查询开始时间不早于范围起点前这么久的会话，跨越范围起点的会话一般不会更长
+MAX_SESSION_LOOKBACK = timedelta(days=2)
+
+WEEKDAY_HOURS = 7 * 24
+_EPOCH = datetime(1970, 1, 1)
+
+# devices: 设备编号 -> (player_id, player_name)；device: int32 设备编号；
+# start / end: int64 秒，未结束的会话以当前时间作为结束时间
+SessionArrays = namedtuple('SessionArrays', ['devices', 'device', 'start', 'end'])
+
+_OVERLAP_SQL = (
+    "SELECT player_id, player_name, "
+    "CAST(strftime('%s', start_time) AS INTEGER), "
+    "CAST(strftime('%s', COALESCE(end_time, ?)) AS INTEGER) "
+    "FROM game_sessions "
+    "WHERE start_time >= ? AND start_time < ? AND (end_time IS NULL OR end_time > ?)"
+)
+
+
+def to_epoch(value):
+    """本地时间（datetime 或 date）转换为 SessionArrays 使用的秒数"""
+    if not isinstance(value, datetime):
+        value = datetime(value.year, value.month, value.day)
+    delta = value - _EPOCH
+    return delta.days * 86400 + delta.seconds
+
+
+def load_sessions(range_start, range_end, player_id=None, now=None):
+    """从会话表和归档中读取与 [range_start, range_end) 有重叠的会话"""
+    from models import db
+    from columnar_store import get_store
+
+    store = get_store()
+    if store is not None:
+        return store.overlapping(range_start, range_end, player_id, now)
+
+    now = now or datetime.now()
+    params = [str(now), str(range_start - MAX_SESSION_LOOKBACK), str(range_end), str(range_start)]
+    sql = _OVERLAP_SQL
+    if player_id is not None:
+        sql += ' AND player_id = ?'
+        params.append(player_id)
+
+    rows = db.execute_sql(sql, params).fetchall()
+    for path in archive.archives_for_range((range_start - MAX_SESSION_LOOKBACK).date(),
+                                           range_end.date()):
+        connection = archive.open_archive(path)
+        try:
+            rows += connection.execute(sql, params).fetchall()
+        finally:
+            connection.close()
+    return session_arrays(rows)
+
+
+def session_arrays(rows):
+    """(player_id, player_name, 开始秒数, 结束秒数) 行转换为 SessionArrays"""
+    index = {}
+    devices = []
+    codes = np.empty(len(rows), dtype=np.int32)
+    for i, (player_id, player_name, _, _) in enumerate(rows):
+        code = index.get(player_id)
+        if code is None:
+            code = index[player_id] = len(devices)
+            devices.append((player_id, player_name))
+        codes[i] = code
+    start = np.fromiter((row[2] for row in rows), dtype=np.int64, count=len(rows))
+    end = np.fromiter((row[3] for row in rows), dtype=np.int64, count=len(rows))
+    return SessionArrays(devices, codes, start, end)
+
+
+def weekday_hour_grid(sessions, range_start, range_end, per_device=False):
+    """按星期（周一为 0）和小时统计 [range_start, range_end) 内的占用秒数
+
+    会话先裁剪到范围内，再在整点处拆分：首尾两个不完整的小时直接累加，中间的整小时
+    用差分数组一次累加，因此跨越整点和午夜的长会话也只需常数次数组操作。
+    返回 (占用秒数, 每个格子在范围内出现的小时数)：前者形状为 (设备数或 1, 168)，
+    后者形状为 (168,)。
+    """
+    start_second = to_epoch(range_start)
+    end_second = to_epoch(range_end)
+    base_hour = start_second // 3600
+    hours = -(-(end_second - base_hour * 3600) // 3600)
+    groups = len(sessions.devices) if per_device else 1
+
+    start = np.maximum(sessions.start, start_second)
+    end = np.minimum(sessions.end, end_second)
+    keep = end > start
+    start, end = start[keep], end[keep]
+    offset = (sessions.device[keep].astype(np.int64) * hours if per_device
+              else np.zeros(len(start), dtype=np.int64))
+
+    first = start // 3600 - base_hour
+    last = (end - 1) // 3600 - base_hour
+    same = first == last
+    first_seconds = np.where(same, end - start, (first + base_hour + 1) * 3600 - start)
+    last_seconds = np.where(same, 0, end - (last + base_hour) * 3600)
+
+    size = groups * hours
+    occupied = (np.bincount(offset + first, weights=first_seconds, minlength=size) +
+                np.bincount(offset + last, weights=last_seconds, minlength=size))
+
+    # 中间的整小时 first+1 .. last-1：差分后前缀和
+    full = last - first > 1
+    diff = (np.bincount(offset[full] + first[full] + 1, minlength=size + 1) -
+            np.bincount(offset[full] + last[full], minlength=size + 1))
+    occupied += np.cumsum(diff[:size]) * 3600
+
+    # 绝对小时 -> 星期 * 24 + 小时（1970-01-01 是星期四）
+    absolute_hour = base_hour + np.arange(hours)
+    slot = ((absolute_hour // 24 + 3) % 7) * 24 + absolute_hour % 24
+    grid = np.zeros((groups, WEEKDAY_HOURS))
+    np.add.at(grid.T, slot, occupied.reshape(groups, hours).T)
+    slot_hours = np.bincount(slot, minlength=WEEKDAY_HOURS)
+    return grid, slot_hours
+
+
+def concurrency_timeline(sessions, range_start, range_end, bucket_seconds):
+    """一次排序扫描计算 [range_start, range_end) 内同时进行的会话数
+
+    开始和结束事件（加上桶边界，增量为 0）按时间排序后求前缀和，得到每段时间内进行中的
+    会话数；同一时刻先处理结束再处理开始，首尾相接的会话不算重叠。
+    返回 (每个桶的占用秒数之和, 每个桶的最大并发数, 每个桶的秒数, 峰值并发数, 峰值开始秒数)。
+    """
+    start_second = to_epoch(range_start)
+    end_second = to_epoch(range_end)
+    bucket_count = -(-(end_second - start_second) // bucket_seconds)
+    boundaries = np.minimum(start_second + np.arange(bucket_count + 1) * bucket_seconds,
+                            end_second)
+
+    start = np.maximum(sessions.start, start_second)
+    end = np.minimum(sessions.end, end_second)
+    keep = end > start
+    start, end = start[keep], end[keep]
+
+    times = np.concatenate([end, boundaries, start])
+    deltas = np.concatenate([np.full(len(end), -1, dtype=np.int64),
+                             np.zeros(len(boundaries), dtype=np.int64),
+                             np.ones(len(start), dtype=np.int64)])
+    order = np.lexsort((deltas, times))
+    times = times[order]
+    level = np.cumsum(deltas[order])[:-1]
+    length = np.diff(times)
+    bucket = np.minimum((times[:-1] - start_second) // bucket_seconds, bucket_count - 1)
+
+    busy = np.bincount(bucket, weights=level * length, minlength=bucket_count)
+    # 只统计长度大于 0 的时间段，同一时刻的中间状态不算
+    positive = length > 0
+    peak = np.zeros(bucket_count, dtype=np.int64)
+    np.maximum.at(peak, bucket[positive], level[positive])
+    peak_index = int(np.argmax(np.where(positive, level, -1)))
+    return busy, peak, np.diff(boundaries), int(level[peak_index]), int(times[peak_index])
+
+
+def concurrency(date_from, date_to, bucket_minutes=60, player_id=None, now=None,
+                device_count=None):
+    """date_from 到 date_to（含两端，截止到当前时间）内每个时间桶的并发会话数和设备占用率
+
+    device_count 为已知的设备总数（包括范围内没有会话的空闲设备），占用率按它计算；
+    省略时只能按范围内有会话的设备数计算。
+    """
+    now = now or datetime.now()
+    range_start = datetime(date_from.year, date_from.month, date_from.day)
+    range_end = min(datetime(date_to.year, date_to.month, date_to.day) + timedelta(days=1), now)
+    if player_id is not None:
+        device_count = 1
+    result = {
+        'start_date': date_from.isoformat(),
+        'end_date': date_to.isoformat(),
+        'bucket_minutes': bucket_minutes
+    }
+    if to_epoch(range_end) <= to_epoch(range_start):
+        # 范围内还没有经过完整的一秒（例如零点整查询今天）
+        result.update(device_count=device_count or 0, peak_concurrent=0, peak_time=None,
+                      average_concurrent=0.0, utilization=0.0, buckets=[])
+        return result
+
+    sessions = load_sessions(range_start, range_end, player_id, now)
+    device_count = max(device_count or 0, len(sessions.devices), 1)
+
+    busy, peak, seconds, peak_concurrent, peak_second = concurrency_timeline(
+        sessions, range_start, range_end, bucket_minutes * 60)
+    total_seconds = int(seconds.sum())
+    buckets = [
+        {
+            'start': (range_start + timedelta(minutes=bucket_minutes * i)).isoformat(),
+            'max_concurrent': int(peak[i]),
+            'average_concurrent': round(float(busy[i] / seconds[i]), 3),
+            'utilization': round(float(busy[i] / (seconds[i] * device_count)), 4)
+        }
+        for i in range(len(seconds))
+    ]
+    result.update({
+        'device_count': device_count,
+        'peak_concurrent': peak_concurrent,
+        'peak_time': ((_EPOCH + timedelta(seconds=peak_second)).isoformat()
+                      if peak_concurrent else None),
+        'average_concurrent': round(float(busy.sum() / total_seconds), 3),
+        'utilization': round(float(busy.sum() / (total_seconds * device_count)), 4),
+        'buckets': buckets
+    })
+    return result
+
+
+def heatmap(date_from, date_to, player_id=None, per_device=False):
+    """星期 × 小时的使用热力图（date_from 到 date_to，含两端）"""
+    range_start = datetime(date_from.year, date_from.month, date_from.day)
+    range_end = datetime(date_to.year, date_to.month, date_to.day) + timedelta(days=1)
+    sessions = load_sessions(range_start, range_end, player_id)
+
+    grid, slot_hours = weekday_hour_grid(sessions, range_start, range_end, per_device)
+    capacity = (slot_hours * 3600).astype(float)
+    capacity[capacity == 0] = np.nan
+
+    def cells(occupied, device_count):
+        utilization = np.nan_to_num(occupied / (capacity * max(device_count, 1)))
+        return {
+            'occupied_seconds': np.rint(occupied).astype(int).reshape(7, 24).tolist(),
+            'utilization': np.round(utilization, 4).reshape(7, 24).tolist()
+        }
+
+    venue = grid.sum(axis=0)
+    result = {
+        'start_date': date_from.isoformat(),
+        'end_date': date_to.isoformat(),
+        'device_count': len(sessions.devices),
+        'venue': cells(venue, len(sessions.devices))
+    }
+    if per_device:
+        result['devices'] = [
+            dict(player_id=player_id, player_name=player_name, **cells(grid[code], 1))
+            for code, (player_id, player_name) in enumerate(sessions.devices)
+        ]
+    return result
@@ -1,5 +1,6 @@
-from flask import Flask, jsonify, request, send_from_directory, Response
+from flask import Flask, jsonify, request, send_from_directory, Response, g
 from flask_cors import CORS
+import base64
 import json
 import time
 import threading
@@ -11,53 +12,575 @@ def format_datetime_for_frontend(dt):
         return None
     # 确保返回 ISO 格式的 UTC 时间
     return dt.isoformat() + 'Z' if not dt.isoformat().endswith('Z') else dt.isoformat()
-from models import GameSession, db
+from peewee import fn, Tuple
+from models import (GameSession, DailyDeviceUsage, DeviceHeartbeat, db, refresh_daily_usage,
+                    bump_session_generation)
+from device_registry import device_registry
+from broadcaster import Broadcaster
+from ipc_bus import EventBusClient, load_states
+from archive import (archives_for_range, archived_player_totals, merge_player_totals,
+                     archived_sessions_page, delete_archived_session, delete_device_from_archives)
+from response_cache import cached_response, bump_data_version
+from session_export import export_stream, CONTENT_TYPES, FORMAT_CSV
+import analytics
+from columnar_store import get_store as get_analytics_store
+from duration_sketch import DurationSketch
+import metrics
 from datetime import datetime, timedelta
 import logging
 
 app = Flask(__name__)
 CORS(app, origins=["*"])
 
-# 用于实时更新的队列
+# 用于实时更新的队列（MQTT 客户端写入，由推送线程消费）
 update_queue = queue.Queue()
-clients = []
+
+# SSE 广播，每个客户端一个有界队列
+broadcaster = Broadcaster()
+_update_pump_thread = None
+_update_pump_lock = threading.Lock()
+
+HEARTBEAT_MESSAGE = f"data: {json.dumps({'type': 'heartbeat'})}\n\n".encode()
+# /api/concurrency 单次请求最多返回的时间桶数
+MAX_CONCURRENCY_BUCKETS = 10000
+# /api/dashboard 可以返回的部分
+DASHBOARD_SECTIONS = ('stats', 'device_status', 'daily_chart', 'players', 'daily_summary')
+
+# 多进程部署时订阅写入进程变更通知的客户端（见 start_event_bus_client）
+event_bus = None
+
+metrics.SSE_SUBSCRIBERS.set_function(lambda: broadcaster.subscriber_count)
+metrics.UPDATE_QUEUE_DEPTH.set_function(update_queue.qsize)
 
 # 配置日志
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+def get_usage_totals(start_date, end_date):
+    """从每日汇总表获取日期范围内（含两端）的总时长和会话数"""
+    store = get_analytics_store()
+    if store is not None:
+        return store.usage_totals(start_date, end_date)
+    row = DailyDeviceUsage.select(
+        fn.COALESCE(fn.SUM(DailyDeviceUsage.total_seconds), 0).alias('total_seconds'),
+        fn.COALESCE(fn.SUM(DailyDeviceUsage.session_count), 0).alias('session_count')
+    ).where(
+        DailyDeviceUsage.date.between(start_date, end_date)
+    ).dicts().get()
+    return row['total_seconds'], row['session_count']
+
+def get_active_player_count(day):
+    """当天开始过会话的设备数"""
+    store = get_analytics_store()
+    if store is not None:
+        return store.active_player_count(day)
+    
+    # 按设备 ID 计数，改过名称的设备只算一次（与列式引擎一致）
+    active_players = GameSession.select(
+        GameSession.player_id
+    ).where(
+        GameSession.start_time >= day,
+        GameSession.start_time < day + timedelta(days=1)
+    ).distinct()
+    if not archives_for_range(day, day):
+        return active_players.count()
+    
+    # 已归档日期的会话不在会话表中，从每日汇总补充
+    players = {player_id for (player_id,) in active_players.tuples()}
+    players.update(player_id for (player_id,) in DailyDeviceUsage.select(
+        DailyDeviceUsage.player_id
+    ).where(DailyDeviceUsage.date == day).tuples())
+    return len(players)
+
+def get_daily_totals(start_date, end_date):
+    """每天已结束会话的总时长和会话数：{日期: {'total_seconds', 'session_count'}}"""
+    store = get_analytics_store()
+    if store is not None:
+        return store.daily_totals(start_date, end_date)
+    
+    # 从每日汇总表一次性读取范围内每天的数据
+    daily_rows = DailyDeviceUsage.select(
+        DailyDeviceUsage.date,
+        fn.SUM(DailyDeviceUsage.total_seconds).alias('total_seconds'),
+        fn.SUM(DailyDeviceUsage.session_count).alias('session_count')
+    ).where(
+        DailyDeviceUsage.date.between(start_date, end_date)
+    ).group_by(DailyDeviceUsage.date)
+    return {row['date']: row for row in daily_rows.dicts()}
+
+def get_daily_device_summary(start_date, end_date):
+    """按日期归集每台设备的会话数、时长和最近活动：{日期: {player_id: {...}}}"""
+    store = get_analytics_store()
+    if store is not None:
+        return store.daily_device_summary(start_date, end_date)
+    
+    # 已结束会话的汇总来自每日汇总表
+    usage_rows = DailyDeviceUsage.select().where(
+        DailyDeviceUsage.date.between(start_date, end_date)
+    )
+    
+    # 未结束的会话走部分索引，数量很少
+    open_sessions = GameSession.select().where(
+        GameSession.end_time.is_null(),
+        GameSession.start_time >= start_date,
+        GameSession.start_time < end_date + timedelta(days=1)
+    )
+    
+    days_devices = {}
+    for row in usage_rows:
+        day_devices = days_devices.setdefault(row.date, {})
+        day_devices[row.player_id] = {
+            'player_name': row.player_name,
+            'sessions': row.session_count,
+            'total_time': row.total_seconds,
+            'completed_sessions': row.session_count,
+            'active_sessions': 0,
+            'last_activity': row.last_activity
+        }
+    
+    for session in open_sessions:
+        day_devices = days_devices.setdefault(session.start_time.date(), {})
+        device = day_devices.setdefault(session.player_id, {
+            'player_name': session.player_name,
+            'sessions': 0,
+            'total_time': 0,
+            'completed_sessions': 0,
+            'active_sessions': 0,
+            'last_activity': session.start_time
+        })
+        device['sessions'] += 1
+        device['active_sessions'] += 1
+        if device['last_activity'] is None or session.start_time > device['last_activity']:
+            device['last_activity'] = session.start_time
+    return days_devices
+
+def get_duration_sketches(date_from=None, date_to=None, player_id=None):
+    """合并每日汇总中的时长草图：{player_id: (player_name, DurationSketch)}"""
+    query = DailyDeviceUsage.select(
+        DailyDeviceUsage.player_id,
+        fn.MAX(DailyDeviceUsage.player_name),
+        fn.sketch_union(DailyDeviceUsage.duration_sketch)
+    ).group_by(DailyDeviceUsage.player_id)
+    if date_from is not None:
+        query = query.where(DailyDeviceUsage.date >= date_from)
+    if date_to is not None:
+        query = query.where(DailyDeviceUsage.date <= date_to)
+    if player_id is not None:
+        query = query.where(DailyDeviceUsage.player_id == player_id)
+    return {
+        player_id: (player_name, DurationSketch.from_bytes(sketch))
+        for player_id, player_name, sketch in query.tuples()
+    }
+
+def load_analytics_store():
+    """启用列式统计引擎时在启动阶段加载快照"""
+    store = get_analytics_store()
+    if store is not None:
+        store.load()
+        logger.info(f"列式统计快照已加载: {len(store)} 个会话，{store.memory_bytes() / 1024 / 1024:.1f} MB")
+
+def invalidate_analytics_store():
+    """会话被删除或由外部工具改写后，列式快照需要整体重新加载"""
+    store = get_analytics_store()
+    if store is not None:
+        store.invalidate()
+
+class DashboardContext:
+    """一次请求内多个部分共享的中间结果
+
+    prefetch_days() 之后，范围内的日/周统计、每日图表和每日汇总都由同一次
+    get_daily_device_summary 的结果计算；设备状态和在线计数使用同一份设备列表。
+    没有预取的范围仍按各自的查询计算，因此单独的接口不受影响。
+    """
+    
+    def __init__(self):
+        self._devices = None
+        self._days_devices = {}
+        self._ranges = []
+    
+    def prefetch_days(self, start_date, end_date):
+        """一次读取日期范围内（含两端）每台设备每天的汇总"""
+        self._days_devices.update(get_daily_device_summary(start_date, end_date))
+        self._ranges.append((start_date, end_date))
+    
+    def _covers(self, start_date, end_date):
+        return any(start <= start_date and end_date <= end for start, end in self._ranges)
+    
+    def daily_device_summary(self, start_date, end_date):
+        if not self._covers(start_date, end_date):
+            return get_daily_device_summary(start_date, end_date)
+        return {day: devices for day, devices in self._days_devices.items()
+                if start_date <= day <= end_date}
+    
+    def daily_totals(self, start_date, end_date):
+        if not self._covers(start_date, end_date):
+            return get_daily_totals(start_date, end_date)
+        totals = {}
+        for day, devices in self.daily_device_summary(start_date, end_date).items():
+            session_count = sum(d['completed_sessions'] for d in devices.values())
+            if session_count:
+                totals[day] = {
+                    'total_seconds': sum(d['total_time'] for d in devices.values()),
+                    'session_count': session_count
+                }
+        return totals
+    
+    def usage_totals(self, start_date, end_date):
+        if not self._covers(start_date, end_date):
+            return get_usage_totals(start_date, end_date)
+        totals = self.daily_totals(start_date, end_date).values()
+        return (sum(t['total_seconds'] for t in totals),
+                sum(t['session_count'] for t in totals))
+    
+    def active_player_count(self, day):
+        if not self._covers(day, day):
+            return get_active_player_count(day)
+        return len(self._days_devices.get(day, {}))
+    
+    def devices(self):
+        """设备状态列表（每个请求只读取一次注册表）"""
+        if self._devices is None:
+            self._devices = device_registry.snapshot()
+        return self._devices
+    
+    def device_counts(self):
+        """正在游戏和在线的设备数；已读取设备列表时与之保持一致"""
+        if self._devices is None:
+            return device_registry.counts()
+        statuses = [device['status'] for device in self._devices]
+        playing = statuses.count('playing')
+        return {
+            'playing': playing,
+            'online': playing + statuses.count('online'),
+            'total': len(statuses)
+        }
+
+def parse_chart_range(days=7, start_date_str=None, end_date_str=None):
+    """每日图表的日期范围：指定开始和结束日期时使用它们，否则为截至今天的最近 days 天"""
+    if start_date_str and end_date_str:
+        return (datetime.strptime(start_date_str, '%Y-%m-%d').date(),
+                datetime.strptime(end_date_str, '%Y-%m-%d').date())
+    end_date = datetime.now().date()
+    return end_date - timedelta(days=days-1), end_date
+
+def build_stats(context, target_date):
+    """/api/stats 的数据"""
+    # 指定日期统计
+    day_total_time, day_session_count = context.usage_totals(target_date, target_date)
+    
+    # 本周统计
+    week_start = target_date - timedelta(days=target_date.weekday())
+    week_total_time, week_session_count = context.usage_totals(
+        week_start, week_start + timedelta(days=6))
+    
+    # 活跃玩家统计
+    active_player_count = context.active_player_count(target_date)
+    
+    # 在线设备统计（正在游戏或5分钟内结束游戏的设备），由内存注册表增量维护
+    device_counts = context.device_counts()
+    
+    return {
+        'selected_date': target_date.isoformat(),
+        'day': {
+            'total_time_seconds': day_total_time,
+            'session_count': day_session_count,
+            'active_players': active_player_count
+        },
+        'week': {
+            'total_time_seconds': week_total_time,
+            'session_count': week_session_count
+        },
+        'online_devices': device_counts['online'],
+        'playing_devices': device_counts['playing']
+    }
+
+def build_players(date_from=None, date_to=None, limit=None):
+    """/api/players 的数据"""
+    total_time = fn.COALESCE(fn.SUM(GameSession.duration_seconds), 0)
+    
+    # 单次聚合查询获取所有玩家的统计信息，排序在 SQL 中完成
+    query = GameSession.select(
+        GameSession.player_id,
+        GameSession.player_name,
+        total_time.alias('total_time_seconds'),
+        fn.COUNT(GameSession.duration_seconds).alias('session_count'),
+        fn.MAX(GameSession.start_time).alias('last_start_time'),
+        fn.MAX(GameSession.end_time).alias('last_end_time')
+    ).group_by(
+        GameSession.player_id,
+        GameSession.player_name
+    ).order_by(total_time.desc())
+    
+    if date_from:
+        query = query.where(GameSession.start_time >= date_from)
+    if date_to:
+        query = query.where(GameSession.start_time < date_to + timedelta(days=1))
+    
+    # 日期范围涉及已归档的月份时，合并归档中的统计后再排序截取
+    if archives_for_range(date_from, date_to):
+        totals = archived_player_totals(date_from, date_to)
+        for player in query.dicts():
+            merge_player_totals(totals, player)
+        players = sorted(totals.values(), key=lambda p: p['total_time_seconds'], reverse=True)
+        if limit:
+            players = players[:limit]
+    else:
+        if limit:
+            query = query.limit(limit)
+        players = query.dicts()
+    
+    sketches = get_duration_sketches(date_from, date_to)
+    
+    result = []
+    for player in players:
+        _, sketch = sketches.get(player['player_id'], (None, DurationSketch()))
+        # 使用最新的活动时间（开始时间或结束时间中较晚的）
+        last_played = player['last_start_time']
+        if player['last_end_time'] and player['last_end_time'] > last_played:
+            last_played = player['last_end_time']
+        
+        result.append({
+            'player_id': player['player_id'],
+            'player_name': player['player_name'],
+            'total_time_seconds': player['total_time_seconds'],
+            'session_count': player['session_count'],
+            'last_played': format_datetime_for_frontend(last_played),
+            'duration_percentiles': sketch.percentiles()
+        })
+    return result
+
+def build_device_status(context):
+    """/api/device-status 的数据"""
+    # 从内存注册表读取所有设备的最新状态
+    devices = []
+    for device in context.devices():
+        devices.append({
+            'player_id': device['player_id'],
+            'player_name': device['player_name'],
+            'status': device['status'],
+            'current_session_id': device['current_session_id'],
+            'last_activity': format_datetime_for_frontend(device['last_activity'])
+        })
+    
+    # 统计各状态数量
+    status_count = {
+        'online': len([d for d in devices if d['status'] == 'online']),
+        'playing': len([d for d in devices if d['status'] == 'playing']),
+        'offline': len([d for d in devices if d['status'] == 'offline'])
+    }
+    
+    return {
+        'devices': devices,
+        'status_count': status_count,
+        'total_devices': len(devices)
+    }
+
+def build_daily_chart(context, start_date, end_date):
+    """/api/daily-chart 的数据"""
+    days = (end_date - start_date).days + 1
+    daily_totals = context.daily_totals(start_date, end_date)
+    
+    chart_data = []
+    total_period_time = 0
+    total_period_sessions = 0
+    
+    for i in range(days):
+        current_date = start_date + timedelta(days=i)
+        
+        day_row = daily_totals.get(current_date)
+        total_time = day_row['total_seconds'] if day_row else 0
+        session_count = day_row['session_count'] if day_row else 0
+        
+        total_period_time += total_time
+        total_period_sessions += session_count
+        
+        chart_data.append({
+            'date': current_date.isoformat(),
+            'total_time_minutes': round(total_time / 60, 1),
+            'total_time_hours': round(total_time / 3600, 2),
+            'session_count': session_count
+        })
+    
+    return {
+        'daily_data': chart_data,
+        'period_summary': {
+            'start_date': start_date.isoformat(),
+            'end_date': end_date.isoformat(),
+            'total_days': days,
+            'total_time_minutes': round(total_period_time / 60, 1),
+            'total_time_hours': round(total_period_time / 3600, 2),
+            'total_sessions': total_period_sessions,
+            'avg_daily_minutes': round(total_period_time / 60 / days, 1) if days > 0 else 0
+        }
+    }
+
+def build_daily_summary(context, days=7):
+    """/api/daily-summary 的数据（最新的日期在前）"""
+    end_date = datetime.now().date()
+    start_date = end_date - timedelta(days=days-1)
+    
+    # 按日期归集每台设备的数据
+    days_devices = context.daily_device_summary(start_date, end_date)
+    
+    daily_summary = []
+    
+    for i in range(days):
+        current_date = start_date + timedelta(days=i)
+        active_devices = days_devices.get(current_date, {})
+        
+        # 统计当天数据
+        total_time = sum(d['total_time'] for d in active_devices.values())
+        completed_count = sum(d['completed_sessions'] for d in active_devices.values())
+        active_count = sum(d['active_sessions'] for d in active_devices.values())
+        
+        # 最近活动的设备在前，格式化设备数据中的时间
+        formatted_devices = []
+        for device_data in sorted(active_devices.values(),
+                                  key=lambda d: d['last_activity'], reverse=True):
+            formatted_devices.append({
+                'player_name': device_data['player_name'],
+                'sessions': device_data['sessions'],
+                'total_time': device_data['total_time'],
+                'last_activity': format_datetime_for_frontend(device_data['last_activity'])
+            })
+        
+        daily_summary.append({
+            'date': current_date.isoformat(),
+            'total_time_seconds': total_time,
+            'total_time_minutes': round(total_time / 60, 1),
+            'completed_sessions': completed_count,
+            'active_sessions': active_count,
+            'total_sessions': completed_count + active_count,
+            'active_devices_count': len(active_devices),
+            'devices': formatted_devices
+        })
+    
+    # 按日期倒序排列（最新的在前面）
+    daily_summary.reverse()
+    return daily_summary
+
 @app.before_request
 def before_request():
-    """每次请求前连接数据库"""
-    if db.is_closed():
-        db.connect()
+    """每次请求前从连接池获取当前线程的数据库连接"""
+    g.request_started = time.perf_counter()
+    g.sql_statements = metrics.sql_statement_count()
+    db.connect(reuse_if_open=True)
 
 @app.after_request
 def after_request(response):
-    """每次请求后关闭数据库连接"""
+    """记录请求耗时和执行的 SQL 语句数"""
+    if 'request_started' in g:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        metrics.HTTP_REQUEST_SECONDS.labels(route).observe(
+            time.perf_counter() - g.request_started)
+        metrics.SQL_STATEMENTS_PER_REQUEST.labels(route).observe(
+            metrics.sql_statement_count() - g.sql_statements)
+    return response
+
+@app.teardown_request
+def teardown_request(exception):
+    """请求结束后将当前线程的连接归还连接池"""
     if not db.is_closed():
         db.close()
-    return response
+
+def encode_session_cursor(session):
+    """将 (created_at, id) 编码为不透明的分页游标"""
+    raw = json.dumps([session.created_at.isoformat(), session.id])
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+def decode_session_cursor(cursor):
+    """解析分页游标，格式错误时抛出 ValueError"""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        created_at, session_id = json.loads(base64.urlsafe_b64decode(padded))
+        return datetime.fromisoformat(created_at), int(session_id)
+    except Exception:
+        raise ValueError('无效的分页游标')
 
 @app.route('/api/sessions', methods=['GET'])
 def get_sessions():
-    """获取游戏会话列表"""
+    """获取游戏会话列表（基于游标分页，按创建时间倒序）
+
+    默认只列出会话表中的会话；include_archived=1 时合并已归档的会话（只支持游标分页），
+    每条记录带 archived 字段
+    """
     try:
-        page = int(request.args.get('page', 1))
         per_page = int(request.args.get('per_page', 20))
         player_id = request.args.get('player_id')
+        cursor = request.args.get('cursor')
+        direction = request.args.get('direction', 'after')
+        include_archived = request.args.get('include_archived') == '1'
         
-        query = GameSession.select().order_by(GameSession.created_at.desc())
+        if direction not in ('after', 'before'):
+            return jsonify({'success': False, 'error': 'direction 只能是 after 或 before'}), 400
+        if include_archived and 'page' in request.args and not cursor:
+            return jsonify({'success': False, 'error': 'include_archived 只支持游标分页'}), 400
         
+        query = GameSession.select()
         if player_id:
             query = query.where(GameSession.player_id == player_id)
         
-        # 分页
-        sessions = query.paginate(page, per_page)
+        # 兼容旧的页码分页（OFFSET，越往后越慢）
+        if 'page' in request.args and not cursor:
+            page = int(request.args.get('page', 1))
+            sessions = list(query.order_by(
+                GameSession.created_at.desc(), GameSession.id.desc()
+            ).paginate(page, per_page))
+            has_more = len(sessions) == per_page
+            has_newer = page > 1
+        else:
+            page = None
+            sort_key = Tuple(GameSession.created_at, GameSession.id)
+            cursor_values = None
+            
+            if cursor:
+                try:
+                    cursor_values = decode_session_cursor(cursor)
+                except ValueError as e:
+                    return jsonify({'success': False, 'error': str(e)}), 400
+                cursor_key = Tuple(*cursor_values)
+                
+                if direction == 'after':
+                    # 游标之后（更早创建）的记录
+                    query = query.where(sort_key < cursor_key)
+                else:
+                    # 游标之前（更晚创建）的记录
+                    query = query.where(sort_key > cursor_key)
+            
+            # 多取一条用于判断是否还有更多数据
+            if direction == 'after':
+                query = query.order_by(GameSession.created_at.desc(), GameSession.id.desc())
+            else:
+                query = query.order_by(GameSession.created_at.asc(), GameSession.id.asc())
+            sessions = list(query.limit(per_page + 1))
+            if include_archived:
+                # 各归档文件同样多取一条，合并排序后再截取
+                for session in sessions:
+                    session.archived = False
+                for row in archived_sessions_page(cursor_values, direction, per_page + 1,
+                                                  player_id or None):
+                    session = GameSession(id=row[0], player_id=row[1], player_name=row[2],
+                                          start_time=row[3], end_time=row[4],
+                                          duration_seconds=row[5], created_at=row[6])
+                    session.archived = True
+                    sessions.append(session)
+                sessions.sort(key=lambda session: (session.created_at, session.id),
+                              reverse=direction == 'after')
+                sessions = sessions[:per_page + 1]
+            has_extra = len(sessions) > per_page
+            sessions = sessions[:per_page]
+            
+            if direction == 'after':
+                has_more = has_extra
+                has_newer = cursor is not None
+            else:
+                sessions.reverse()
+                has_more = True
+                has_newer = has_extra
         
         result = []
         for session in sessions:
-            result.append({
+            item = {
                 'id': session.id,
                 'player_id': session.player_id,
                 'player_name': session.player_name,
@@ -65,20 +588,63 @@ def get_sessions():
                 'end_time': session.end_time.isoformat() if session.end_time else None,
                 'duration_seconds': session.duration_seconds,
                 'created_at': session.created_at.isoformat()
-            })
+            }
+            if include_archived:
+                item['archived'] = session.archived
+            result.append(item)
         
-        return jsonify({
+        response = {
             'success': True,
             'data': result,
-            'page': page,
-            'per_page': per_page
-        })
+            'per_page': per_page,
+            'next_cursor': encode_session_cursor(sessions[-1]) if sessions and has_more else None,
+            'prev_cursor': encode_session_cursor(sessions[0]) if sessions and has_newer else None
+        }
+        if page is not None:
+            response['page'] = page
+        
+        return jsonify(response)
         
     except Exception as e:
         logger.error(f"获取会话列表时出错: {e}")
         return jsonify({'success': False, 'error': str(e)}), 500
 
+@app.route('/api/sessions/export', methods=['GET'])
+def export_sessions():
+    """流式导出会话（CSV 或 NDJSON），客户端支持 gzip 时压缩输出
+
+    参数：format=csv|ndjson，date_from、date_to（按开始日期，含两端），player_id
+    """
+    try:
+        fmt = request.args.get('format', FORMAT_CSV)
+        if fmt not in CONTENT_TYPES:
+            return jsonify({'success': False, 'error': 'format 只能是 csv 或 ndjson'}), 400
+        
+        date_from = date_to = None
+        if request.args.get('date_from'):
+            date_from = datetime.strptime(request.args['date_from'], '%Y-%m-%d').date()
+        if request.args.get('date_to'):
+            date_to = datetime.strptime(request.args['date_to'], '%Y-%m-%d').date()
+        player_id = request.args.get('player_id') or None
+        
+        # 按 q 值协商，gzip;q=0 表示不接受
+        compress = request.accept_encodings['gzip'] > 0
+        headers = {
+            'Content-Disposition': f'attachment; filename="sessions.{fmt}"',
+            'Vary': 'Accept-Encoding'
+        }
+        if compress:
+            headers['Content-Encoding'] = 'gzip'
+        
+        body = export_stream(db.database, fmt, date_from, date_to, player_id, compress=compress)
+        return Response(body, content_type=CONTENT_TYPES[fmt], headers=headers)
+        
+    except Exception as e:
+        logger.error(f"导出会话时出错: {e}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
 @app.route('/api/stats', methods=['GET'])
+@cached_response(ttl=30)
 def get_stats():
     """获取使用统计"""
     try:
@@ -88,61 +654,9 @@ def get_stats():
         else:
             target_date = datetime.now().date()
         
-        # 指定日期统计
-        day_sessions = GameSession.select().where(
-            GameSession.start_time >= target_date,
-            GameSession.start_time < target_date + timedelta(days=1),
-            GameSession.duration_seconds.is_null(False)
-        )
-        
-        day_total_time = sum(session.duration_seconds for session in day_sessions)
-        day_session_count = day_sessions.count()
-        
-        # 本周统计
-        week_start = target_date - timedelta(days=target_date.weekday())
-        week_sessions = GameSession.select().where(
-            GameSession.start_time >= week_start,
-            GameSession.start_time < week_start + timedelta(days=7),
-            GameSession.duration_seconds.is_null(False)
-        )
-        
-        week_total_time = sum(session.duration_seconds for session in week_sessions)
-        week_session_count = week_sessions.count()
-        
-        # 活跃玩家统计
-        active_players = GameSession.select(
-            GameSession.player_id,
-            GameSession.player_name
-        ).where(
-            GameSession.start_time >= target_date,
-            GameSession.start_time < target_date + timedelta(days=1)
-        ).distinct()
-        
-        # 在线设备统计（最近5分钟内有活动的设备）
-        five_minutes_ago = datetime.now() - timedelta(minutes=5)
-        online_devices = GameSession.select(
-            GameSession.player_id,
-            GameSession.player_name
-        ).where(
-            (GameSession.end_time.is_null()) |
-            (GameSession.start_time >= five_minutes_ago)
-        ).distinct()
-        
         return jsonify({
             'success': True,
-            'data': {
-                'selected_date': target_date.isoformat(),
-                'day': {
-                    'total_time_seconds': day_total_time,
-                    'session_count': day_session_count,
-                    'active_players': active_players.count()
-                },
-                'week': {
-                    'total_time_seconds': week_total_time,
-                    'session_count': week_session_count
-                },
-                'online_devices': online_devices.count()
-            }
+            'data': build_stats(DashboardContext(), target_date)
         })
         
     except Exception as e:
@@ -150,53 +664,23 @@ def get_stats():
         return jsonify({'success': False, 'error': str(e)}), 500
 
 @app.route('/api/players', methods=['GET'])
+@cached_response()
 def get_players():
     """获取玩家列表及其使用统计"""
     try:
-        # 获取所有玩家的统计信息
-        players_query = GameSession.select(
-            GameSession.player_id,
-            GameSession.player_name,
-        ).distinct()
+        date_from_str = request.args.get('date_from')
+        date_to_str = request.args.get('date_to')
+        limit = request.args.get('limit', type=int)
         
-        result = []
-        for player in players_query:
-            # 计算该玩家的总使用时长
-            player_sessions = GameSession.select().where(
-                GameSession.player_id == player.player_id,
-                GameSession.duration_seconds.is_null(False)
-            )
-            
-            total_time = sum(session.duration_seconds for session in player_sessions)
-            session_count = player_sessions.count()
-            
-            # 最后一次游戏时间 - 使用最新的活动时间
-            last_session = GameSession.select().where(
-                GameSession.player_id == player.player_id
-            ).order_by(GameSession.start_time.desc()).first()
-            
-            last_played = None
-            if last_session:
-                # 使用最新的活动时间（开始时间或结束时间中较晚的）
-                if last_session.end_time:
-                    last_played = max(last_session.start_time, last_session.end_time)
-                else:
-                    last_played = last_session.start_time
-            
-            result.append({
-                'player_id': player.player_id,
-                'player_name': player.player_name,
-                'total_time_seconds': total_time,
-                'session_count': session_count,
-                'last_played': format_datetime_for_frontend(last_played)
-            })
-        
-        # 按总使用时长排序
-        result.sort(key=lambda x: x['total_time_seconds'], reverse=True)
+        date_from = date_to = None
+        if date_from_str:
+            date_from = datetime.strptime(date_from_str, '%Y-%m-%d').date()
+        if date_to_str:
+            date_to = datetime.strptime(date_to_str, '%Y-%m-%d').date()
         
         return jsonify({
             'success': True,
-            'data': result
+            'data': build_players(date_from, date_to, limit)
         })
         
     except Exception as e:
@@ -207,65 +691,9 @@ def get_players():
 def get_device_status():
     """获取设备实时状态"""
     try:
-        # 获取所有设备的最新状态
-        devices = []
-        
-        # 查询所有有记录的设备
-        all_devices = GameSession.select(
-            GameSession.player_id,
-            GameSession.player_name
-        ).distinct()
-        
-        for device in all_devices:
-            # 查找最新的会话记录
-            latest_session = GameSession.select().where(
-                GameSession.player_id == device.player_id
-            ).order_by(GameSession.start_time.desc()).first()
-            
-            # 判断设备状态
-            status = "offline"
-            current_session_id = None
-            last_activity = None
-            
-            if latest_session:
-                # 使用最新的活动时间（开始时间或结束时间中较晚的）
-                if latest_session.end_time:
-                    last_activity = max(latest_session.start_time, latest_session.end_time)
-                else:
-                    last_activity = latest_session.start_time
-                
-                if latest_session.end_time is None:
-                    # 有未结束的会话，设备在线且使用中
-                    status = "playing"
-                    current_session_id = latest_session.id
-                else:
-                    # 检查最后活动时间，5分钟内算在线
-                    time_diff = datetime.now() - latest_session.end_time
-                    if time_diff.total_seconds() < 300:  # 5分钟
-                        status = "online"
-            
-            devices.append({
-                'player_id': device.player_id,
-                'player_name': device.player_name,
-                'status': status,
-                'current_session_id': current_session_id,
-                'last_activity': format_datetime_for_frontend(last_activity)
-            })
-        
-        # 统计各状态数量
-        status_count = {
-            'online': len([d for d in devices if d['status'] == 'online']),
-            'playing': len([d for d in devices if d['status'] == 'playing']),
-            'offline': len([d for d in devices if d['status'] == 'offline'])
-        }
-        
         return jsonify({
             'success': True,
-            'data': {
-                'devices': devices,
-                'status_count': status_count,
-                'total_devices': len(devices)
-            }
+            'data': build_device_status(DashboardContext())
         })
         
     except Exception as e:
@@ -273,70 +701,136 @@ def get_device_status():
         return jsonify({'success': False, 'error': str(e)}), 500
 
 @app.route('/api/daily-chart', methods=['GET'])
+@cached_response()
 def get_daily_chart():
     """获取每日使用时长图表数据"""
     try:
-        days = int(request.args.get('days', 7))  # 默认7天
-        start_date_str = request.args.get('start_date')
-        end_date_str = request.args.get('end_date')
-        
-        # 如果提供了具体的开始和结束日期
-        if start_date_str and end_date_str:
-            start_date = datetime.strptime(start_date_str, '%Y-%m-%d').date()
-            end_date = datetime.strptime(end_date_str, '%Y-%m-%d').date()
-            days = (end_date - start_date).days + 1
-        else:
-            # 使用默认的天数范围
-            end_date = datetime.now().date()
-            start_date = end_date - timedelta(days=days-1)
-        
-        chart_data = []
-        total_period_time = 0
-        total_period_sessions = 0
-        
-        for i in range(days):
-            current_date = start_date + timedelta(days=i)
-            
-            # 查询当天的会话数据
-            day_sessions = GameSession.select().where(
-                GameSession.start_time >= current_date,
-                GameSession.start_time < current_date + timedelta(days=1),
-                GameSession.duration_seconds.is_null(False)
-            )
-            
-            total_time = sum(session.duration_seconds for session in day_sessions)
-            session_count = day_sessions.count()
-            
-            total_period_time += total_time
-            total_period_sessions += session_count
-            
-            chart_data.append({
-                'date': current_date.isoformat(),
-                'total_time_minutes': round(total_time / 60, 1),
-                'total_time_hours': round(total_time / 3600, 2),
-                'session_count': session_count
-            })
+        start_date, end_date = parse_chart_range(
+            int(request.args.get('days', 7)),  # 默认7天
+            request.args.get('start_date'),
+            request.args.get('end_date')
+        )
         
         return jsonify({
             'success': True,
-            'data': {
-                'daily_data': chart_data,
-                'period_summary': {
-                    'start_date': start_date.isoformat(),
-                    'end_date': end_date.isoformat(),
-                    'total_days': days,
-                    'total_time_minutes': round(total_period_time / 60, 1),
-                    'total_time_hours': round(total_period_time / 3600, 2),
-                    'total_sessions': total_period_sessions,
-                    'avg_daily_minutes': round(total_period_time / 60 / days, 1) if days > 0 else 0
-                }
-            }
+            'data': build_daily_chart(DashboardContext(), start_date, end_date)
         })
         
     except Exception as e:
         logger.error(f"获取图表数据时出错: {e}")
         return jsonify({'success': False, 'error': str(e)}), 500
 
+@app.route('/api/heatmap', methods=['GET'])
+@cached_response(ttl=60)
+def get_heatmap():
+    """星期 × 小时的设备占用热力图
+
+    参数：date_from、date_to（含两端，默认最近 4 周），player_id（只统计一台设备），
+    per_device=1（额外返回每台设备的热力图）
+    """
+    try:
+        date_to = datetime.now().date()
+        if request.args.get('date_to'):
+            date_to = datetime.strptime(request.args['date_to'], '%Y-%m-%d').date()
+        date_from = date_to - timedelta(days=27)
+        if request.args.get('date_from'):
+            date_from = datetime.strptime(request.args['date_from'], '%Y-%m-%d').date()
+        if date_from > date_to:
+            return jsonify({'success': False, 'error': 'date_from 不能晚于 date_to'}), 400
+        
+        data = analytics.heatmap(
+            date_from, date_to,
+            player_id=request.args.get('player_id') or None,
+            per_device=request.args.get('per_device') in ('1', 'true')
+        )
+        return jsonify({'success': True, 'data': data})
+        
+    except Exception as e:
+        logger.error(f"获取热力图数据时出错: {e}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/api/durations', methods=['GET'])
+@cached_response()
+def get_durations():
+    """已结束会话的时长分布（p50/p90/p99 和直方图）
+
+    参数：date_from、date_to（含两端，默认最近 30 天），player_id（只统计一台设备），
+    per_device=1（额外返回每台设备的分布）
+    """
+    try:
+        date_to = datetime.now().date()
+        if request.args.get('date_to'):
+            date_to = datetime.strptime(request.args['date_to'], '%Y-%m-%d').date()
+        date_from = date_to - timedelta(days=29)
+        if request.args.get('date_from'):
+            date_from = datetime.strptime(request.args['date_from'], '%Y-%m-%d').date()
+        if date_from > date_to:
+            return jsonify({'success': False, 'error': 'date_from 不能晚于 date_to'}), 400
+        
+        sketches = get_duration_sketches(date_from, date_to,
+                                         player_id=request.args.get('player_id') or None)
+        
+        def distribution(sketch):
+            return dict(count=sketch.count, histogram=sketch.histogram(), **sketch.percentiles())
+        
+        venue = DurationSketch()
+        for _, sketch in sketches.values():
+            venue.merge(sketch)
+        data = {
+            'start_date': date_from.isoformat(),
+            'end_date': date_to.isoformat(),
+            'venue': distribution(venue)
+        }
+        if request.args.get('per_device') in ('1', 'true'):
+            devices = sorted(sketches.items(), key=lambda item: item[1][1].count, reverse=True)
+            data['devices'] = [
+                dict(player_id=player_id, player_name=player_name, **distribution(sketch))
+                for player_id, (player_name, sketch) in devices
+            ]
+        return jsonify({'success': True, 'data': data})
+        
+    except Exception as e:
+        logger.error(f"获取时长分布时出错: {e}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/api/concurrency', methods=['GET'])
+@cached_response(ttl=60)
+def get_concurrency():
+    """同时进行的会话数时间线
+
+    参数：date_from、date_to（含两端，默认最近 7 天），bucket_minutes（时间桶分钟数，默认 60），
+    player_id（只统计一台设备）
+    """
+    try:
+        today = datetime.now().date()
+        date_to = today
+        if request.args.get('date_to'):
+            date_to = datetime.strptime(request.args['date_to'], '%Y-%m-%d').date()
+        date_from = date_to - timedelta(days=6)
+        if request.args.get('date_from'):
+            date_from = datetime.strptime(request.args['date_from'], '%Y-%m-%d').date()
+        bucket_minutes = request.args.get('bucket_minutes', 60, type=int)
+        if date_from > date_to:
+            return jsonify({'success': False, 'error': 'date_from 不能晚于 date_to'}), 400
+        if date_from > today:
+            return jsonify({'success': False, 'error': 'date_from 不能晚于今天'}), 400
+        if not 1 <= bucket_minutes <= 1440:
+            return jsonify({'success': False, 'error': 'bucket_minutes 必须在 1 到 1440 之间'}), 400
+        if (date_to - date_from).days * 1440 // bucket_minutes > MAX_CONCURRENCY_BUCKETS:
+            return jsonify({'success': False, 'error': '时间桶数量过多，请缩小日期范围或增大 bucket_minutes'}), 400
+        
+        # 占用率按所有已知设备计算，范围内没有会话的空闲设备也计入
+        data = analytics.concurrency(
+            date_from, date_to, bucket_minutes,
+            player_id=request.args.get('player_id') or None,
+            device_count=device_registry.counts()['total']
+        )
+        return jsonify({'success': True, 'data': data})
+        
+    except Exception as e:
+        logger.error(f"获取并发数据时出错: {e}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
 @app.route('/api/device/<player_id>', methods=['DELETE'])
 def delete_device(player_id):
     """删除设备及其所有相关数据"""
@@ -346,6 +840,19 @@ def delete_device(player_id):
             GameSession.player_id == player_id
         ).execute()
         
+        DailyDeviceUsage.delete().where(
+            DailyDeviceUsage.player_id == player_id
+        ).execute()
+        DeviceHeartbeat.delete().where(
+            DeviceHeartbeat.player_id == player_id
+        ).execute()
+        deleted_count += delete_device_from_archives(player_id)
+        bump_session_generation()
+        device_registry.remove_device(player_id)
+        invalidate_analytics_store()
+        bump_data_version()
+        publish_change([player_id])
+        
         logger.info(f"删除设备 {player_id} 的 {deleted_count} 条记录")
         
         return jsonify({
@@ -359,11 +866,26 @@ def delete_device(player_id):
 
 @app.route('/api/session/<int:session_id>', methods=['DELETE'])
 def delete_session(session_id):
-    """删除单个游戏会话记录"""
+    """删除单个游戏会话记录（会话表中找不到时在归档文件中查找）"""
     try:
         # 查找并删除指定的会话记录
-        session = GameSession.get_by_id(session_id)
-        session.delete_instance()
+        session = GameSession.get_or_none(GameSession.id == session_id)
+        if session is not None:
+            session.delete_instance()
+            player_id, start_time, duration = (session.player_id, session.start_time,
+                                               session.duration_seconds)
+        else:
+            archived = delete_archived_session(session_id)
+            if archived is None:
+                return jsonify({'success': False, 'error': '会话记录不存在'}), 404
+            player_id, start_time, duration = archived
+        if duration is not None:
+            refresh_daily_usage(start_time.date(), player_id)
+        bump_session_generation()
+        device_registry.reload_device(player_id)
+        invalidate_analytics_store()
+        bump_data_version()
+        publish_change([player_id])
         
         logger.info(f"删除会话记录 {session_id}")
         
@@ -372,96 +894,97 @@ def delete_session(session_id):
             'message': f'成功删除会话记录 {session_id}'
         })
         
-    except GameSession.DoesNotExist:
-        return jsonify({'success': False, 'error': '会话记录不存在'}), 404
     except Exception as e:
         logger.error(f"删除会话记录时出错: {e}")
         return jsonify({'success': False, 'error': str(e)}), 500
 
 @app.route('/api/daily-summary', methods=['GET'])
+@cached_response()
 def get_daily_summary():
     """获取按日期汇总的使用记录"""
     try:
         days = int(request.args.get('days', 7))  # 默认显示最近7天
-        end_date = datetime.now().date()
-        start_date = end_date - timedelta(days=days-1)
-        
-        daily_summary = []
-        
-        for i in range(days):
-            current_date = start_date + timedelta(days=i)
-            
-            # 查询当天的会话数据
-            day_sessions = GameSession.select().where(
-                GameSession.start_time >= current_date,
-                GameSession.start_time < current_date + timedelta(days=1)
-            ).order_by(GameSession.start_time.desc())
-            
-            # 统计当天数据
-            completed_sessions = [s for s in day_sessions if s.duration_seconds is not None]
-            active_sessions = [s for s in day_sessions if s.duration_seconds is None]
-            
-            total_time = sum(session.duration_seconds for session in completed_sessions)
-            
-            # 获取当天活跃的设备
-            active_devices = {}
-            for session in day_sessions:
-                device_id = session.player_id
-                if device_id not in active_devices:
-                    # 计算初始的最后活动时间
-                    initial_last_activity = session.start_time
-                    if session.end_time:
-                        initial_last_activity = max(session.start_time, session.end_time)
-                    
-                    active_devices[device_id] = {
-                        'player_name': session.player_name,
-                        'sessions': 0,
-                        'total_time': 0,
-                        'last_activity': initial_last_activity
-                    }
-                
-                active_devices[device_id]['sessions'] += 1
-                if session.duration_seconds:
-                    active_devices[device_id]['total_time'] += session.duration_seconds
-                
-                # 更新最后活动时间（考虑开始时间和结束时间）
-                session_last_activity = session.start_time
-                if session.end_time:
-                    session_last_activity = max(session.start_time, session.end_time)
-                
-                if session_last_activity > active_devices[device_id]['last_activity']:
-                    active_devices[device_id]['last_activity'] = session_last_activity
-            
-            # 格式化设备数据中的时间
-            formatted_devices = []
-            for device_data in active_devices.values():
-                formatted_device = device_data.copy()
-                formatted_device['last_activity'] = format_datetime_for_frontend(device_data['last_activity'])
-                formatted_devices.append(formatted_device)
-            
-            daily_summary.append({
-                'date': current_date.isoformat(),
-                'total_time_seconds': total_time,
-                'total_time_minutes': round(total_time / 60, 1),
-                'completed_sessions': len(completed_sessions),
-                'active_sessions': len(active_sessions),
-                'total_sessions': len(day_sessions),
-                'active_devices_count': len(active_devices),
-                'devices': formatted_devices
-            })
-        
-        # 按日期倒序排列（最新的在前面）
-        daily_summary.reverse()
         
         return jsonify({
             'success': True,
-            'data': daily_summary
+            'data': build_daily_summary(DashboardContext(), days)
         })
         
     except Exception as e:
         logger.error(f"获取每日汇总数据时出错: {e}")
         return jsonify({'success': False, 'error': str(e)}), 500
 
+@app.route('/api/dashboard', methods=['GET'])
+@cached_response(ttl=30)
+def get_dashboard():
+    """一次返回页面需要的多个部分，数据格式与对应的单独接口相同
+
+    参数：sections（逗号分隔，可选 stats、device_status、daily_chart、players、daily_summary，
+    默认全部），date（stats），chart_days / chart_start_date / chart_end_date（daily_chart），
+    players_limit（players），summary_days（daily_summary）
+    """
+    try:
+        sections = DASHBOARD_SECTIONS
+        if request.args.get('sections'):
+            sections = [name.strip() for name in request.args['sections'].split(',') if name.strip()]
+        unknown = [name for name in sections if name not in DASHBOARD_SECTIONS]
+        if unknown:
+            return jsonify({'success': False, 'error': f"未知的部分: {', '.join(unknown)}"}), 400
+        
+        today = datetime.now().date()
+        target_date = today
+        if request.args.get('date'):
+            target_date = datetime.strptime(request.args['date'], '%Y-%m-%d').date()
+        chart_start, chart_end = parse_chart_range(
+            request.args.get('chart_days', 7, type=int),
+            request.args.get('chart_start_date'),
+            request.args.get('chart_end_date')
+        )
+        summary_days = request.args.get('summary_days', 7, type=int)
+        
+        # 各部分用到的日期范围，相邻或重叠的合并后各读取一次每日汇总
+        ranges = []
+        if 'stats' in sections:
+            week_start = target_date - timedelta(days=target_date.weekday())
+            ranges.append((week_start, week_start + timedelta(days=6)))
+        if 'daily_chart' in sections:
+            ranges.append((chart_start, chart_end))
+        if 'daily_summary' in sections:
+            ranges.append((today - timedelta(days=summary_days-1), today))
+        
+        context = DashboardContext()
+        merged = []
+        for start, end in sorted(ranges):
+            if merged and start <= merged[-1][1] + timedelta(days=1):
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([start, end])
+        for start, end in merged:
+            context.prefetch_days(start, end)
+        
+        data = {}
+        if 'stats' in sections:
+            data['stats'] = build_stats(context, target_date)
+        if 'device_status' in sections:
+            data['device_status'] = build_device_status(context)
+        if 'daily_chart' in sections:
+            data['daily_chart'] = build_daily_chart(context, chart_start, chart_end)
+        if 'players' in sections:
+            data['players'] = build_players(limit=request.args.get('players_limit', type=int))
+        if 'daily_summary' in sections:
+            data['daily_summary'] = build_daily_summary(context, summary_days)
+        
+        return jsonify({'success': True, 'data': data})
+        
+    except Exception as e:
+        logger.error(f"获取仪表盘数据时出错: {e}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/metrics')
+def prometheus_metrics():
+    """Prometheus 指标"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
 @app.route('/')
 def index():
     """重定向到主页"""
@@ -472,33 +995,69 @@ def static_files(filename):
     """提供静态文件"""
     return send_from_directory('static', filename)
 
+def format_sse_message(data):
+    """序列化为 SSE 消息字节"""
+    return f"data: {json.dumps(data)}\n\n".encode()
+
+def build_snapshot_message():
+    """计算一次设备状态和统计快照，序列化后供所有客户端共用"""
+    device_data = get_latest_device_status()
+    stats_data = get_latest_stats()
+    return (format_sse_message({'type': 'device_update', 'data': device_data}) +
+            format_sse_message({'type': 'stats_update', 'data': stats_data}))
+
+def update_pump():
+    """消费更新队列并广播给所有 SSE 客户端"""
+    while True:
+        data = update_queue.get()
+        try:
+            if data.get('type') == 'mqtt_update':
+                # 合并积压的 MQTT 更新信号，只计算一次快照
+                pending = []
+                while True:
+                    try:
+                        pending.append(update_queue.get_nowait())
+                    except queue.Empty:
+                        break
+                
+                if broadcaster.subscriber_count:
+                    logger.info("🔄 收到 MQTT 更新信号，推送最新数据")
+                    broadcaster.publish(build_snapshot_message())
+                
+                for other in pending:
+                    if other.get('type') != 'mqtt_update':
+                        broadcaster.publish(format_sse_message(other))
+            else:
+                # 其他类型的更新
+                broadcaster.publish(format_sse_message(data))
+        except Exception as e:
+            logger.error(f"推送实时更新失败: {e}")
+
+def ensure_update_pump():
+    """首次有客户端连接时启动推送线程"""
+    global _update_pump_thread
+    with _update_pump_lock:
+        if _update_pump_thread is None:
+            _update_pump_thread = threading.Thread(target=update_pump, daemon=True)
+            _update_pump_thread.start()
+
 @app.route('/api/events')
 def events():
     """Server-Sent Events 端点"""
+    ensure_update_pump()
+    subscriber = broadcaster.subscribe()
+    
     def event_stream():
-        while True:
-            try:
-                # 等待更新事件，超时时间缩短到10秒
-                data = update_queue.get(timeout=10)
-                
-                # 如果是 MQTT 更新信号，立即获取最新数据并推送
-                if data.get('type') == 'mqtt_update':
-                    logger.info("🔄 收到 MQTT 更新信号，推送最新数据")
-                    
-                    # 获取最新设备状态
-                    device_data = get_latest_device_status()
-                    yield f"data: {json.dumps({'type': 'device_update', 'data': device_data})}\n\n"
-                    
-                    # 获取最新统计数据
-                    stats_data = get_latest_stats()
-                    yield f"data: {json.dumps({'type': 'stats_update', 'data': stats_data})}\n\n"
-                else:
-                    # 其他类型的更新
-                    yield f"data: {json.dumps(data)}\n\n"
-                    
-            except queue.Empty:
-                # 发送心跳
-                yield f"data: {json.dumps({'type': 'heartbeat'})}\n\n"
+        try:
+            while True:
+                try:
+                    # 等待广播消息，超时时间 10 秒
+                    yield subscriber.get(timeout=10)
+                except queue.Empty:
+                    # 发送心跳
+                    yield HEARTBEAT_MESSAGE
+        finally:
+            broadcaster.unsubscribe(subscriber)
     
     return Response(event_stream(), mimetype="text/event-stream",
                    headers={
@@ -511,37 +1070,13 @@ def events():
 def get_latest_device_status():
     """获取最新设备状态"""
     try:
-        all_devices = GameSession.select(
-            GameSession.player_id,
-            GameSession.player_name
-        ).distinct()
-        
         devices = []
-        for device in all_devices:
-            latest_session = GameSession.select().where(
-                GameSession.player_id == device.player_id
-            ).order_by(GameSession.start_time.desc()).first()
-            
-            status = "offline"
-            last_activity = None
-            
-            if latest_session:
-                if latest_session.end_time:
-                    last_activity = max(latest_session.start_time, latest_session.end_time)
-                else:
-                    last_activity = latest_session.start_time
-                
-                if latest_session.end_time is None:
-                    status = "playing"
-                else:
-                    time_diff = datetime.now() - latest_session.end_time
-                    if time_diff.total_seconds() < 300:
-                        status = "online"
-            
+        for device in device_registry.snapshot():
+            last_activity = device['last_activity']
             devices.append({
-                'player_id': device.player_id,
-                'player_name': device.player_name,
-                'status': status,
+                'player_id': device['player_id'],
+                'player_name': device['player_name'],
+                'status': device['status'],
                 'last_activity': last_activity.isoformat() if last_activity else None
             })
         
@@ -554,13 +1089,7 @@ def get_latest_stats():
     """获取最新统计数据"""
     try:
         today = datetime.now().date()
-        today_sessions = GameSession.select().where(
-            GameSession.start_time >= today,
-            GameSession.duration_seconds.is_null(False)
-        )
-        
-        total_time = sum(session.duration_seconds for session in today_sessions)
-        session_count = today_sessions.count()
+        total_time, session_count = get_usage_totals(today, today)
         
         return {
             'total_time_seconds': total_time,
@@ -583,6 +1112,44 @@ def broadcast_update(update_type, data):
     except Exception as e:
         logger.error(f"广播更新失败: {e}")
 
+def notify_data_changed():
+    """数据已变化：使本进程缓存失效并推送最新快照"""
+    bump_data_version()
+    update_queue.put({'type': 'mqtt_update', 'timestamp': time.time()})
+
+def handle_bus_message(message):
+    """处理写入进程或其他 Web 进程经总线发来的变更通知"""
+    if message.get('type') == 'devices':
+        device_registry.import_states(load_states(message.get('devices', [])))
+    elif message.get('type') == 'changed':
+        for player_id in message.get('reload', []):
+            device_registry.reload_device(player_id)
+        invalidate_analytics_store()
+    else:
+        return
+    notify_data_changed()
+
+def resync_from_db():
+    """可能漏掉了通知，从数据库整体刷新设备状态"""
+    device_registry.load_from_db()
+    invalidate_analytics_store()
+    notify_data_changed()
+
+def start_event_bus_client(path=None):
+    """Web 工作进程订阅写入进程的变更通知"""
+    global event_bus
+    if event_bus is None:
+        event_bus = EventBusClient(path, on_message=handle_bus_message,
+                                   on_resync=resync_from_db)
+        event_bus.start()
+    return event_bus
+
+def publish_change(player_ids):
+    """把本进程内的数据变更通知给其他进程"""
+    if event_bus is not None and not event_bus.publish({'type': 'changed',
+                                                        'reload': list(player_ids)}):
+        logger.warning("变更通知总线未连接，其他进程可能暂时显示旧数据")
+
 @app.route('/api/debug-time', methods=['GET'])
 def debug_time():
     """调试时间显示问题"""
@@ -617,34 +1184,18 @@ def debug_time():
 def trigger_update():
     """触发前端实时更新"""
     try:
-        # 获取最新的设备状态和统计数据
-        from datetime import datetime, timedelta
+        # 由独立进程的 MQTT 客户端触发时，内存注册表需要从数据库刷新
+        device_registry.load_from_db()
+        invalidate_analytics_store()
+        bump_data_version()
         
         # 获取设备状态
-        all_devices = GameSession.select(
-            GameSession.player_id,
-            GameSession.player_name
-        ).distinct()
-        
         devices = []
-        for device in all_devices:
-            latest_session = GameSession.select().where(
-                GameSession.player_id == device.player_id
-            ).order_by(GameSession.start_time.desc()).first()
-            
-            status = "offline"
-            if latest_session:
-                if latest_session.end_time is None:
-                    status = "playing"
-                else:
-                    time_diff = datetime.now() - latest_session.end_time
-                    if time_diff.total_seconds() < 300:
-                        status = "online"
-            
+        for device in device_registry.snapshot():
             devices.append({
-                'player_id': device.player_id,
-                'player_name': device.player_name,
-                'status': status
+                'player_id': device['player_id'],
+                'player_name': device['player_name'],
+                'status': device['status']
             })
         
         # 广播设备状态更新
@@ -652,13 +1203,7 @@ def trigger_update():
         
         # 获取今日统计
         today = datetime.now().date()
-        today_sessions = GameSession.select().where(
-            GameSession.start_time >= today,
-            GameSession.duration_seconds.is_null(False)
-        )
-        
-        today_total_time = sum(session.duration_seconds for session in today_sessions)
-        today_session_count = today_sessions.count()
+        today_total_time, today_session_count = get_usage_totals(today, today)
         
         # 广播统计更新
         broadcast_update('stats_update', {
@@ -675,5 +1220,8 @@ if __name__ == '__main__':
     # 初始化数据库
     from models import init_db
     init_db()
+    device_registry.load_from_db()
+    load_analytics_store()
+    ensure_update_pump()
     
     app.run(debug=True, host='0.0.0.0', port=5001)
\ No newline at end of file
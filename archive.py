@@ -0,0 +1,396 @@
+#!/usr/bin/env python3
+"""
+冷数据归档
+
+把开始时间早于保留期限（按天计，截止到当天零点）的已结束会话移出 game_sessions，
+按月份写入独立的 SQLite 文件（archive/sessions-YYYY-MM.db），热表只保留近期数据。
+
+- 每日汇总表不归档，统计、每日图表、每日汇总等基于汇总表的接口不受影响
+- 每台设备最新的一个会话始终保留在热表中，设备状态不受影响
+- 玩家排行、会话导出、每日汇总重建和删除设备会在需要时读取归档文件
+- 会话列表（/api/sessions）默认只列出热表中的会话，include_archived=1 时合并归档；
+  删除单个会话时热表中找不到的 id 会在归档文件中查找
+
+    python archive.py run               # 按 GAME_USAGE_RETENTION_DAYS（默认 90 天）归档
+    python archive.py run --days 30 --vacuum
+    python archive.py list
+
+归档分两步：先把会话复制到归档文件并提交，再从热表删除已复制的会话，
+中途中断后重新运行即可继续，不会丢失或重复数据。热表的 id 可能被 SQLite 复用，
+归档文件中已有同一 id 的其他会话时不删除该会话并中止归档，需要人工处理。
+适合用 cron 每天运行一次。
+"""
+
+import argparse
+import glob
+import os
+import sqlite3
+from datetime import date, datetime, timedelta
+
+from peewee import fn
+
+import duration_sketch
+
+ARCHIVE_DIR = os.environ.get('GAME_USAGE_ARCHIVE_DIR', 'archive')
+RETENTION_DAYS = int(os.environ.get('GAME_USAGE_RETENTION_DAYS', 90))
+
+_ARCHIVE_SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS game_sessions ('
+    'id INTEGER PRIMARY KEY, '
+    'player_id VARCHAR(100) NOT NULL, '
+    'player_name VARCHAR(100) NOT NULL, '
+    'start_time DATETIME NOT NULL, '
+    'end_time DATETIME, '
+    'duration_seconds INTEGER, '
+    'created_at DATETIME NOT NULL)',
+    'CREATE INDEX IF NOT EXISTS idx_archive_player_start ON game_sessions (player_id, start_time)',
+    'CREATE INDEX IF NOT EXISTS idx_archive_start ON game_sessions (start_time)',
+)
+_COLUMNS = 'id, player_id, player_name, start_time, end_time, duration_seconds, created_at'
+
+
+def _month_start(day):
+    return date(day.year, day.month, 1)
+
+
+def _next_month(month):
+    return date(month.year + month.month // 12, month.month % 12 + 1, 1)
+
+
+def archive_path(month, directory=None):
+    return os.path.join(directory or ARCHIVE_DIR, f'sessions-{month:%Y-%m}.db')
+
+
+def list_archives(directory=None):
+    """所有归档文件，按月份排序：[(月份第一天, 路径)]"""
+    archives = []
+    for path in glob.glob(os.path.join(directory or ARCHIVE_DIR, 'sessions-*.db')):
+        name = os.path.basename(path)[len('sessions-'):-len('.db')]
+        try:
+            month = datetime.strptime(name, '%Y-%m').date()
+        except ValueError:
+            continue
+        archives.append((month, path))
+    return sorted(archives)
+
+
+def archives_for_range(date_from=None, date_to=None, directory=None):
+    """与日期范围（含两端）有交集的归档文件路径"""
+    return [path for month, path in list_archives(directory)
+            if (date_to is None or month <= date_to) and
+            (date_from is None or _next_month(month) > date_from)]
+
+
+def _connect(path, readonly=True):
+    if readonly:
+        return sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+    connection = sqlite3.connect(path)
+    for statement in _ARCHIVE_SCHEMA:
+        connection.execute(statement)
+    return connection
+
+
+def open_archive(path):
+    """以只读方式打开归档文件"""
+    return _connect(path)
+
+
+def _range_condition(date_from, date_to):
+    """start_time 的日期范围条件（含两端）"""
+    conditions, params = [], []
+    if date_from is not None:
+        conditions.append('start_time >= ?')
+        params.append(str(date_from))
+    if date_to is not None:
+        conditions.append('start_time < ?')
+        params.append(str(date_to + timedelta(days=1)))
+    return (' WHERE ' + ' AND '.join(conditions)) if conditions else '', params
+
+
+def _parse_datetime(value):
+    return datetime.fromisoformat(value) if value else None
+
+
+# ---------------------------------------------------------------------------
+# 归档任务
+# ---------------------------------------------------------------------------
+
+def archive_sessions(days=RETENTION_DAYS, directory=None, chunk_size=10000):
+    """把早于保留期限的已结束会话移到按月份划分的归档文件，返回 {月份: 会话数}"""
+    from models import GameSession, db
+
+    directory = directory or ARCHIVE_DIR
+    os.makedirs(directory, exist_ok=True)
+    cutoff = date.today() - timedelta(days=days)
+
+    # 每台设备最新的会话保留在热表中
+    latest = (GameSession
+              .select(GameSession.player_id, fn.MAX(GameSession.start_time).alias('max_start'))
+              .group_by(GameSession.player_id))
+    keep_ids = {session_id for (session_id,) in GameSession
+                .select(GameSession.id)
+                .join(latest, on=((GameSession.player_id == latest.c.player_id) &
+                                  (GameSession.start_time == latest.c.max_start)))
+                .tuples()}
+
+    oldest = GameSession.select(fn.MIN(GameSession.start_time)).where(
+        GameSession.start_time < cutoff).scalar()
+    if oldest is None:
+        return {}
+
+    moved = {}
+    month = _month_start(oldest.date())
+    while month < cutoff:
+        month_end = min(_next_month(month), cutoff)
+        candidates = (GameSession.end_time.is_null(False) &
+                      (GameSession.start_time >= month) &
+                      (GameSession.start_time < month_end))
+        count = 0
+        connection = _connect(archive_path(month, directory), readonly=False)
+        try:
+            last_id = 0
+            while True:
+                rows = list(GameSession
+                            .select(GameSession.id, GameSession.player_id, GameSession.player_name,
+                                    GameSession.start_time, GameSession.end_time,
+                                    GameSession.duration_seconds, GameSession.created_at)
+                            .where(candidates & (GameSession.id > last_id))
+                            .order_by(GameSession.id)
+                            .limit(chunk_size)
+                            .tuples())
+                if not rows:
+                    break
+                last_id = rows[-1][0]
+                rows = [row for row in rows if row[0] not in keep_ids]
+                if not rows:
+                    continue
+
+                # 第一步：写入归档文件并提交（重复运行时已归档的会话会被忽略）
+                archived_rows = [(row[0], row[1], row[2], str(row[3]), str(row[4]), row[5], str(row[6]))
+                                 for row in rows]
+                with connection:
+                    connection.executemany(
+                        f'INSERT OR IGNORE INTO game_sessions ({_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                        archived_rows)
+                # 核对归档文件中的会话与热表一致：id 被复用时归档文件里是另一个会话
+                stored = {row[0]: row for row in connection.execute(
+                    f'SELECT {_COLUMNS} FROM game_sessions WHERE id BETWEEN ? AND ?',
+                    (archived_rows[0][0], archived_rows[-1][0]))}
+                verified = [row[0] for row in archived_rows if stored.get(row[0]) == row]
+                conflicts = [row[0] for row in archived_rows if stored.get(row[0]) != row]
+                # 第二步：只从热表删除已核对的会话
+                if verified:
+                    with db.atomic():
+                        GameSession.delete().where(GameSession.id.in_(verified)).execute()
+                    count += len(verified)
+                if conflicts:
+                    raise RuntimeError(
+                        f'归档文件 {archive_path(month, directory)} 中已有 id 相同的其他会话，'
+                        f'已中止归档，冲突的会话 id: {conflicts[:20]}')
+        finally:
+            connection.close()
+
+        if count:
+            moved[month] = count
+        month = _next_month(month)
+    return moved
+
+
+# ---------------------------------------------------------------------------
+# 查询归档
+# ---------------------------------------------------------------------------
+
+def archived_daily_usage(date_from=None, date_to=None, player_id=None, directory=None):
+    """按 (日期, 设备) 汇总归档中已结束的会话，格式与每日汇总表一致"""
+    where, params = _range_condition(date_from, date_to)
+    where += (' AND ' if where else ' WHERE ') + 'duration_seconds IS NOT NULL'
+    if player_id is not None:
+        where += ' AND player_id = ?'
+        params.append(player_id)
+    rows = []
+    for path in archives_for_range(date_from, date_to, directory):
+        connection = _connect(path)
+        try:
+            duration_sketch.register(connection)
+            for day, player_id, player_name, total, count, last_activity, sketch in connection.execute(
+                    'SELECT DATE(start_time), player_id, MAX(player_name), '
+                    'SUM(duration_seconds), COUNT(*), MAX(end_time), sketch_agg(duration_seconds) '
+                    f'FROM game_sessions{where} GROUP BY DATE(start_time), player_id', params):
+                rows.append((date.fromisoformat(day), player_id, player_name, total, count,
+                             _parse_datetime(last_activity), sketch))
+        finally:
+            connection.close()
+    return rows
+
+
+def archived_player_totals(date_from=None, date_to=None, directory=None):
+    """按设备汇总归档中的会话，字段与 /api/players 的查询一致"""
+    where, params = _range_condition(date_from, date_to)
+    totals = {}
+    for path in archives_for_range(date_from, date_to, directory):
+        connection = _connect(path)
+        try:
+            for player_id, player_name, total, count, last_start, last_end in connection.execute(
+                    'SELECT player_id, player_name, COALESCE(SUM(duration_seconds), 0), '
+                    'COUNT(duration_seconds), MAX(start_time), MAX(end_time) '
+                    f'FROM game_sessions{where} GROUP BY player_id, player_name', params):
+                merge_player_totals(totals, {
+                    'player_id': player_id,
+                    'player_name': player_name,
+                    'total_time_seconds': total,
+                    'session_count': count,
+                    'last_start_time': _parse_datetime(last_start),
+                    'last_end_time': _parse_datetime(last_end)
+                })
+        finally:
+            connection.close()
+    return totals
+
+
+def merge_player_totals(totals, row):
+    """把一行设备统计合并到 {(player_id, player_name): 统计} 中"""
+    key = (row['player_id'], row['player_name'])
+    current = totals.get(key)
+    if current is None:
+        totals[key] = dict(row)
+        return
+    current['total_time_seconds'] += row['total_time_seconds']
+    current['session_count'] += row['session_count']
+    for field in ('last_start_time', 'last_end_time'):
+        if row[field] and (current[field] is None or row[field] > current[field]):
+            current[field] = row[field]
+
+
+def iter_session_chunks(connection, date_from=None, date_to=None, player_id=None, chunk_size=5000):
+    """按开始时间顺序分块读取 game_sessions（热表或归档文件），每块为原始行的列表"""
+    where, params = _range_condition(date_from, date_to)
+    if player_id is not None:
+        where += (' AND ' if where else ' WHERE ') + 'player_id = ?'
+        params.append(player_id)
+    cursor = connection.execute(
+        f'SELECT {_COLUMNS} FROM game_sessions{where} ORDER BY start_time, id', params)
+    try:
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                return
+            yield rows
+    finally:
+        cursor.close()
+
+
+def iter_archived_sessions(date_from=None, date_to=None, player_id=None, chunk_size=5000,
+                           directory=None):
+    """按月份顺序分块读取归档中的会话"""
+    for path in archives_for_range(date_from, date_to, directory):
+        connection = _connect(path)
+        try:
+            yield from iter_session_chunks(connection, date_from, date_to, player_id, chunk_size)
+        finally:
+            connection.close()
+
+
+def archived_sessions_page(cursor_key=None, direction='after', limit=20, player_id=None,
+                           directory=None):
+    """按 (created_at, id) 分页读取归档中的会话，顺序与 /api/sessions 的游标分页一致
+
+    direction 为 after 时返回游标之后（更早创建）的会话，按创建时间倒序；before 时返回
+    游标之前（更晚创建）的会话，按创建时间正序。每个归档文件最多取 limit 行，
+    调用方与热表的结果合并后再截取，返回 [(id, player_id, player_name, 开始, 结束, 时长, 创建时间)]
+    """
+    conditions, params = [], []
+    if player_id is not None:
+        conditions.append('player_id = ?')
+        params.append(player_id)
+    if cursor_key is not None:
+        conditions.append('(created_at, id) < (?, ?)' if direction == 'after'
+                          else '(created_at, id) > (?, ?)')
+        params.extend((str(cursor_key[0]), cursor_key[1]))
+    where = (' WHERE ' + ' AND '.join(conditions)) if conditions else ''
+    order = 'DESC' if direction == 'after' else 'ASC'
+    rows = []
+    for _, path in list_archives(directory):
+        connection = _connect(path)
+        try:
+            for row in connection.execute(
+                    f'SELECT {_COLUMNS} FROM game_sessions{where} '
+                    f'ORDER BY created_at {order}, id {order} LIMIT ?', params + [limit]):
+                rows.append((row[0], row[1], row[2], _parse_datetime(row[3]),
+                             _parse_datetime(row[4]), row[5], _parse_datetime(row[6])))
+        finally:
+            connection.close()
+    return rows
+
+
+def delete_archived_session(session_id, directory=None):
+    """从归档文件删除一个会话，返回 (player_id, 开始时间, 时长)，找不到时返回 None"""
+    for _, path in list_archives(directory):
+        connection = _connect(path, readonly=False)
+        try:
+            with connection:
+                row = connection.execute(
+                    'SELECT player_id, start_time, duration_seconds FROM game_sessions WHERE id = ?',
+                    (session_id,)).fetchone()
+                if row is None:
+                    continue
+                connection.execute('DELETE FROM game_sessions WHERE id = ?', (session_id,))
+        finally:
+            connection.close()
+        return row[0], _parse_datetime(row[1]), row[2]
+    return None
+
+
+def delete_device_from_archives(player_id, directory=None):
+    """从所有归档文件删除设备的会话，返回删除的会话数"""
+    deleted = 0
+    for _, path in list_archives(directory):
+        connection = _connect(path, readonly=False)
+        try:
+            with connection:
+                deleted += connection.execute(
+                    'DELETE FROM game_sessions WHERE player_id = ?', (player_id,)).rowcount
+        finally:
+            connection.close()
+    return deleted
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='会话冷数据归档')
+    parser.add_argument('command', choices=['run', 'list'])
+    parser.add_argument('--days', type=int, default=RETENTION_DAYS, help='热表保留的天数')
+    parser.add_argument('--archive-dir', default=ARCHIVE_DIR, help='归档目录')
+    parser.add_argument('--vacuum', action='store_true', help='归档后执行 VACUUM 回收热表空间')
+    parser.add_argument('--db', help='数据库文件路径')
+    args = parser.parse_args(argv)
+
+    if args.command == 'list':
+        for month, path in list_archives(args.archive_dir):
+            connection = _connect(path)
+            try:
+                count = connection.execute('SELECT COUNT(*) FROM game_sessions').fetchone()[0]
+            finally:
+                connection.close()
+            print(f"{month:%Y-%m}  {count:>10} 个会话  {path}")
+        return
+
+    from models import configure_database, init_db, db
+    if args.db:
+        configure_database(args.db)
+    init_db()
+
+    try:
+        moved = archive_sessions(args.days, args.archive_dir)
+    except RuntimeError as e:
+        print(f"归档失败: {e}")
+        raise SystemExit(1)
+    for month, count in sorted(moved.items()):
+        print(f"{month:%Y-%m}: 归档 {count} 个会话")
+    print(f"共归档 {sum(moved.values())} 个会话")
+
+    if args.vacuum and moved:
+        print("回收空间...")
+        db.execute_sql('VACUUM')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,247 @@
+"""
+ASGI 入口：SSE 连接为协程，不再各自占用一个线程
+
+    uvicorn asgi:app --host 0.0.0.0 --port 5001
+
+- /api/events 由协程直接处理，等待 asyncio 广播通道中的消息，
+  上千个空闲连接只占用少量内存
+- 其他接口原样交给 Flask 应用，在有界线程池中执行（数据库读取不会阻塞事件循环），
+  URL 和 JSON 格式与 WSGI 模式完全一致
+- 与 wsgi.py 一样订阅 MQTT 写入进程（python run.py --role ingest）的变更通知
+
+uvicorn 为可选依赖，只有使用 ASGI 模式时才需要安装（pip install uvicorn）。
+"""
+
+import asyncio
+import io
+import logging
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from models import init_db
+from device_registry import device_registry
+from api import (app as flask_app, broadcaster, ensure_update_pump,
+                 start_event_bus_client, load_analytics_store, HEARTBEAT_MESSAGE)
+
+logger = logging.getLogger(__name__)
+
+# 执行 Flask 请求的线程数，同时也是数据库读取的最大并发数
+WSGI_THREADS = int(os.environ.get('GAME_USAGE_ASGI_THREADS', 16))
+SSE_HEARTBEAT_SECONDS = 10
+
+SSE_HEADERS = [
+    (b'content-type', b'text/event-stream'),
+    (b'cache-control', b'no-cache'),
+    (b'access-control-allow-origin', b'*'),
+    (b'access-control-allow-headers', b'Cache-Control'),
+]
+
+
+class AsyncBroadcastChannel:
+    """事件循环内的一对多广播通道，挂接到线程版 Broadcaster 上
+
+    publish() 可以在任意线程调用，消息通过 call_soon_threadsafe 交给事件循环，
+    每个连接一个有界的 asyncio.Queue，慢客户端只丢弃自己积压的旧消息。
+    """
+
+    def __init__(self, loop, max_queue_size=16):
+        self.loop = loop
+        self.max_queue_size = max_queue_size
+        self._subscribers = set()
+
+    @property
+    def subscriber_count(self):
+        return len(self._subscribers)
+
+    def subscribe(self):
+        subscriber = asyncio.Queue(maxsize=self.max_queue_size)
+        self._subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        self._subscribers.discard(subscriber)
+
+    def publish(self, message):
+        self.loop.call_soon_threadsafe(self._publish, message)
+
+    def _publish(self, message):
+        for subscriber in self._subscribers:
+            if subscriber.full():
+                subscriber.get_nowait()
+            subscriber.put_nowait(message)
+
+
+def _build_environ(scope, body):
+    """按 PEP 3333 从 ASGI scope 构造 WSGI environ"""
+    server_name, server_port = scope.get('server') or ('localhost', 80)
+    client = scope.get('client')
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server_name,
+        'SERVER_PORT': str(server_port),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': client[0] if client else '',
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name == 'CONTENT_TYPE':
+            key = 'CONTENT_TYPE'
+        elif name == 'CONTENT_LENGTH':
+            key = 'CONTENT_LENGTH'
+        else:
+            key = f'HTTP_{name}'
+        environ[key] = f'{environ[key]},{value}' if key in environ else value
+    return environ
+
+
+class GameUsageASGI:
+    """ASGI 应用：SSE 原生异步处理，其余请求交给 Flask"""
+
+    def __init__(self, wsgi_app, threads=WSGI_THREADS):
+        self.wsgi_app = wsgi_app
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='wsgi')
+        self.channel = None
+        self._started = False
+        self._start_lock = asyncio.Lock()
+
+    def startup(self):
+        """初始化数据库、设备状态、推送线程和变更通知订阅（只执行一次）"""
+        if self._started:
+            return
+        self._started = True
+        init_db()
+        device_registry.load_from_db()
+        load_analytics_store()
+        start_event_bus_client()
+        ensure_update_pump()
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self._ensure_started()
+            if scope['path'] == '/api/events' and scope['method'] == 'GET':
+                await self._sse(receive, send)
+            else:
+                await self._wsgi(scope, receive, send)
+
+    async def _ensure_started(self):
+        if self.channel is not None:
+            return
+        async with self._start_lock:
+            if self.channel is None:
+                loop = asyncio.get_running_loop()
+                await loop.run_in_executor(self.executor, self.startup)
+                self.channel = AsyncBroadcastChannel(loop)
+                broadcaster.attach(self.channel)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                try:
+                    await self._ensure_started()
+                except Exception as e:
+                    logger.error(f"启动失败: {e}")
+                    await send({'type': 'lifespan.startup.failed', 'message': str(e)})
+                    return
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if self.channel is not None:
+                    broadcaster.detach(self.channel)
+                self.executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def _sse(self, receive, send):
+        """Server-Sent Events：每个连接只是一个等待广播消息的协程"""
+        subscriber = self.channel.subscribe()
+        try:
+            await send({'type': 'http.response.start', 'status': 200, 'headers': SSE_HEADERS})
+            stream = asyncio.ensure_future(self._stream(subscriber, send))
+            disconnected = asyncio.ensure_future(self._wait_disconnect(receive))
+            await asyncio.wait({stream, disconnected}, return_when=asyncio.FIRST_COMPLETED)
+            for task in (stream, disconnected):
+                task.cancel()
+        finally:
+            self.channel.unsubscribe(subscriber)
+
+    @staticmethod
+    async def _stream(subscriber, send):
+        while True:
+            try:
+                message = await asyncio.wait_for(subscriber.get(), SSE_HEARTBEAT_SECONDS)
+            except asyncio.TimeoutError:
+                message = HEARTBEAT_MESSAGE
+            await send({'type': 'http.response.body', 'body': message, 'more_body': True})
+
+    @staticmethod
+    async def _wait_disconnect(receive):
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+
+    async def _wsgi(self, scope, receive, send):
+        """在线程池中执行 Flask 请求，响应体逐块取出后发送"""
+        chunks = []
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+            chunks.append(message.get('body', b''))
+            if not message.get('more_body'):
+                break
+        environ = _build_environ(scope, b''.join(chunks))
+
+        loop = asyncio.get_running_loop()
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            response['status'] = int(status.split(' ', 1)[0])
+            response['headers'] = [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                                   for name, value in headers]
+            return response.setdefault('written', []).append
+
+        def run():
+            iterable = self.wsgi_app(environ, start_response)
+            return iterable, iter(iterable)
+
+        iterable, iterator = await loop.run_in_executor(self.executor, run)
+        try:
+            started = False
+            while True:
+                chunk = await loop.run_in_executor(self.executor, next, iterator, None)
+                if not started:
+                    # 生成器响应在第一次迭代时才调用 start_response
+                    await send({'type': 'http.response.start',
+                                'status': response['status'],
+                                'headers': response['headers']})
+                    started = True
+                    written = b''.join(response.get('written', []))
+                    if written:
+                        await send({'type': 'http.response.body', 'body': written,
+                                    'more_body': True})
+                if chunk is None:
+                    break
+                if chunk:
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            if hasattr(iterable, 'close'):
+                await loop.run_in_executor(self.executor, iterable.close)
+
+
+app = GameUsageASGI(flask_app)
@@ -0,0 +1,339 @@
+#!/usr/bin/env python3
+"""
+MQTT 写入吞吐量基准测试
+
+直接用构造的消息对象驱动 GameUsageTracker.on_message（或经由进程内的
+模拟 Broker），按配置回放工作负载，输出 JSON 格式的结果便于跨版本对比。
+标准输出只包含结果 JSON，数据库初始化等状态信息输出到标准错误，可以直接重定向到文件。
+
+--verify-replay 在压测结束后把检查点移到日志中部并重放，检查重放得到的会话与
+写入流程得到的完全相同（多分片时各分片提交顺序与日志顺序不同）。
+
+示例：
+    python benchmark_ingest.py --devices 200 --events 50000
+    python benchmark_ingest.py --mode broker --rate 2000 --duplicate-ratio 0.05
+    python benchmark_ingest.py --shards 4 --journal /tmp/bench-journal --verify-replay
+"""
+
+import argparse
+import contextlib
+import json
+import logging
+import os
+import queue
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+from event_codec import encode_event
+
+
+class FakeMessage:
+    """模拟 paho 的 MQTTMessage，只提供 on_message 用到的属性"""
+
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = payload
+
+
+class LocalBroker:
+    """进程内的 Broker 替身：单独的网络线程按顺序分发消息，与 paho 的 loop 线程一致"""
+
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._subscribers = []
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+
+    def subscribe(self, on_message):
+        self._subscribers.append(on_message)
+
+    def publish(self, topic, payload):
+        self._queue.put(FakeMessage(topic, payload))
+
+    def close(self):
+        """分发完已发布的消息后停止"""
+        self._queue.put(None)
+        self._thread.join()
+
+    def _loop(self):
+        while True:
+            msg = self._queue.get()
+            if msg is None:
+                break
+            for on_message in self._subscribers:
+                on_message(None, None, msg)
+
+
+def generate_workload(devices, events, end_ratio, duplicate_ratio, out_of_order_ratio, seed,
+                      encoding='json'):
+    """生成事件序列
+
+    每台设备按开始/结束交替产生事件，end_ratio 控制设备在游戏中时
+    下一条事件是结束事件的概率；然后按比例插入重复事件、交换相邻事件。
+    """
+    rng = random.Random(seed)
+    playing = [False] * devices
+    workload = []
+
+    while len(workload) < events:
+        index = rng.randrange(devices)
+        if playing[index] and rng.random() < end_ratio:
+            event = 'game_end'
+            playing[index] = False
+        else:
+            event = 'game_start'
+            playing[index] = True
+
+        payload = encode_event(event, f'bench-{index:05d}', f'压测设备{index:05d}', encoding)
+        workload.append(payload)
+
+        if rng.random() < duplicate_ratio and len(workload) < events:
+            workload.append(payload)
+
+    for i in range(len(workload) - 1):
+        if rng.random() < out_of_order_ratio:
+            workload[i], workload[i + 1] = workload[i + 1], workload[i]
+
+    return workload[:events]
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def database_size(path):
+    """数据库文件及 WAL 文件的总大小"""
+    total = 0
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(path + suffix):
+            total += os.path.getsize(path + suffix)
+    return total
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except Exception:
+        return None
+
+
+def verify_replay(journal_dir):
+    """从日志中部的检查点重放，比较重放前后的会话"""
+    from models import GameSession
+    from event_journal import EventJournal, replay
+
+    def sessions():
+        return sorted(GameSession.select(GameSession.player_id, GameSession.start_time,
+                                         GameSession.end_time, GameSession.duration_seconds).tuples())
+
+    journal = EventJournal(journal_dir)
+    positions = [position for position, _ in journal.scan()]
+    if len(positions) < 2:
+        return None
+    expected = sessions()
+    middle = len(positions) // 2
+    journal.write_checkpoint(positions[middle - 1])
+    replay(journal)
+    actual = sessions()
+    return {
+        'replayed_events': len(positions) - middle,
+        'sessions': len(expected),
+        'sessions_after_replay': len(actual),
+        'matches': actual == expected
+    }
+
+
+def run_benchmark(args):
+    from models import configure_database, init_db, db, GameSession
+    from mqtt_client import GameUsageTracker
+    from event_journal import EventJournal
+
+    # mqtt_client 导入时会配置 INFO 级别日志，逐条日志会严重影响结果
+    logging.getLogger().setLevel(args.log_level)
+
+    configure_database(args.db)
+    init_db()
+
+    latencies = []
+    latencies_lock = threading.Lock()
+
+    class BenchmarkTracker(GameUsageTracker):
+        """记录每个事件从收到到提交的耗时"""
+
+        def enqueue_event(self, event):
+            event['bench_received_at'] = time.perf_counter()
+            super().enqueue_event(event)
+
+        def on_batch_committed(self, events):
+            committed_at = time.perf_counter()
+            with latencies_lock:
+                latencies.extend(committed_at - e['bench_received_at'] for e in events)
+
+    # 实时更新信号直接丢弃，避免走 HTTP 备用通道
+    tracker = BenchmarkTracker(update_queue=queue.Queue(maxsize=1),
+                               batch_size=args.batch_size,
+                               batch_wait=args.batch_wait_ms / 1000,
+                               shards=args.shards,
+                               shard_mode=args.shard_mode,
+                               journal=EventJournal(args.journal) if args.journal else None)
+    tracker.trigger_realtime_update = lambda: None
+
+    workload = generate_workload(args.devices, args.events, args.end_ratio,
+                                 args.duplicate_ratio, args.out_of_order_ratio, args.seed,
+                                 args.encoding)
+    topic = tracker.msgpack_topic if args.encoding == 'msgpack' else tracker.topic
+
+    sessions_before = GameSession.select().count()
+    size_before = database_size(args.db)
+
+    broker = None
+    if args.mode == 'broker':
+        broker = LocalBroker()
+        broker.subscribe(tracker.on_message)
+        deliver = lambda payload: broker.publish(topic, payload)
+    else:
+        deliver = lambda payload: tracker.on_message(None, None, FakeMessage(topic, payload))
+
+    on_message_times = []
+    interval = 1.0 / args.rate if args.rate else 0
+
+    tracker.start_writer()
+    started = time.perf_counter()
+    for i, payload in enumerate(workload):
+        if interval:
+            delay = started + i * interval - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        t0 = time.perf_counter()
+        deliver(payload)
+        on_message_times.append(time.perf_counter() - t0)
+
+    if broker:
+        broker.close()
+    tracker.stop_writer()
+    elapsed = time.perf_counter() - started
+
+    db.connect(reuse_if_open=True)
+    sessions_after = GameSession.select().count()
+    db.execute_sql('PRAGMA wal_checkpoint(TRUNCATE)')
+    size_after = database_size(args.db)
+
+    latencies.sort()
+    on_message_times.sort()
+    sessions_created = sessions_after - sessions_before
+
+    replay_check = verify_replay(args.journal) if args.verify_replay else None
+
+    return {
+        'benchmark': 'mqtt_ingest',
+        'git_revision': git_revision(),
+        'timestamp': datetime.now().isoformat(),
+        'python': sys.version.split()[0],
+        'config': {
+            'mode': args.mode,
+            'encoding': args.encoding,
+            'devices': args.devices,
+            'events': args.events,
+            'rate': args.rate,
+            'end_ratio': args.end_ratio,
+            'duplicate_ratio': args.duplicate_ratio,
+            'out_of_order_ratio': args.out_of_order_ratio,
+            'batch_size': args.batch_size,
+            'batch_wait_ms': args.batch_wait_ms,
+            'shards': args.shards,
+            'shard_mode': args.shard_mode,
+            'journal': bool(args.journal),
+            'seed': args.seed
+        },
+        'results': {
+            'elapsed_seconds': round(elapsed, 4),
+            'events_processed': len(latencies),
+            'events_per_second': round(len(latencies) / elapsed, 1) if elapsed else None,
+            'latency_ms': {
+                'p50': round(percentile(latencies, 0.50) * 1000, 3) if latencies else None,
+                'p99': round(percentile(latencies, 0.99) * 1000, 3) if latencies else None,
+                'max': round(latencies[-1] * 1000, 3) if latencies else None
+            },
+            'on_message_us': {
+                'p50': round(percentile(on_message_times, 0.50) * 1e6, 2) if on_message_times else None,
+                'p99': round(percentile(on_message_times, 0.99) * 1e6, 2) if on_message_times else None
+            },
+            'sessions_created': sessions_created,
+            'db_size_before_bytes': size_before,
+            'db_size_after_bytes': size_after,
+            'db_growth_bytes': size_after - size_before,
+            'db_growth_per_session_bytes': round((size_after - size_before) / sessions_created, 1)
+            if sessions_created else None,
+            'replay_check': replay_check
+        }
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='MQTT 写入吞吐量基准测试')
+    parser.add_argument('--mode', choices=['direct', 'broker'], default='direct',
+                        help='direct: 直接调用 on_message；broker: 经由进程内模拟 Broker')
+    parser.add_argument('--encoding', choices=['json', 'msgpack'], default='json',
+                        help='消息编码（msgpack 发送到并行主题）')
+    parser.add_argument('--devices', type=int, default=100, help='设备数量')
+    parser.add_argument('--events', type=int, default=20000, help='事件总数')
+    parser.add_argument('--rate', type=float, default=0, help='每秒发送事件数，0 表示不限速')
+    parser.add_argument('--end-ratio', type=float, default=0.5,
+                        help='设备游戏中时下一条为结束事件的概率')
+    parser.add_argument('--duplicate-ratio', type=float, default=0.0, help='重复事件比例')
+    parser.add_argument('--out-of-order-ratio', type=float, default=0.0, help='乱序事件比例')
+    parser.add_argument('--batch-size', type=int, default=200, help='每批最多事件数')
+    parser.add_argument('--batch-wait-ms', type=float, default=50, help='凑批最长等待毫秒数')
+    parser.add_argument('--shards', type=int, default=1, help='写入分片数')
+    parser.add_argument('--shard-mode', choices=['thread', 'process'], default='thread',
+                        help='分片使用线程还是独立进程')
+    parser.add_argument('--journal', help='启用事件日志并写入该目录')
+    parser.add_argument('--verify-replay', action='store_true',
+                        help='结束后从日志中部重放并比较会话（需要 --journal，会改写其检查点）')
+    parser.add_argument('--seed', type=int, default=42, help='随机种子')
+    parser.add_argument('--db', help='数据库文件路径，默认使用临时文件')
+    parser.add_argument('--output', help='结果 JSON 输出文件，默认打印到标准输出')
+    parser.add_argument('--log-level', default='ERROR', help='日志级别')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.verify_replay and not args.journal:
+        raise SystemExit('--verify-replay 需要同时指定 --journal')
+
+    temp_dir = None
+    if not args.db:
+        temp_dir = tempfile.mkdtemp(prefix='ingest-bench-')
+        args.db = os.path.join(temp_dir, 'bench.db')
+
+    try:
+        # 运行期间的状态输出（数据库迁移等）转到标准错误，保持标准输出为合法 JSON
+        with contextlib.redirect_stdout(sys.stderr):
+            result = run_benchmark(args)
+    finally:
+        if temp_dir:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+    output = json.dumps(result, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output + '\n')
+    print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""
+SSE 消息广播
+
+每个订阅者（一个 /api/events 连接）拥有独立的有界队列，
+发布方把同一份已序列化的字节推送给所有订阅者。
+
+其他形式的订阅渠道（如 ASGI 模式下的 asyncio 广播通道）可以通过 attach()
+挂接，渠道需要提供线程安全的 publish(message) 和 subscriber_count。
+"""
+
+import queue
+import threading
+
+
+class Broadcaster:
+    """一对多消息广播，慢客户端只会丢弃自己积压的旧消息"""
+
+    def __init__(self, max_queue_size=16):
+        self.max_queue_size = max_queue_size
+        self._lock = threading.Lock()
+        self._subscribers = set()
+        self._sinks = []
+
+    def attach(self, sink):
+        """挂接额外的订阅渠道"""
+        with self._lock:
+            self._sinks.append(sink)
+
+    def detach(self, sink):
+        with self._lock:
+            if sink in self._sinks:
+                self._sinks.remove(sink)
+
+    def subscribe(self):
+        """注册订阅者，返回其专属队列"""
+        subscriber = queue.Queue(maxsize=self.max_queue_size)
+        with self._lock:
+            self._subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        """注销订阅者"""
+        with self._lock:
+            self._subscribers.discard(subscriber)
+
+    @property
+    def subscriber_count(self):
+        return len(self._subscribers) + sum(sink.subscriber_count for sink in self._sinks)
+
+    def publish(self, message):
+        """向所有订阅者推送消息，不会因为某个客户端阻塞"""
+        with self._lock:
+            subscribers = list(self._subscribers)
+            sinks = list(self._sinks)
+
+        for sink in sinks:
+            sink.publish(message)
+
+        for subscriber in subscribers:
+            try:
+                subscriber.put_nowait(message)
+            except queue.Full:
+                # 队列已满说明客户端消费太慢，丢弃最旧的一条再放入
+                try:
+                    subscriber.get_nowait()
+                except queue.Empty:
+                    pass
+                try:
+                    subscriber.put_nowait(message)
+                except queue.Full:
+                    pass
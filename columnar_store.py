@@ -0,0 +1,312 @@
+"""
+列式会话快照（可选的统计引擎）
+
+GAME_USAGE_ANALYTICS_ENGINE=columnar 时，Web 进程在内存中保存所有会话（包括归档）的
+列式副本：id、设备编号（字典编码）、开始/结束时间（int64 微秒，与 analytics 相同的本地时间
+表示，保留小数秒）和时长（int32），每个会话约 32 字节。统计、每日图表和每日汇总接口用
+向量化的过滤和归约直接回答，不再读取数据库。
+
+快照在启动时加载一次。之后数据版本变化时（写入线程提交或收到总线通知）增量同步：
+追加 id 大于已加载最大 id 的会话，并重新检查快照中仍未结束的会话。
+删除会话或设备后整体重新加载；其他进程（包括重放和导入工具）删除或改写会话时
+会增加数据库中的会话改写次数（models.session_generation），同步时发现变化也整体重新加载。
+"""
+
+import os
+import threading
+from datetime import datetime, timedelta
+
+import numpy as np
+
+import archive
+from analytics import MAX_SESSION_LOOKBACK, SessionArrays, to_epoch
+from response_cache import data_version
+
+ANALYTICS_ENGINE = os.environ.get('GAME_USAGE_ANALYTICS_ENGINE', 'sql')
+
+MICROS = 1000000
+DAY_MICROS = 86400 * MICROS
+
+
+def _epoch_micros(column):
+    """SQL 表达式：日期时间列的微秒数（整秒部分与 analytics 的秒数一致）"""
+    # 日期时间以 'YYYY-MM-DD HH:MM:SS.ffffff' 保存，没有小数部分时补 0
+    return (f"CAST(strftime('%s', {column}) AS INTEGER) * {MICROS} + "
+            f"CAST(substr({column} || '000000', 21, 6) AS INTEGER)")
+
+
+_SELECT_COLUMNS = (
+    f"id, player_id, player_name, {_epoch_micros('start_time')}, "
+    f"{_epoch_micros('end_time')}, duration_seconds"
+)
+
+# 未结束的会话
+OPEN = -1
+
+_COLUMNS = (('id', np.int64), ('device', np.int32), ('start', np.int64),
+            ('end', np.int64), ('duration', np.int32))
+
+
+def _day_epoch(day):
+    return to_epoch(day) // 86400
+
+
+def _day_of(micros):
+    return micros // DAY_MICROS
+
+
+class ColumnarSessionStore:
+    """会话的列式内存副本，线程安全"""
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._clear()
+
+    def _clear(self):
+        self._size = 0
+        self._columns = {name: np.empty(0, dtype=dtype) for name, dtype in _COLUMNS}
+        self._device_index = {}
+        self._devices = []
+        self._max_id = 0
+        self._version = None
+        self._generation = None
+        self._loaded = False
+
+    # ------------------------------------------------------------------
+    # 加载与同步
+    # ------------------------------------------------------------------
+
+    def _column(self, name):
+        return self._columns[name][:self._size]
+
+    def _device_code(self, player_id, player_name):
+        code = self._device_index.get(player_id)
+        if code is None:
+            code = self._device_index[player_id] = len(self._devices)
+            self._devices.append([player_id, player_name])
+        else:
+            self._devices[code][1] = player_name
+        return code
+
+    def _append(self, rows):
+        """追加 (id, player_id, player_name, 开始, 结束, 时长) 行，rows 按 id 升序"""
+        if not rows:
+            return
+        count = len(rows)
+        needed = self._size + count
+        capacity = len(self._columns['id'])
+        if needed > capacity:
+            capacity = max(needed, capacity * 2, 1024)
+            for name, column in self._columns.items():
+                grown = np.empty(capacity, dtype=column.dtype)
+                grown[:self._size] = column[:self._size]
+                self._columns[name] = grown
+
+        end = self._size + count
+        self._columns['id'][self._size:end] = np.fromiter(
+            (row[0] for row in rows), dtype=np.int64, count=count)
+        self._columns['device'][self._size:end] = np.fromiter(
+            (self._device_code(row[1], row[2]) for row in rows), dtype=np.int32, count=count)
+        self._columns['start'][self._size:end] = np.fromiter(
+            (row[3] for row in rows), dtype=np.int64, count=count)
+        self._columns['end'][self._size:end] = np.fromiter(
+            (OPEN if row[4] is None else row[4] for row in rows), dtype=np.int64, count=count)
+        self._columns['duration'][self._size:end] = np.fromiter(
+            (OPEN if row[5] is None else row[5] for row in rows), dtype=np.int32, count=count)
+        self._size = end
+        self._max_id = max(self._max_id, rows[-1][0])
+
+    def load(self):
+        """从归档和会话表加载全部会话"""
+        from models import db, session_generation
+
+        with self._lock:
+            version = data_version.value
+            generation = session_generation()
+            # 先读会话表再读归档：归档任务同时运行时会话可能被读到两次，但不会漏掉
+            rows = db.execute_sql(f'SELECT {_SELECT_COLUMNS} FROM game_sessions').fetchall()
+            for _, path in archive.list_archives():
+                connection = archive.open_archive(path)
+                try:
+                    rows += connection.execute(
+                        f'SELECT {_SELECT_COLUMNS} FROM game_sessions').fetchall()
+                finally:
+                    connection.close()
+            rows.sort(key=lambda row: row[0])
+            rows = [row for i, row in enumerate(rows) if i == 0 or row[0] != rows[i - 1][0]]
+            self._clear()
+            self._append(rows)
+            self._version = version
+            self._generation = generation
+            self._loaded = True
+
+    def invalidate(self):
+        """会话被删除后调用，下次访问时整体重新加载"""
+        with self._lock:
+            self._loaded = False
+
+    def sync(self):
+        """数据版本变化时增量同步"""
+        from models import db, session_generation
+
+        with self._lock:
+            if not self._loaded:
+                self.load()
+                return
+            version = data_version.value
+            if version == self._version:
+                return
+            # 会话被删除或改写过：增量追加会重复统计重新插入的会话
+            if session_generation() != self._generation:
+                self.load()
+                return
+
+            # 快照中未结束的会话可能已经结束
+            open_rows = np.flatnonzero(self._column('end') == OPEN)
+            if len(open_rows):
+                ids = self._column('id')[open_rows]
+                placeholders = ', '.join('?' * len(ids))
+                closed = db.execute_sql(
+                    f"SELECT id, {_epoch_micros('end_time')}, duration_seconds "
+                    f"FROM game_sessions WHERE end_time IS NOT NULL AND id IN ({placeholders})",
+                    [int(session_id) for session_id in ids]).fetchall()
+                if closed:
+                    rows = np.searchsorted(self._column('id'), [row[0] for row in closed])
+                    self._columns['end'][rows] = [row[1] for row in closed]
+                    self._columns['duration'][rows] = [row[2] for row in closed]
+
+            self._append(db.execute_sql(
+                f'SELECT {_SELECT_COLUMNS} FROM game_sessions WHERE id > ? ORDER BY id',
+                (self._max_id,)).fetchall())
+            self._version = version
+
+    def memory_bytes(self):
+        return sum(column.nbytes for column in self._columns.values())
+
+    def __len__(self):
+        return self._size
+
+    # ------------------------------------------------------------------
+    # 查询（调用前自动同步）
+    # ------------------------------------------------------------------
+
+    def _started_between(self, start_date, end_date):
+        """开始日期在 [start_date, end_date] 内的行"""
+        day = _day_of(self._column('start'))
+        return (day >= _day_epoch(start_date)) & (day <= _day_epoch(end_date))
+
+    def usage_totals(self, start_date, end_date):
+        """日期范围内（含两端）已结束会话的总时长和会话数"""
+        with self._lock:
+            self.sync()
+            mask = self._started_between(start_date, end_date) & (self._column('end') != OPEN)
+            durations = self._column('duration')[mask]
+            return int(durations.sum(dtype=np.int64)), int(len(durations))
+
+    def active_player_count(self, day):
+        """当天开始过会话的设备数"""
+        with self._lock:
+            self.sync()
+            return int(len(np.unique(self._column('device')[self._started_between(day, day)])))
+
+    def daily_totals(self, start_date, end_date):
+        """每天已结束会话的总时长和会话数：{date: {'total_seconds', 'session_count'}}"""
+        with self._lock:
+            self.sync()
+            first_day = _day_epoch(start_date)
+            days = _day_epoch(end_date) - first_day + 1
+            mask = self._started_between(start_date, end_date) & (self._column('end') != OPEN)
+            offsets = _day_of(self._column('start')[mask]) - first_day
+            totals = np.bincount(offsets, weights=self._column('duration')[mask], minlength=days)
+            counts = np.bincount(offsets, minlength=days)
+        return {
+            start_date + timedelta(days=int(offset)): {
+                'total_seconds': int(totals[offset]),
+                'session_count': int(counts[offset])
+            }
+            for offset in np.flatnonzero(counts)
+        }
+
+    def daily_device_summary(self, start_date, end_date):
+        """按 (日期, 设备) 汇总，格式与 /api/daily-summary 的中间结果一致：
+        {date: {player_id: {'player_name', 'sessions', 'total_time', 'completed_sessions',
+        'active_sessions', 'last_activity'}}}
+        """
+        with self._lock:
+            self.sync()
+            first_day = _day_epoch(start_date)
+            mask = self._started_between(start_date, end_date)
+            start = self._column('start')[mask]
+            end = self._column('end')[mask]
+            duration = self._column('duration')[mask]
+            device = self._column('device')[mask]
+            devices = [tuple(entry) for entry in self._devices]
+
+        device_count = len(devices)
+        keys = (_day_of(start) - first_day) * device_count + device
+        closed = end != OPEN
+        size = ((_day_epoch(end_date) - first_day + 1) * device_count) or 1
+        total_time = np.bincount(keys[closed], weights=duration[closed], minlength=size)
+        completed = np.bincount(keys[closed], minlength=size)
+        active = np.bincount(keys[~closed], minlength=size)
+        # 最近活动：已结束的会话取结束时间，未结束的取开始时间
+        last_activity = np.full(size, np.iinfo(np.int64).min, dtype=np.int64)
+        np.maximum.at(last_activity, keys, np.where(closed, end, start))
+
+        summary = {}
+        epoch = datetime(1970, 1, 1)
+        for key in np.flatnonzero(completed + active):
+            day_offset, code = divmod(int(key), device_count)
+            player_id, player_name = devices[code]
+            summary.setdefault(start_date + timedelta(days=day_offset), {})[player_id] = {
+                'player_name': player_name,
+                'sessions': int(completed[key] + active[key]),
+                'total_time': int(total_time[key]),
+                'completed_sessions': int(completed[key]),
+                'active_sessions': int(active[key]),
+                'last_activity': epoch + timedelta(microseconds=int(last_activity[key]))
+            }
+        return summary
+
+    def overlapping(self, range_start, range_end, player_id=None, now=None):
+        """与 [range_start, range_end) 有重叠的会话（analytics.SessionArrays）
+
+        与 SQL 查询相同，只包括开始时间不早于范围起点前 MAX_SESSION_LOOKBACK 的会话。
+        """
+        now_second = to_epoch(now or datetime.now())
+        earliest = range_start - MAX_SESSION_LOOKBACK
+        earliest_micros = to_epoch(earliest) * MICROS + earliest.microsecond
+        with self._lock:
+            self.sync()
+            recent = self._column('start') >= earliest_micros
+            # SessionArrays 使用整秒
+            start = self._column('start') // MICROS
+            end = np.where(self._column('end') == OPEN, now_second, self._column('end') // MICROS)
+            mask = recent & (start < to_epoch(range_end)) & (end > to_epoch(range_start))
+            if player_id is not None:
+                code = self._device_index.get(player_id)
+                mask &= self._column('device') == (code if code is not None else -1)
+            device = self._column('device')[mask]
+            start = start[mask]
+            end = end[mask]
+            devices = [tuple(entry) for entry in self._devices]
+
+        # 只保留出现的设备，重新编号
+        used, codes = np.unique(device, return_inverse=True)
+        return SessionArrays([devices[code] for code in used],
+                             codes.astype(np.int32), start, end)
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    """启用列式引擎时返回全局快照，否则返回 None"""
+    global _store
+    if ANALYTICS_ENGINE != 'columnar':
+        return None
+    with _store_lock:
+        if _store is None:
+            _store = ColumnarSessionStore()
+        return _store
@@ -0,0 +1,201 @@
+"""
+设备状态内存注册表
+
+由 MQTT 事件驱动维护每台设备的最新状态，启动时从数据库加载一次，
+之后设备状态接口和实时推送直接读取内存，无需查询数据库。
+正在游戏和在线的设备数随状态变化增量维护，counts() 不需要遍历所有设备。
+"""
+
+import heapq
+import threading
+from datetime import datetime, timedelta
+from peewee import fn
+from models import GameSession
+
+# 结束后多少秒内仍视为在线
+ONLINE_WINDOW_SECONDS = 300
+
+
+class DeviceRegistry:
+    """线程安全的设备状态注册表"""
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._devices = {}
+        self._loaded = False
+        self._reset_counts()
+
+    def _reset_counts(self):
+        self._playing = 0
+        # 当前状态为已结束的设备，以及它们的 (结束时间, player_id) 最小堆；
+        # 结束时间超出在线窗口的条目在读取或写入时清理
+        self._recent_ended = set()
+        self._recent_ends = []
+
+    def _set_state(self, player_id, state):
+        """更新设备状态并维护计数（调用方持有锁）"""
+        old = self._devices.get(player_id)
+        if old is not None and old['end_time'] is None:
+            self._playing -= 1
+        self._recent_ended.discard(player_id)
+        if state is None:
+            self._devices.pop(player_id, None)
+            return
+        self._devices[player_id] = state
+        if state['end_time'] is None:
+            self._playing += 1
+        else:
+            self._recent_ended.add(player_id)
+            heapq.heappush(self._recent_ends, (state['end_time'], player_id))
+            self._prune(datetime.now())
+
+    def _prune(self, now):
+        """移出结束时间已超出在线窗口的设备（调用方持有锁）"""
+        cutoff = now - timedelta(seconds=ONLINE_WINDOW_SECONDS)
+        while self._recent_ends and self._recent_ends[0][0] <= cutoff:
+            end_time, player_id = heapq.heappop(self._recent_ends)
+            state = self._devices.get(player_id)
+            # 设备此后又有新的状态时，集合由更新的条目负责
+            if state is not None and state['end_time'] == end_time:
+                self._recent_ended.discard(player_id)
+
+    def load_from_db(self):
+        """从数据库加载每台设备最新的会话（单次查询）"""
+        latest = (GameSession
+                  .select(GameSession.player_id,
+                          fn.MAX(GameSession.start_time).alias('max_start'))
+                  .group_by(GameSession.player_id)
+                  .alias('latest'))
+        query = (GameSession
+                 .select()
+                 .join(latest, on=(
+                     (GameSession.player_id == latest.c.player_id) &
+                     (GameSession.start_time == latest.c.max_start)))
+                 .order_by(GameSession.id))
+
+        states = [self._state_from_session(session) for session in query]
+
+        with self._lock:
+            self._devices = {}
+            self._reset_counts()
+            for state in states:
+                self._set_state(state['player_id'], state)
+            self._loaded = True
+
+    def ensure_loaded(self):
+        """首次访问时加载"""
+        if not self._loaded:
+            self.load_from_db()
+
+    def reload_device(self, player_id):
+        """从数据库重新加载单台设备的状态"""
+        session = GameSession.select().where(
+            GameSession.player_id == player_id
+        ).order_by(GameSession.start_time.desc(), GameSession.id.desc()).first()
+
+        with self._lock:
+            self._set_state(player_id, self._state_from_session(session) if session else None)
+
+    def session_started(self, player_id, player_name, session_id, start_time):
+        """记录设备开始游戏"""
+        with self._lock:
+            self._set_state(player_id, {
+                'player_id': player_id,
+                'player_name': player_name,
+                'current_session_id': session_id,
+                'start_time': start_time,
+                'end_time': None
+            })
+
+    def session_ended(self, player_id, player_name, session_id, start_time, end_time):
+        """记录设备结束游戏"""
+        with self._lock:
+            state = self._devices.get(player_id)
+            # 只有结束的是最新会话时才更新状态
+            if state and state['start_time'] and state['start_time'] > start_time:
+                return
+            self._set_state(player_id, {
+                'player_id': player_id,
+                'player_name': player_name,
+                'current_session_id': None,
+                'start_time': start_time,
+                'end_time': end_time
+            })
+
+    def export_states(self, player_ids):
+        """导出指定设备的内部状态（用于跨进程同步）"""
+        with self._lock:
+            return [dict(self._devices[player_id])
+                    for player_id in player_ids if player_id in self._devices]
+
+    def import_states(self, states):
+        """导入其他进程导出的设备状态"""
+        with self._lock:
+            for state in states:
+                current = self._devices.get(state['player_id'])
+                if current and current['start_time'] and current['start_time'] > state['start_time']:
+                    continue
+                self._set_state(state['player_id'], dict(state))
+
+    def remove_device(self, player_id):
+        """移除设备"""
+        with self._lock:
+            self._set_state(player_id, None)
+
+    def counts(self, now=None):
+        """正在游戏的设备数和在线设备数（含正在游戏），与 snapshot() 的状态一致"""
+        self.ensure_loaded()
+        with self._lock:
+            self._prune(now or datetime.now())
+            return {
+                'playing': self._playing,
+                'online': self._playing + len(self._recent_ended),
+                'total': len(self._devices)
+            }
+
+    def snapshot(self, now=None):
+        """获取所有设备的当前状态列表"""
+        self.ensure_loaded()
+        if now is None:
+            now = datetime.now()
+
+        with self._lock:
+            states = list(self._devices.values())
+
+        devices = []
+        for state in states:
+            start_time = state['start_time']
+            end_time = state['end_time']
+
+            if end_time is None:
+                status = 'playing'
+                last_activity = start_time
+            else:
+                last_activity = max(start_time, end_time)
+                if (now - end_time).total_seconds() < ONLINE_WINDOW_SECONDS:
+                    status = 'online'
+                else:
+                    status = 'offline'
+
+            devices.append({
+                'player_id': state['player_id'],
+                'player_name': state['player_name'],
+                'status': status,
+                'current_session_id': state['current_session_id'],
+                'last_activity': last_activity
+            })
+        return devices
+
+    @staticmethod
+    def _state_from_session(session):
+        return {
+            'player_id': session.player_id,
+            'player_name': session.player_name,
+            'current_session_id': session.id if session.end_time is None else None,
+            'start_time': session.start_time,
+            'end_time': session.end_time
+        }
+
+
+# 全局注册表实例，MQTT 客户端与 API 共享
+device_registry = DeviceRegistry()
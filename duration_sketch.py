@@ -0,0 +1,204 @@
+"""
+会话时长分布草图（DDSketch 风格的对数分桶直方图）
+
+时长 x 秒（x >= 1）落入编号为 ceil(log_gamma(x)) 的桶，gamma = (1 + a) / (1 - a)，
+用桶的代表值估计分位数时相对误差不超过 a（RELATIVE_ACCURACY）。0 秒的会话单独计数。
+两个草图按桶编号相加即可合并，结果与直接统计全部会话完全相同，
+因此每日汇总表为每台设备每天保存一个草图，任意日期范围的分布都由每日草图合并得到。
+
+草图序列化为紧凑的字节串（版本号、0 秒计数、桶数，以及按编号排序的
+（编号差, 计数）varint 对），一台设备一天通常只有几十字节。
+register() 把合并函数和聚合函数注册到 SQLite 连接，供每日汇总的 upsert 和重建使用。
+"""
+
+import math
+
+RELATIVE_ACCURACY = 0.01
+GAMMA = (1 + RELATIVE_ACCURACY) / (1 - RELATIVE_ACCURACY)
+_LOG_GAMMA = math.log(GAMMA)
+
+_FORMAT_VERSION = 1
+
+# 默认的直方图边界（秒），最后一个区间不设上限
+HISTOGRAM_EDGES = (0, 30, 60, 120, 300, 600, 1200, 1800, 3600, 7200)
+
+PERCENTILES = (('p50', 0.5), ('p90', 0.9), ('p99', 0.99))
+
+
+def _write_varint(out, value):
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _read_varint(data, position):
+    value = 0
+    shift = 0
+    while True:
+        byte = data[position]
+        position += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, position
+        shift += 7
+
+
+class DurationSketch:
+    """可合并的会话时长分布"""
+
+    __slots__ = ('bins', 'zero_count', 'count')
+
+    def __init__(self):
+        self.bins = {}
+        self.zero_count = 0
+        self.count = 0
+
+    @staticmethod
+    def bin_index(seconds):
+        return math.ceil(math.log(seconds) / _LOG_GAMMA)
+
+    @staticmethod
+    def bin_value(index):
+        """桶的代表值：与桶内任意值的相对误差不超过 RELATIVE_ACCURACY"""
+        return 2 * GAMMA ** index / (GAMMA + 1)
+
+    def add(self, seconds, count=1):
+        """记录时长为 seconds 的会话（小于 1 秒按 0 秒计）"""
+        if seconds is None:
+            return
+        if seconds < 1:
+            self.zero_count += count
+        else:
+            index = self.bin_index(seconds)
+            self.bins[index] = self.bins.get(index, 0) + count
+        self.count += count
+
+    def merge(self, other):
+        """把另一个草图合并到当前草图"""
+        for index, count in other.bins.items():
+            self.bins[index] = self.bins.get(index, 0) + count
+        self.zero_count += other.zero_count
+        self.count += other.count
+        return self
+
+    def quantile(self, q):
+        """估计分位数 q（0 到 1），没有数据时返回 None"""
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        seen = self.zero_count
+        if seen > rank:
+            return 0.0
+        for index in sorted(self.bins):
+            seen += self.bins[index]
+            if seen > rank:
+                return self.bin_value(index)
+        return self.bin_value(max(self.bins))
+
+    def percentiles(self):
+        """p50 / p90 / p99（秒，保留一位小数）"""
+        result = {}
+        for name, q in PERCENTILES:
+            value = self.quantile(q)
+            result[name] = round(value, 1) if value is not None else None
+        return result
+
+    def histogram(self, edges=HISTOGRAM_EDGES):
+        """按 edges 分区间统计会话数（按桶代表值归入区间）"""
+        counts = [0] * len(edges)
+        counts[0] += self.zero_count
+        for index, count in self.bins.items():
+            value = self.bin_value(index)
+            slot = 0
+            while slot + 1 < len(edges) and value >= edges[slot + 1]:
+                slot += 1
+            counts[slot] += count
+        return [
+            {
+                'min_seconds': edges[slot],
+                'max_seconds': edges[slot + 1] if slot + 1 < len(edges) else None,
+                'count': counts[slot]
+            }
+            for slot in range(len(edges))
+        ]
+
+    def to_bytes(self):
+        out = bytearray([_FORMAT_VERSION])
+        _write_varint(out, self.zero_count)
+        _write_varint(out, len(self.bins))
+        previous = 0
+        for index in sorted(self.bins):
+            _write_varint(out, index - previous)
+            _write_varint(out, self.bins[index])
+            previous = index
+        return bytes(out)
+
+    @classmethod
+    def from_bytes(cls, data):
+        sketch = cls()
+        if not data:
+            return sketch
+        if data[0] != _FORMAT_VERSION:
+            raise ValueError(f'不支持的草图版本: {data[0]}')
+        sketch.zero_count, position = _read_varint(data, 1)
+        sketch.count = sketch.zero_count
+        bin_count, position = _read_varint(data, position)
+        index = 0
+        for _ in range(bin_count):
+            delta, position = _read_varint(data, position)
+            count, position = _read_varint(data, position)
+            index += delta
+            sketch.bins[index] = count
+            sketch.count += count
+        return sketch
+
+    @classmethod
+    def of(cls, durations):
+        sketch = cls()
+        for seconds in durations:
+            sketch.add(seconds)
+        return sketch
+
+
+def merge_blobs(left, right):
+    """合并两个序列化的草图（任一为 NULL 时返回另一个）"""
+    if not left:
+        return right
+    if not right:
+        return left
+    return DurationSketch.from_bytes(left).merge(DurationSketch.from_bytes(right)).to_bytes()
+
+
+class SketchAggregate:
+    """SQLite 聚合函数 sketch_agg(duration_seconds)：由时长构造草图"""
+
+    def __init__(self):
+        self.sketch = DurationSketch()
+
+    def step(self, seconds):
+        self.sketch.add(seconds)
+
+    def finalize(self):
+        return self.sketch.to_bytes() if self.sketch.count else None
+
+
+class SketchUnion:
+    """SQLite 聚合函数 sketch_union(duration_sketch)：合并多个草图"""
+
+    def __init__(self):
+        self.sketch = DurationSketch()
+
+    def step(self, data):
+        if data:
+            self.sketch.merge(DurationSketch.from_bytes(data))
+
+    def finalize(self):
+        return self.sketch.to_bytes() if self.sketch.count else None
+
+
+def register(connection):
+    """在 sqlite3 连接上注册 sketch_merge、sketch_agg 和 sketch_union"""
+    connection.create_function('sketch_merge', 2, merge_blobs, deterministic=True)
+    connection.create_aggregate('sketch_agg', 1, SketchAggregate)
+    connection.create_aggregate('sketch_union', 1, SketchUnion)
@@ -0,0 +1,161 @@
+"""
+MQTT 事件载荷解码
+
+按声明的事件结构校验消息，校验失败时返回拒绝原因而不是抛出异常，
+调用方只需计数即可，不会走异常日志路径。
+
+支持两种编码：
+- JSON（主题 game）：安装了 orjson 时使用 orjson，否则使用标准库 json
+- MessagePack（主题 game/msgpack）：供带宽受限的设备使用，需要安装 msgpack
+"""
+
+import json
+from datetime import datetime
+
+try:
+    import orjson
+    _json_loads = orjson.loads
+    JSON_BACKEND = 'orjson'
+except ImportError:
+    _json_loads = json.loads
+    JSON_BACKEND = 'json'
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+FORMAT_JSON = 'json'
+FORMAT_MSGPACK = 'msgpack'
+
+# 事件结构：消息字段 -> 内部字段
+EVENT_FIELDS = (
+    ('event', 'event'),
+    ('playerId', 'player_id'),
+    ('playerName', 'player_name'),
+)
+# heartbeat 只更新设备的存活状态，不写入数据库
+EVENT_TYPES = frozenset(('game_start', 'game_end', 'heartbeat'))
+
+# 单条消息与单个字段的长度上限，超出直接拒绝
+MAX_PAYLOAD_BYTES = 4096
+MAX_FIELD_LENGTH = 255
+
+# 拒绝原因
+REJECT_TOO_LARGE = 'too_large'
+REJECT_MALFORMED = 'malformed'
+REJECT_NOT_OBJECT = 'not_object'
+REJECT_MISSING_FIELD = 'missing_field'
+REJECT_BAD_FIELD = 'bad_field'
+REJECT_UNKNOWN_EVENT = 'unknown_event'
+REJECT_UNSUPPORTED_FORMAT = 'unsupported_format'
+REJECT_BAD_TIMESTAMP = 'bad_timestamp'
+
+
+def msgpack_available():
+    return msgpack is not None
+
+
+def _loads_json(payload):
+    try:
+        return _json_loads(payload), None
+    except (ValueError, TypeError):
+        # orjson.JSONDecodeError、json.JSONDecodeError、UnicodeDecodeError 都是 ValueError
+        return None, REJECT_MALFORMED
+
+
+def _loads_msgpack(payload):
+    if msgpack is None:
+        return None, REJECT_UNSUPPORTED_FORMAT
+    try:
+        return msgpack.unpackb(payload, raw=False,
+                               max_str_len=MAX_FIELD_LENGTH * 4,
+                               max_bin_len=0, max_array_len=16,
+                               max_map_len=16, max_ext_len=0), None
+    except Exception:
+        # msgpack 的各种解包错误没有统一的基类
+        return None, REJECT_MALFORMED
+
+
+_LOADERS = {
+    FORMAT_JSON: _loads_json,
+    FORMAT_MSGPACK: _loads_msgpack,
+}
+
+
+def _field_value(value):
+    """字段值规范化为非空字符串，设备 ID 允许整数"""
+    if isinstance(value, str):
+        return value if 0 < len(value) <= MAX_FIELD_LENGTH else None
+    if isinstance(value, int) and not isinstance(value, bool):
+        return str(value)
+    return None
+
+
+def parse_timestamp(value):
+    """事件时间转换为本地时间（与 datetime.now() 一致的无时区时间）
+
+    支持 ISO 8601 字符串和 Unix 时间戳（秒，数值），无法解析时返回 None。
+    """
+    try:
+        if isinstance(value, str):
+            timestamp = datetime.fromisoformat(value.replace('Z', '+00:00'))
+            if timestamp.tzinfo is not None:
+                timestamp = timestamp.astimezone().replace(tzinfo=None)
+            return timestamp
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            return datetime.fromtimestamp(value)
+    except (ValueError, OverflowError, OSError):
+        pass
+    return None
+
+
+def decode_event(payload, fmt=FORMAT_JSON, with_timestamp=False):
+    """解码并校验一条事件消息
+
+    返回 (event, None) 或 (None, 拒绝原因)，event 为
+    {'event': ..., 'player_id': ..., 'player_name': ...}；
+    with_timestamp 为 True 时消息必须带 timestamp 字段，解析后放入 event['timestamp']
+    """
+    if len(payload) > MAX_PAYLOAD_BYTES:
+        return None, REJECT_TOO_LARGE
+
+    loader = _LOADERS.get(fmt)
+    if loader is None:
+        return None, REJECT_UNSUPPORTED_FORMAT
+
+    message, reason = loader(payload)
+    if reason:
+        return None, reason
+    if not isinstance(message, dict):
+        return None, REJECT_NOT_OBJECT
+
+    event = {}
+    for name, key in EVENT_FIELDS:
+        value = message.get(name)
+        if value is None or value == '':
+            return None, REJECT_MISSING_FIELD
+        value = _field_value(value)
+        if value is None:
+            return None, REJECT_BAD_FIELD
+        event[key] = value
+
+    if event['event'] not in EVENT_TYPES:
+        return None, REJECT_UNKNOWN_EVENT
+
+    if with_timestamp:
+        timestamp = parse_timestamp(message.get('timestamp'))
+        if timestamp is None:
+            return None, REJECT_BAD_TIMESTAMP
+        event['timestamp'] = timestamp
+    return event, None
+
+
+def encode_event(event, player_id, player_name, fmt=FORMAT_JSON):
+    """编码一条事件消息（用于测试工具和设备端参考实现）"""
+    message = {'event': event, 'playerId': player_id, 'playerName': player_name}
+    if fmt == FORMAT_MSGPACK:
+        if msgpack is None:
+            raise RuntimeError('未安装 msgpack，无法使用 MessagePack 编码')
+        return msgpack.packb(message, use_bin_type=True)
+    return json.dumps(message, ensure_ascii=False).encode('utf-8')
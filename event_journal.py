@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+"""
+原始事件日志（只追加）
+
+MQTT 客户端在处理之前把每个通过校验的事件追加到日志缓冲区，写入线程每批事件
+在写数据库之前调用一次 sync()，批量编码、写入并 fsync。处理时出错的事件
+仍保留在日志中，修复配对逻辑后可以从日志重放重建会话表和每日汇总。
+
+文件布局（默认目录 journal/，可用 GAME_USAGE_JOURNAL_DIR 指定，设为空字符串则关闭）：
+- events-<首条记录序号>.log：日志段，超过 segment_bytes 后切换到新段；
+  每次打开日志都会开始一个新段，不会在可能被截断的旧段后追加
+- checkpoint.json：检查点，此前的所有事件都已提交到数据库
+
+记录格式：<长度 u32><CRC32 u32><事件类型 u8><时间戳 微秒 i64><ID 长度 u16><名称长度 u16><ID><名称>[<结束时间 微秒 i64>]
+
+时间戳是事件进入写入流程的时间。心跳超时（timeout）记录的会话结束时间是更早的
+最后收到消息的时间，单独附加在记录末尾；旧版本写入的 timeout 记录没有该字段，
+时间戳即结束时间。
+
+重放：
+    python event_journal.py replay                 # 从检查点重放
+    python event_journal.py replay --full          # 从日志开头重放
+    python event_journal.py checkpoint             # 查看检查点
+"""
+
+import argparse
+import glob
+import json
+import logging
+import os
+import struct
+import threading
+import zlib
+from datetime import datetime, timedelta
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_JOURNAL_DIR = os.environ.get('GAME_USAGE_JOURNAL_DIR', 'journal')
+DEFAULT_SEGMENT_BYTES = 64 * 1024 * 1024
+
+_RECORD_HEADER = struct.Struct('<II')
+_EVENT_HEADER = struct.Struct('<BqHH')
+_END_TIME = struct.Struct('<q')
+# timeout 为心跳超时时由 MQTT 客户端生成的事件，heartbeat 不写入日志
+_EVENT_CODES = {'game_start': 0, 'game_end': 1, 'timeout': 2}
+_EVENT_NAMES = {code: name for name, code in _EVENT_CODES.items()}
+_EPOCH = datetime(1970, 1, 1)
+
+
+def _to_micros(value):
+    delta = value - _EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+SEGMENT_PATTERN = 'events-*.log'
+CHECKPOINT_FILE = 'checkpoint.json'
+
+
+def _segment_name(first_seq):
+    return f'events-{first_seq:016d}.log'
+
+
+def _segment_first_seq(name):
+    return int(os.path.basename(name)[len('events-'):-len('.log')])
+
+
+def encode_record(event, names=None):
+    """事件编码为一条日志记录
+
+    names: 可选的 {(player_id, player_name): 编码后的字段} 缓存，批量编码时复用
+    """
+    key = (event['player_id'], event['player_name'])
+    encoded = names.get(key) if names is not None else None
+    if encoded is None:
+        player_id = key[0].encode('utf-8')
+        player_name = key[1].encode('utf-8')
+        encoded = (len(player_id), len(player_name), player_id + player_name)
+        if names is not None:
+            names[key] = encoded
+    # timeout 事件的 timestamp 是会话结束时间，ingested_at 是生成该事件的时间
+    ingested_at = event.get('ingested_at', event['timestamp'])
+    body = _EVENT_HEADER.pack(_EVENT_CODES[event['event']], _to_micros(ingested_at),
+                              encoded[0], encoded[1]) + encoded[2]
+    if event['event'] == 'timeout':
+        body += _END_TIME.pack(_to_micros(event['timestamp']))
+    return _RECORD_HEADER.pack(len(body), zlib.crc32(body)) + body
+
+
+def decode_record(body):
+    code, micros, id_length, name_length = _EVENT_HEADER.unpack_from(body)
+    offset = _EVENT_HEADER.size
+    player_id = body[offset:offset + id_length].decode('utf-8')
+    offset += id_length
+    player_name = body[offset:offset + name_length].decode('utf-8')
+    offset += name_length
+    ingested_at = _EPOCH + timedelta(microseconds=micros)
+    timestamp = ingested_at
+    if len(body) >= offset + _END_TIME.size:
+        timestamp = _EPOCH + timedelta(microseconds=_END_TIME.unpack_from(body, offset)[0])
+    return {
+        'event': _EVENT_NAMES[code],
+        'player_id': player_id,
+        'player_name': player_name,
+        'timestamp': timestamp,
+        'ingested_at': ingested_at
+    }
+
+
+def _read_segment(path, offset=0):
+    """逐条读取日志段，返回 (结束偏移, 事件)；遇到截断或校验失败的记录时停止"""
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        while True:
+            header = f.read(_RECORD_HEADER.size)
+            if len(header) < _RECORD_HEADER.size:
+                if header:
+                    logger.warning(f"日志段 {path} 末尾记录不完整，已忽略")
+                return
+            length, crc = _RECORD_HEADER.unpack(header)
+            body = f.read(length)
+            if len(body) < length or zlib.crc32(body) != crc:
+                logger.warning(f"日志段 {path} 偏移 {offset} 处记录损坏，忽略该段剩余内容")
+                return
+            offset += _RECORD_HEADER.size + length
+            yield offset, decode_record(body)
+
+
+class EventJournal:
+    """分段的只追加事件日志，线程安全
+
+    append() 只把事件放入内存缓冲区并分配序号；sync() 批量编码、写入并 fsync，
+    写入线程在每批事件写数据库之前调用一次。
+    """
+
+    def __init__(self, directory=None, segment_bytes=DEFAULT_SEGMENT_BYTES):
+        self.directory = directory or DEFAULT_JOURNAL_DIR
+        self.segment_bytes = segment_bytes
+        os.makedirs(self.directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        self._pending = []
+        # 设备 ID 和名称的编码缓存，只在 sync() 中使用
+        self._names = {}
+        self._file = None
+        self._segment = None
+        self._offset = 0
+        self._next_seq = self._recover_next_seq()
+        self._synced_seq = self._next_seq
+        self._synced_position = None
+
+    def _segments(self):
+        return sorted(glob.glob(os.path.join(self.directory, SEGMENT_PATTERN)))
+
+    def _recover_next_seq(self):
+        """根据最后一个日志段中的有效记录数确定下一条记录的序号"""
+        segments = self._segments()
+        if not segments:
+            return 0
+        last = segments[-1]
+        count = sum(1 for _ in _read_segment(last))
+        return _segment_first_seq(last) + count
+
+    def _open_segment(self, first_seq):
+        if self._file is not None:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
+        # 同名文件只可能是没有有效记录的段（如写入首条记录时崩溃），可以直接覆盖
+        self._segment = _segment_name(first_seq)
+        self._file = open(os.path.join(self.directory, self._segment), 'wb')
+        self._offset = 0
+
+    def append(self, event):
+        """追加一个事件（只写入内存缓冲区），返回其序号"""
+        with self._lock:
+            self._pending.append(event)
+            seq = self._next_seq
+            self._next_seq += 1
+        return seq
+
+    def sync(self):
+        """把缓冲区中的事件写入日志并落盘（每批事件调用一次）"""
+        with self._sync_lock:
+            with self._lock:
+                pending, self._pending = self._pending, []
+            if not pending:
+                return
+
+            if len(self._names) > 100000:
+                self._names.clear()
+            seq = self._synced_seq
+            records = []
+            size = 0
+            for event in pending:
+                if self._file is None or self._offset + size >= self.segment_bytes:
+                    if records:
+                        self._file.write(b''.join(records))
+                        self._offset += size
+                        records, size = [], 0
+                    self._open_segment(seq)
+                record = encode_record(event, self._names)
+                records.append(record)
+                size += len(record)
+                seq += 1
+
+            self._file.write(b''.join(records))
+            self._offset += size
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._synced_seq = seq
+            self._synced_position = {'segment': self._segment, 'offset': self._offset, 'seq': seq}
+
+    def synced_position(self):
+        """已落盘的最后一条记录之后的位置"""
+        return self._synced_position
+
+    def close(self):
+        self.sync()
+        with self._sync_lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def write_checkpoint(self, position):
+        """记录检查点：position 之前的事件都已提交到数据库"""
+        path = os.path.join(self.directory, CHECKPOINT_FILE)
+        temp_path = path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(dict(position, written_at=datetime.now().isoformat()), f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+
+    def read_checkpoint(self):
+        path = os.path.join(self.directory, CHECKPOINT_FILE)
+        if not os.path.exists(path):
+            return None
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+
+    def scan(self, position=None):
+        """从指定位置（默认日志开头）开始按顺序读取，返回 (该记录之后的位置, 事件)"""
+        for path in self._segments():
+            name = os.path.basename(path)
+            offset = 0
+            if position:
+                if name < position['segment']:
+                    continue
+                if name == position['segment']:
+                    offset = position['offset']
+            for end, event in _read_segment(path, offset):
+                yield {'segment': name, 'offset': end}, event
+
+    def read(self, position=None):
+        """从指定位置（默认日志开头）开始按顺序读取事件"""
+        for _, event in self.scan(position):
+            yield event
+
+
+def open_default_journal():
+    """按环境变量打开默认日志，GAME_USAGE_JOURNAL_DIR 为空字符串时返回 None"""
+    if not DEFAULT_JOURNAL_DIR:
+        return None
+    return EventJournal(DEFAULT_JOURNAL_DIR)
+
+
+def replay(journal, full=False, chunk_size=50000):
+    """从日志重放，重建会话表和每日汇总
+
+    重放起点之后的事件产生的会话（开始时间不早于这些事件中最早进入写入流程的时间）
+    先被删除，被这些事件结束的会话恢复为未结束，然后按导入规则重新处理起点之后的所有事件。
+    日志顺序不一定是时间顺序，因此先完整读一遍取最早的时间，而不是用第一条记录的时间；
+    心跳超时记录的结束时间早于其进入写入流程的时间，也不能作为起点，否则会删除检查点之前
+    已提交、不会被重放的会话。
+    起点之前的会话（包括启用日志之前的历史数据）保持不变。
+    """
+    from peewee import fn
+    from models import GameSession, db, rebuild_daily_usage, bump_session_generation
+    from import_events import EventImporter
+
+    position = None if full else journal.read_checkpoint()
+    since = min((event['ingested_at'] for event in journal.read(position)), default=None)
+    if since is None:
+        print("检查点之后没有事件，无需重放")
+        return None
+
+    with db.atomic():
+        reopened_from = GameSession.select(fn.MIN(GameSession.start_time)).where(
+            GameSession.end_time >= since).scalar()
+        deleted = GameSession.delete().where(GameSession.start_time >= since).execute()
+        reopened = GameSession.update(end_time=None, duration_seconds=None).where(
+            GameSession.end_time >= since).execute()
+        # 运行中的 Web 进程的列式快照据此整体重新加载
+        bump_session_generation()
+    print(f"从 {since} 开始重放：删除 {deleted} 个会话，恢复 {reopened} 个未结束的会话")
+
+    importer = EventImporter(chunk_size=chunk_size)
+    importer.seed_open_sessions()
+    for event in journal.read(position):
+        importer.feed(event)
+    importer.finish()
+
+    rebuild_from = since.date()
+    if reopened_from is not None:
+        rebuild_from = min(rebuild_from, reopened_from.date())
+    rebuild_daily_usage(rebuild_from)
+    return importer.stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='事件日志工具')
+    parser.add_argument('command', choices=['replay', 'checkpoint'])
+    parser.add_argument('--full', action='store_true', help='从日志开头重放，而不是从检查点')
+    parser.add_argument('--journal-dir', default=DEFAULT_JOURNAL_DIR, help='日志目录')
+    parser.add_argument('--db', help='数据库文件路径')
+    args = parser.parse_args(argv)
+
+    journal = EventJournal(args.journal_dir)
+    if args.command == 'checkpoint':
+        print(json.dumps(journal.read_checkpoint(), ensure_ascii=False, indent=2))
+        return
+
+    from models import configure_database, init_db
+    if args.db:
+        configure_database(args.db)
+    init_db()
+
+    stats = replay(journal, full=args.full)
+    if stats:
+        print(f"重放完成：{stats['events']} 个事件，新增 {stats['sessions_inserted']} 个会话，"
+              f"结束 {stats['sessions_closed']} 个已有会话")
+        print("重放期间应停止 MQTT 写入进程；如果 Web 服务正在运行，请调用 POST /api/trigger-update 刷新")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+"""
+历史事件批量导入
+
+迁移场地或 MQTT Broker 故障恢复时，把 JSONL 格式的原始事件直接导入数据库，
+无需通过 MQTT 逐条重放。每行一个事件：
+
+    {"event": "game_start", "playerId": "...", "playerName": "...", "timestamp": "2024-05-01T10:00:00"}
+
+timestamp 为 ISO 8601 字符串或 Unix 时间戳（秒）。事件按文件顺序处理，配对规则与
+MQTT 写入一致：开始时若有未结束的会话先在该时间结束它；结束时没有未结束的会话则忽略；
+heartbeat 事件被忽略。
+
+每台设备在内存中只保留一个未结束的会话，已完成的会话按块批量写入，内存占用与
+事件总数无关。导入完成后重建受影响日期范围内的每日汇总。
+
+示例：
+    python import_events.py events.jsonl
+    python import_events.py --defer-indexes --chunk-size 100000 2024-*.jsonl
+    zcat events.jsonl.gz | python import_events.py -
+
+导入期间应停止 MQTT 写入进程；如果 Web 服务在运行，导入后调用
+POST /api/trigger-update 刷新设备状态。
+"""
+
+import argparse
+import sys
+import time
+
+from event_codec import decode_event
+from models import (GameSession, db, init_db, configure_database, rebuild_daily_usage,
+                    bump_session_generation, CLOSE_SESSION_SQL, INSERT_SESSION_SQL)
+
+
+def drop_secondary_indexes(table='game_sessions'):
+    """删除表上的二级索引，返回用于重建的 SQL"""
+    rows = db.execute_sql(
+        "SELECT name, sql FROM sqlite_master "
+        "WHERE type = 'index' AND tbl_name = ? AND sql IS NOT NULL",
+        (table,)
+    ).fetchall()
+    for name, _ in rows:
+        db.execute_sql(f'DROP INDEX "{name}"')
+    return [sql for _, sql in rows]
+
+
+def restore_indexes(statements):
+    for sql in statements:
+        db.execute_sql(sql)
+
+
+class EventImporter:
+    """按设备配对事件，已完成的会话按块写入数据库"""
+
+    def __init__(self, chunk_size=50000):
+        self.chunk_size = chunk_size
+        # player_id -> 未结束的会话：{'id', 'player_name', 'start_time'}，id 为 None 表示尚未写入
+        self.open_sessions = {}
+        self.pending_inserts = []
+        self.pending_closes = []
+        self.date_from = None
+        self.date_to = None
+        self.stats = {
+            'events': 0,
+            'rejected': {},
+            'sessions_inserted': 0,
+            'sessions_closed': 0,
+            'auto_closed': 0,
+            'unmatched_end': 0
+        }
+
+    def seed_open_sessions(self):
+        """从数据库载入每台设备未结束的会话，导入的结束事件可以结束它们"""
+        query = (GameSession
+                 .select(GameSession.id, GameSession.player_id,
+                         GameSession.player_name, GameSession.start_time)
+                 .where(GameSession.end_time.is_null())
+                 .order_by(GameSession.start_time)
+                 .tuples())
+        for session_id, player_id, player_name, start_time in query:
+            self.open_sessions[player_id] = {
+                'id': session_id,
+                'player_name': player_name,
+                'start_time': start_time
+            }
+        return len(self.open_sessions)
+
+    def feed_line(self, line):
+        if not line.strip():
+            return
+        event, reason = decode_event(line, with_timestamp=True)
+        if reason:
+            self.stats['rejected'][reason] = self.stats['rejected'].get(reason, 0) + 1
+            return
+        self.feed(event)
+
+    def feed(self, event):
+        """处理一个事件（配对规则与 GameUsageTracker 相同）"""
+        self.stats['events'] += 1
+        player_id = event['player_id']
+        timestamp = event['timestamp']
+        session = self.open_sessions.get(player_id)
+
+        if event['event'] == 'game_start':
+            if session is not None:
+                self.stats['auto_closed'] += 1
+                self._close(player_id, session, timestamp)
+            self.open_sessions[player_id] = {
+                'id': None,
+                'player_name': event['player_name'],
+                'start_time': timestamp
+            }
+        elif event['event'] == 'heartbeat':
+            return
+        elif event['event'] == 'timeout':
+            # 日志中的心跳超时：在最后收到消息的时间结束此前开始的会话
+            if session is not None and session['start_time'] <= timestamp:
+                self._close(player_id, session, timestamp)
+                del self.open_sessions[player_id]
+        elif session is not None:
+            self._close(player_id, session, timestamp)
+            del self.open_sessions[player_id]
+        else:
+            self.stats['unmatched_end'] += 1
+
+        if len(self.pending_inserts) + len(self.pending_closes) >= self.chunk_size:
+            self.flush()
+
+    def _close(self, player_id, session, end_time):
+        start_time = session['start_time']
+        duration = int((end_time - start_time).total_seconds())
+        if session['id'] is None:
+            self.pending_inserts.append((player_id, session['player_name'], start_time,
+                                         end_time, duration, start_time))
+        else:
+            self.pending_closes.append((end_time, duration, session['id']))
+
+        day = start_time.date()
+        if self.date_from is None or day < self.date_from:
+            self.date_from = day
+        if self.date_to is None or day > self.date_to:
+            self.date_to = day
+
+    def flush(self):
+        """在一个事务中写入当前块"""
+        if not self.pending_inserts and not self.pending_closes:
+            return
+        with db.atomic():
+            cursor = db.cursor()
+            if self.pending_inserts:
+                cursor.executemany(INSERT_SESSION_SQL, self.pending_inserts)
+            for params in self.pending_closes:
+                cursor.execute(CLOSE_SESSION_SQL, params)
+                self.stats['sessions_closed'] += cursor.rowcount
+        self.stats['sessions_inserted'] += len(self.pending_inserts)
+        self.pending_inserts = []
+        self.pending_closes = []
+
+    def finish(self):
+        """写入剩余的会话，导入结束时仍未结束的新会话作为进行中的会话写入"""
+        for player_id, session in self.open_sessions.items():
+            if session['id'] is None:
+                start_time = session['start_time']
+                self.pending_inserts.append((player_id, session['player_name'], start_time,
+                                             None, None, start_time))
+        self.flush()
+
+
+def iter_lines(paths):
+    for path in paths:
+        if path == '-':
+            yield from sys.stdin.buffer
+        else:
+            with open(path, 'rb') as f:
+                yield from f
+
+
+def run_import(paths, chunk_size=50000, defer_indexes=False, progress_every=1000000):
+    importer = EventImporter(chunk_size=chunk_size)
+    seeded = importer.seed_open_sessions()
+    print(f"数据库中未结束的会话: {seeded}")
+
+    index_statements = drop_secondary_indexes() if defer_indexes else []
+    if index_statements:
+        print(f"已暂时删除 {len(index_statements)} 个索引")
+
+    started = time.perf_counter()
+    try:
+        next_report = progress_every
+        for line in iter_lines(paths):
+            importer.feed_line(line)
+            if importer.stats['events'] >= next_report:
+                elapsed = time.perf_counter() - started
+                print(f"已处理 {importer.stats['events']} 条事件（{importer.stats['events'] / elapsed:.0f} 条/秒）")
+                next_report += progress_every
+        importer.finish()
+    finally:
+        if index_statements:
+            print("重建索引...")
+            restore_indexes(index_statements)
+
+    # 大量改写会话表后让运行中的 Web 进程整体重新加载列式快照，而不是逐个增量同步
+    bump_session_generation()
+    if importer.date_from is not None:
+        print(f"重建每日汇总 {importer.date_from} ~ {importer.date_to}...")
+        rebuild_daily_usage(importer.date_from, importer.date_to)
+
+    importer.stats['elapsed_seconds'] = round(time.perf_counter() - started, 2)
+    return importer.stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='从 JSONL 文件批量导入历史事件')
+    parser.add_argument('paths', nargs='+', help='事件文件，- 表示标准输入')
+    parser.add_argument('--chunk-size', type=int, default=50000, help='每个事务写入的会话数')
+    parser.add_argument('--defer-indexes', action='store_true',
+                        help='导入期间删除会话表的二级索引，完成后重建（适合大量导入）')
+    parser.add_argument('--db', help='数据库文件路径，默认使用 GAME_USAGE_DB 或 game_usage.db')
+    args = parser.parse_args(argv)
+
+    if args.db:
+        configure_database(args.db)
+    init_db()
+
+    stats = run_import(args.paths, chunk_size=args.chunk_size, defer_indexes=args.defer_indexes)
+
+    print(f"导入完成，用时 {stats['elapsed_seconds']} 秒")
+    print(f"  事件: {stats['events']}")
+    print(f"  新增会话: {stats['sessions_inserted']}")
+    print(f"  结束已有会话: {stats['sessions_closed']}")
+    print(f"  自动结束（重复开始）: {stats['auto_closed']}")
+    print(f"  无匹配的结束事件: {stats['unmatched_end']}")
+    if stats['rejected']:
+        rejected = ', '.join(f'{reason}={count}' for reason, count in sorted(stats['rejected'].items()))
+        print(f"  拒绝的行: {rejected}")
+    print("如果 Web 服务正在运行，请调用 POST /api/trigger-update 刷新设备状态")
+
+
+if __name__ == "__main__":
+    main()
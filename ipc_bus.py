@@ -0,0 +1,308 @@
+"""
+本机进程间变更通知总线（Unix Socket）
+
+多进程部署时，MQTT 写入进程运行 EventBusServer，每个 Web 工作进程运行
+EventBusClient 订阅变更通知。消息为一行一条的 JSON，服务端为每条消息分配
+递增序号；客户端发现序号不连续、服务端重启或重新连接时调用 on_resync，
+由调用方从数据库整体刷新状态。
+
+客户端也可以发布消息（如删除接口的变更），服务端编号后转发给所有订阅者，
+并交给服务端自己的 on_message 处理。
+"""
+
+import json
+import logging
+import os
+import queue
+import socket
+import threading
+import time
+import uuid
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SOCKET_PATH = os.environ.get('GAME_USAGE_BUS_SOCKET', 'game_usage_bus.sock')
+
+# 设备状态中需要按日期时间传输的字段
+_STATE_DATETIME_FIELDS = ('start_time', 'end_time')
+
+
+def dump_states(states):
+    """设备状态转换为可 JSON 序列化的形式"""
+    result = []
+    for state in states:
+        state = dict(state)
+        for field in _STATE_DATETIME_FIELDS:
+            if state.get(field) is not None:
+                state[field] = state[field].isoformat()
+        result.append(state)
+    return result
+
+
+def load_states(states):
+    """dump_states 的逆操作"""
+    result = []
+    for state in states:
+        state = dict(state)
+        for field in _STATE_DATETIME_FIELDS:
+            if state.get(field) is not None:
+                state[field] = datetime.fromisoformat(state[field])
+        result.append(state)
+    return result
+
+
+def _encode(message):
+    return (json.dumps(message, ensure_ascii=False, separators=(',', ':')) + '\n').encode('utf-8')
+
+
+class _Subscriber:
+    """服务端上的一个客户端连接：独立的发送队列和发送线程，慢客户端不影响其他客户端"""
+
+    def __init__(self, server, conn, max_pending):
+        self.server = server
+        self.conn = conn
+        self.pending = queue.Queue(maxsize=max_pending)
+        self.closed = False
+
+    def start(self):
+        threading.Thread(target=self._send_loop, daemon=True).start()
+        threading.Thread(target=self._recv_loop, daemon=True).start()
+
+    def send(self, data):
+        """放入发送队列，队列已满时返回 False"""
+        try:
+            self.pending.put_nowait(data)
+            return True
+        except queue.Full:
+            return False
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.server._remove(self)
+        try:
+            self.conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.conn.close()
+        # 唤醒发送线程
+        try:
+            self.pending.put_nowait(None)
+        except queue.Full:
+            pass
+
+    def _send_loop(self):
+        while not self.closed:
+            data = self.pending.get()
+            if data is None:
+                break
+            try:
+                self.conn.sendall(data)
+            except OSError:
+                self.close()
+
+    def _recv_loop(self):
+        try:
+            with self.conn.makefile('rb') as stream:
+                for line in stream:
+                    try:
+                        message = json.loads(line)
+                    except ValueError:
+                        logger.warning("忽略无法解析的变更通知")
+                        continue
+                    self.server.publish(message)
+        except OSError:
+            pass
+        finally:
+            self.close()
+
+
+class EventBusServer:
+    """变更通知服务端，运行在 MQTT 写入进程中"""
+
+    def __init__(self, path=None, on_message=None, max_pending=1024):
+        self.path = path or DEFAULT_SOCKET_PATH
+        self.on_message = on_message
+        self.max_pending = max_pending
+        self.boot = uuid.uuid4().hex[:8]
+        self._lock = threading.Lock()
+        self._subscribers = set()
+        self._seq = 0
+        self._sock = None
+
+    def start(self):
+        """绑定 Socket 并开始接受订阅"""
+        if os.path.exists(self.path):
+            # 上次异常退出遗留的 Socket 文件
+            os.unlink(self.path)
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.bind(self.path)
+        os.chmod(self.path, 0o660)
+        self._sock.listen(64)
+        threading.Thread(target=self._accept_loop, daemon=True).start()
+        logger.info(f"变更通知总线已启动: {self.path}")
+
+    def close(self):
+        if self._sock:
+            self._sock.close()
+            self._sock = None
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for subscriber in subscribers:
+            subscriber.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    @property
+    def subscriber_count(self):
+        return len(self._subscribers)
+
+    def publish(self, message):
+        """为消息分配序号并发送给所有订阅者"""
+        with self._lock:
+            self._seq += 1
+            message = dict(message, seq=self._seq)
+            data = _encode(message)
+            # 在锁内入队，保证各订阅者收到的序号有序
+            dropped = [subscriber for subscriber in self._subscribers
+                       if not subscriber.send(data)]
+
+        for subscriber in dropped:
+            # 积压过多时断开，客户端重连后会整体刷新
+            logger.warning("变更通知订阅者积压过多，断开连接")
+            subscriber.close()
+
+        if self.on_message:
+            try:
+                self.on_message(message)
+            except Exception as e:
+                logger.error(f"处理变更通知失败: {e}")
+        return message['seq']
+
+    def _remove(self, subscriber):
+        with self._lock:
+            self._subscribers.discard(subscriber)
+
+    def _accept_loop(self):
+        while self._sock is not None:
+            try:
+                conn, _ = self._sock.accept()
+            except OSError:
+                break
+            subscriber = _Subscriber(self, conn, self.max_pending)
+            with self._lock:
+                subscriber.send(_encode({'type': 'hello', 'boot': self.boot, 'seq': self._seq}))
+                self._subscribers.add(subscriber)
+            subscriber.start()
+
+
+class EventBusClient:
+    """变更通知客户端，运行在 Web 工作进程中，断线后自动重连"""
+
+    def __init__(self, path=None, on_message=None, on_resync=None,
+                 reconnect_delay=1.0, max_reconnect_delay=30.0):
+        self.path = path or DEFAULT_SOCKET_PATH
+        self.on_message = on_message
+        self.on_resync = on_resync
+        self.reconnect_delay = reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay
+        self._sock = None
+        self._send_lock = threading.Lock()
+        self._boot = None
+        self._seq = None
+        self._thread = None
+        self._stopped = False
+
+    @property
+    def connected(self):
+        return self._sock is not None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stopped = True
+        sock = self._sock
+        if sock:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def publish(self, message):
+        """发送消息给服务端转发，未连接时返回 False"""
+        sock = self._sock
+        if sock is None:
+            return False
+        try:
+            with self._send_lock:
+                sock.sendall(_encode(message))
+            return True
+        except OSError:
+            return False
+
+    def _resync(self):
+        if self.on_resync:
+            try:
+                self.on_resync()
+            except Exception as e:
+                logger.error(f"刷新状态失败: {e}")
+
+    def _handle(self, message):
+        if message.get('type') == 'hello':
+            # 首次连接、服务端重启或重连期间可能漏掉了通知
+            if message['boot'] != self._boot or message['seq'] != self._seq:
+                self._resync()
+            self._boot = message['boot']
+            self._seq = message['seq']
+            return
+
+        seq = message.get('seq')
+        if self._seq is not None and seq != self._seq + 1:
+            logger.warning(f"变更通知序号不连续（{self._seq} -> {seq}），整体刷新")
+            self._seq = seq
+            self._resync()
+            return
+        self._seq = seq
+        if self.on_message:
+            try:
+                self.on_message(message)
+            except Exception as e:
+                logger.error(f"处理变更通知失败: {e}")
+
+    def _run(self):
+        delay = self.reconnect_delay
+        while not self._stopped:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(self.path)
+            except OSError:
+                sock.close()
+                time.sleep(delay)
+                delay = min(delay * 2, self.max_reconnect_delay)
+                continue
+
+            logger.info(f"已连接变更通知总线: {self.path}")
+            delay = self.reconnect_delay
+            self._sock = sock
+            try:
+                with sock.makefile('rb') as stream:
+                    for line in stream:
+                        try:
+                            message = json.loads(line)
+                        except ValueError:
+                            continue
+                        self._handle(message)
+            except OSError:
+                pass
+            finally:
+                self._sock = None
+                sock.close()
+
+            if not self._stopped:
+                logger.warning("变更通知总线连接断开，稍后重连")
+                time.sleep(delay)
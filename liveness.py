@@ -0,0 +1,169 @@
+"""
+设备心跳与超时会话回收
+
+发送过 heartbeat 事件的设备被视为支持心跳。这类设备开始游戏或发送心跳时，
+都会（重新）设定截止时间：最后一次收到消息的时间加上超时时长。截止时间保存在最小堆中，
+过期的条目惰性删除。后台线程只在最早的截止时间到达时醒来；设备到期时调用 on_expired，
+由 MQTT 客户端生成 timeout 事件，在最后一次收到消息的时间结束设备未结束的会话。
+
+不发送心跳的设备不受影响，其会话仍只由 game_end 或下一次 game_start 结束。
+
+截止时间只在内存中，因此支持心跳的设备和最后收到消息的时间由后台线程定期交给
+on_persist 保存。重启时 restore() 为这些设备未结束的会话重新设定截止时间：
+服务停止期间断电的设备不会再发消息，其会话在保存的最后收到消息的时间结束。
+"""
+
+import heapq
+import itertools
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# 超过多少秒没有收到支持心跳的设备的任何消息，视为断电或离线
+HEARTBEAT_TIMEOUT_SECONDS = float(os.environ.get('GAME_USAGE_HEARTBEAT_TIMEOUT', 90))
+
+
+class LivenessTracker:
+    """按截止时间回收失联设备的会话，线程安全"""
+
+    def __init__(self, timeout_seconds=HEARTBEAT_TIMEOUT_SECONDS, on_expired=None,
+                 on_persist=None, persist_interval=None):
+        self.timeout_seconds = timeout_seconds
+        self.on_expired = on_expired
+        # on_persist([(player_id, 设备名称, 最后收到消息的时间)])，默认每三分之一个超时时长调用一次
+        self.on_persist = on_persist
+        self.persist_interval = persist_interval or timeout_seconds / 3
+        self._condition = threading.Condition()
+        # 发送过心跳的设备
+        self._capable = set()
+        # player_id -> (令牌, 最后收到消息的时间, 设备名称)，只包含已设定截止时间的设备
+        self._armed = {}
+        # (截止时间 monotonic, 令牌, player_id)，令牌与 _armed 不一致的条目已失效
+        self._deadlines = []
+        # 上次保存之后最后收到消息的时间有变化的设备：player_id -> (player_id, 设备名称, 时间)
+        self._unsaved = {}
+        self._tokens = itertools.count()
+        self._thread = None
+        self._stopping = False
+
+    def _arm(self, player_id, player_name, last_seen):
+        token = next(self._tokens)
+        self._armed[player_id] = (token, last_seen, player_name)
+        self._unsaved[player_id] = (player_id, player_name, last_seen)
+        was_empty = not self._deadlines
+        heapq.heappush(self._deadlines, (time.monotonic() + self.timeout_seconds, token, player_id))
+        # 超时时长固定，新的截止时间不会早于堆顶，只有堆为空时需要唤醒后台线程
+        if was_empty:
+            self._condition.notify()
+        # 失效条目过多时重建堆，避免持续心跳让堆无限增长
+        if len(self._deadlines) > 4 * len(self._armed) + 1024:
+            self._deadlines = [entry for entry in self._deadlines
+                               if self._armed.get(entry[2], (None,))[0] == entry[1]]
+            heapq.heapify(self._deadlines)
+
+    def heartbeat(self, player_id, player_name, timestamp):
+        """收到心跳"""
+        with self._condition:
+            self._capable.add(player_id)
+            self._arm(player_id, player_name, timestamp)
+
+    def session_started(self, player_id, player_name, timestamp):
+        """收到 game_start：支持心跳的设备设定截止时间"""
+        with self._condition:
+            if player_id in self._capable:
+                self._arm(player_id, player_name, timestamp)
+
+    def restore(self, capable_ids, open_sessions):
+        """启动时恢复：capable_ids 为支持心跳的设备，open_sessions 为它们未结束的会话
+        [(player_id, 设备名称, 最后收到消息的时间)]
+
+        截止时间从现在起算一个超时时长：仍在运行的设备在此之前会发来心跳，
+        服务停止期间失联的设备到期后在保存的最后收到消息的时间结束会话。
+        """
+        with self._condition:
+            self._capable.update(capable_ids)
+            for player_id, player_name, last_seen in open_sessions:
+                self._capable.add(player_id)
+                self._arm(player_id, player_name, last_seen)
+            self._unsaved.clear()
+
+    def persist(self):
+        """把变化的最后收到消息时间交给 on_persist"""
+        with self._condition:
+            rows, self._unsaved = list(self._unsaved.values()), {}
+        if rows and self.on_persist is not None:
+            try:
+                self.on_persist(rows)
+            except Exception as e:
+                logger.error(f"保存设备心跳时间出错: {e}")
+
+    def session_ended(self, player_id):
+        """收到 game_end：设备不再有未结束的会话，取消截止时间"""
+        with self._condition:
+            self._armed.pop(player_id, None)
+
+    def armed_count(self):
+        """已设定截止时间的设备数"""
+        return len(self._armed)
+
+    def expire(self, now=None):
+        """取出所有已到期的设备，返回 [(player_id, player_name, 最后收到消息的时间)]"""
+        if now is None:
+            now = time.monotonic()
+        expired = []
+        with self._condition:
+            while self._deadlines and self._deadlines[0][0] <= now:
+                _, token, player_id = heapq.heappop(self._deadlines)
+                armed = self._armed.get(player_id)
+                if armed is None or armed[0] != token:
+                    continue
+                del self._armed[player_id]
+                expired.append((player_id, armed[2], armed[1]))
+        return expired
+
+    def _run(self):
+        next_persist = time.monotonic() + self.persist_interval
+        while True:
+            with self._condition:
+                while not self._stopping:
+                    wake = next_persist if self.on_persist is not None else None
+                    if self._deadlines:
+                        wake = self._deadlines[0][0] if wake is None else min(wake, self._deadlines[0][0])
+                    if wake is None:
+                        self._condition.wait()
+                        continue
+                    remaining = wake - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+                if self._stopping:
+                    break
+
+            for player_id, player_name, last_seen in self.expire():
+                try:
+                    self.on_expired(player_id, player_name, last_seen)
+                except Exception as e:
+                    logger.error(f"处理设备 {player_id} 心跳超时出错: {e}")
+            if time.monotonic() >= next_persist:
+                self.persist()
+                next_persist = time.monotonic() + self.persist_interval
+        self.persist()
+
+    def start(self):
+        with self._condition:
+            if self._thread is not None:
+                return
+            self._stopping = False
+            self._thread = threading.Thread(target=self._run, name='liveness-reaper', daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=None):
+        with self._condition:
+            thread, self._thread = self._thread, None
+            self._stopping = True
+            self._condition.notify_all()
+        if thread is not None:
+            thread.join(timeout)
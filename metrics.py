@@ -0,0 +1,242 @@
+"""
+运行指标收集，以 Prometheus 文本格式导出
+
+计数器和直方图在创建时分配好存储，记录一次样本只需一次加锁和整数加法，
+可以在生产环境常开。热点路径应预先调用 labels() 取得子指标再使用。
+"""
+
+import threading
+from bisect import bisect_left
+
+# 默认耗时分桶（秒）
+DEFAULT_TIME_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                        0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# 每次请求/事件的 SQL 语句数分桶
+SQL_COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 100)
+
+_registry = []
+_registry_lock = threading.Lock()
+
+
+def _format_labels(labelnames, labelvalues, extra=None):
+    pairs = list(zip(labelnames, labelvalues))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    escaped = ','.join(
+        '{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+        for name, value in pairs)
+    return '{' + escaped + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class _Metric:
+    kind = 'untyped'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._children_lock = threading.Lock()
+        if not self.labelnames:
+            self._default = self._new_child()
+        with _registry_lock:
+            _registry.append(self)
+
+    def labels(self, *labelvalues):
+        """获取（必要时创建）指定标签值的子指标"""
+        child = self._children.get(labelvalues)
+        if child is None:
+            with self._children_lock:
+                child = self._children.setdefault(labelvalues, self._new_child())
+        return child
+
+    def _samples(self):
+        if not self.labelnames:
+            return [((), self._default)]
+        return sorted(self._children.items(), key=lambda item: item[0])
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}',
+                 f'# TYPE {self.name} {self.kind}']
+        for labelvalues, child in self._samples():
+            lines.extend(self._render_child(labelvalues, child))
+        return lines
+
+
+class _CounterChild:
+    __slots__ = ('_lock', '_value')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._value = 0
+
+    def inc(self, amount=1):
+        with self._lock:
+            self._value += amount
+
+    @property
+    def value(self):
+        return self._value
+
+
+class Counter(_Metric):
+    """只增不减的计数器"""
+    kind = 'counter'
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount=1):
+        self._default.inc(amount)
+
+    def _render_child(self, labelvalues, child):
+        labels = _format_labels(self.labelnames, labelvalues)
+        return [f'{self.name}{labels} {_format_value(child.value)}']
+
+
+class _HistogramChild:
+    __slots__ = ('_lock', '_bounds', '_counts', '_sum')
+
+    def __init__(self, bounds):
+        self._lock = threading.Lock()
+        self._bounds = bounds
+        # 最后一个槽位对应 +Inf
+        self._counts = [0] * (len(bounds) + 1)
+        self._sum = 0.0
+
+    def observe(self, value):
+        index = bisect_left(self._bounds, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+
+    def snapshot(self):
+        with self._lock:
+            return list(self._counts), self._sum
+
+
+class Histogram(_Metric):
+    """固定分桶的直方图"""
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_TIME_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value):
+        self._default.observe(value)
+
+    def _render_child(self, labelvalues, child):
+        counts, total = child.snapshot()
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            labels = _format_labels(self.labelnames, labelvalues, ('le', _format_value(float(bound))))
+            lines.append(f'{self.name}_bucket{labels} {cumulative}')
+        labels = _format_labels(self.labelnames, labelvalues)
+        lines.append(f'{self.name}_sum{labels} {_format_value(total)}')
+        lines.append(f'{self.name}_count{labels} {cumulative}')
+        return lines
+
+
+class Gauge(_Metric):
+    """采集时通过回调函数读取当前值的仪表"""
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, function=None):
+        self._function = function
+        super().__init__(name, documentation)
+
+    def _new_child(self):
+        return None
+
+    def set_function(self, function):
+        self._function = function
+
+    def _samples(self):
+        return [((), None)]
+
+    def _render_child(self, labelvalues, child):
+        try:
+            value = self._function() if self._function else 0
+        except Exception:
+            value = 0
+        return [f'{self.name} {_format_value(value)}']
+
+
+def render():
+    """以 Prometheus 文本格式输出所有指标"""
+    with _registry_lock:
+        metrics = list(_registry)
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+# ---------------------------------------------------------------------------
+# SQL 语句计数：总数 + 当前线程的累计数（用于计算每次请求/事件的语句数）
+# ---------------------------------------------------------------------------
+
+_sql_local = threading.local()
+
+SQL_STATEMENTS = Counter('sql_statements_total', '执行的 SQL 语句总数')
+
+
+def count_sql_statement():
+    _sql_local.count = getattr(_sql_local, 'count', 0) + 1
+    SQL_STATEMENTS.inc()
+
+
+def sql_statement_count():
+    """当前线程累计执行的 SQL 语句数"""
+    return getattr(_sql_local, 'count', 0)
+
+
+# ---------------------------------------------------------------------------
+# 写入链路
+# ---------------------------------------------------------------------------
+
+MQTT_MESSAGE_PARSE_SECONDS = Histogram(
+    'mqtt_message_parse_seconds', 'on_message 解析并入队的耗时')
+INGEST_EVENT_HANDLE_SECONDS = Histogram(
+    'ingest_event_handle_seconds', '写入线程处理单个事件的耗时')
+INGEST_BATCH_SIZE = Histogram(
+    'ingest_batch_size', '每批写入的事件数', buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, 1000))
+INGEST_EVENTS = Counter(
+    'ingest_events_total', '按类型统计的 MQTT 事件数', ['event'])
+INGEST_REJECTED = Counter(
+    'ingest_rejected_total', '按原因统计的被拒绝消息数', ['reason'])
+SQL_STATEMENTS_PER_EVENT = Histogram(
+    'sql_statements_per_event', '处理单个事件执行的 SQL 语句数', buckets=SQL_COUNT_BUCKETS)
+INGEST_QUEUE_DEPTH = Gauge(
+    'ingest_queue_depth', '等待写入的事件数')
+LIVENESS_ARMED_DEVICES = Gauge(
+    'liveness_armed_devices', '等待心跳超时判定的设备数')
+
+# ---------------------------------------------------------------------------
+# API
+# ---------------------------------------------------------------------------
+
+HTTP_REQUEST_SECONDS = Histogram(
+    'http_request_duration_seconds', '按路由统计的请求耗时', ['route'])
+SQL_STATEMENTS_PER_REQUEST = Histogram(
+    'sql_statements_per_request', '每次请求执行的 SQL 语句数', ['route'], buckets=SQL_COUNT_BUCKETS)
+SSE_SUBSCRIBERS = Gauge(
+    'sse_subscribers', '当前连接的 SSE 客户端数')
+UPDATE_QUEUE_DEPTH = Gauge(
+    'update_queue_depth', '实时更新队列中等待推送的信号数')
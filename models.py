@@ -1,8 +1,54 @@
 from peewee import *
-from datetime import datetime
+from playhouse.pool import PooledSqliteDatabase
+from datetime import datetime, timedelta
+import os
+import sys
+import metrics
+from duration_sketch import DurationSketch, SketchAggregate, SketchUnion, merge_blobs
 
-# SQLite 数据库配置
-db = SqliteDatabase('game_usage.db')
+# SQLite 数据库配置（均可通过环境变量覆盖）
+DATABASE_PATH = os.environ.get('GAME_USAGE_DB', 'game_usage.db')
+DATABASE_MAX_CONNECTIONS = int(os.environ.get('GAME_USAGE_DB_MAX_CONNECTIONS', 32))
+DATABASE_PRAGMAS = {
+    # WAL 模式下读不阻塞写、写不阻塞读
+    'journal_mode': 'wal',
+    # WAL 下 NORMAL 已足够安全，且避免每次提交都 fsync
+    'synchronous': 'normal',
+    # 写锁被占用时等待的毫秒数
+    'busy_timeout': int(os.environ.get('GAME_USAGE_DB_BUSY_TIMEOUT', 5000)),
+    # 负数表示 KiB
+    'cache_size': int(os.environ.get('GAME_USAGE_DB_CACHE_SIZE', -16000)),
+    'mmap_size': int(os.environ.get('GAME_USAGE_DB_MMAP_SIZE', 256 * 1024 * 1024)),
+    'temp_store': 'memory',
+}
+
+class InstrumentedSqliteDatabase(PooledSqliteDatabase):
+    """统计执行的 SQL 语句数"""
+    
+    def execute_sql(self, sql, params=None, commit=None):
+        metrics.count_sql_statement()
+        return super().execute_sql(sql, params, commit)
+
+# 连接池：每个线程持有自己的连接，close() 归还到池中，
+# API 请求线程与 MQTT 写入线程互不影响
+db = InstrumentedSqliteDatabase(None)
+
+def configure_database(path=None, max_connections=None, **pragmas):
+    """初始化（或重新指定）数据库文件和连接参数"""
+    db.init(
+        path or DATABASE_PATH,
+        max_connections=max_connections or DATABASE_MAX_CONNECTIONS,
+        stale_timeout=300,
+        pragmas=dict(DATABASE_PRAGMAS, **pragmas),
+        check_same_thread=False
+    )
+
+configure_database()
+
+# 每日汇总中会话时长草图的合并与聚合函数（见 duration_sketch.py）
+db.register_function(merge_blobs, 'sketch_merge', 2, deterministic=True)
+db.register_aggregate(SketchAggregate, 'sketch_agg', 1)
+db.register_aggregate(SketchUnion, 'sketch_union', 1)
 
 class BaseModel(Model):
     class Meta:
@@ -20,11 +66,317 @@ class GameSession(BaseModel):
     class Meta:
         table_name = 'game_sessions'
 
+class DailyDeviceUsage(BaseModel):
+    """每日设备使用汇总（按会话开始日期统计已结束的会话）"""
+    date = DateField()
+    player_id = CharField(max_length=100)
+    player_name = CharField(max_length=100)
+    total_seconds = IntegerField(default=0)
+    session_count = IntegerField(default=0)
+    last_activity = DateTimeField(null=True)
+    # 已结束会话的时长分布（序列化的 DurationSketch）
+    duration_sketch = BlobField(null=True)
+    
+    class Meta:
+        table_name = 'daily_device_usage'
+        indexes = (
+            (('date', 'player_id'), True),
+        )
+
+class DeviceHeartbeat(BaseModel):
+    """发送过心跳的设备及最后一次收到其消息的时间（重启后恢复心跳超时用）"""
+    player_id = CharField(max_length=100, primary_key=True)
+    player_name = CharField(max_length=100)
+    last_seen = DateTimeField()
+    
+    class Meta:
+        table_name = 'device_heartbeats'
+
+class SessionGeneration(BaseModel):
+    """会话被删除或改写的次数（只有 id = 1 一行）
+
+    列式统计快照只增量追加新会话；其他进程或命令行工具删除、改写会话后增加该次数，
+    快照同步时发现次数变化就整体重新加载。
+    """
+    generation = IntegerField(default=0)
+    
+    class Meta:
+        table_name = 'session_generation'
+
+def daily_usage_upsert(date, player_id, player_name, total_seconds, session_count, last_activity,
+                       duration_sketch=None):
+    """构造将使用量累加到每日汇总的 upsert 语句（未执行）"""
+    return DailyDeviceUsage.insert(
+        date=date,
+        player_id=player_id,
+        player_name=player_name,
+        total_seconds=total_seconds,
+        session_count=session_count,
+        last_activity=last_activity,
+        duration_sketch=duration_sketch
+    ).on_conflict(
+        conflict_target=[DailyDeviceUsage.date, DailyDeviceUsage.player_id],
+        update={
+            DailyDeviceUsage.player_name: EXCLUDED.player_name,
+            DailyDeviceUsage.total_seconds: DailyDeviceUsage.total_seconds + EXCLUDED.total_seconds,
+            DailyDeviceUsage.session_count: DailyDeviceUsage.session_count + EXCLUDED.session_count,
+            DailyDeviceUsage.last_activity: fn.MAX(
+                fn.COALESCE(DailyDeviceUsage.last_activity, EXCLUDED.last_activity),
+                EXCLUDED.last_activity),
+            DailyDeviceUsage.duration_sketch: fn.sketch_merge(
+                DailyDeviceUsage.duration_sketch, EXCLUDED.duration_sketch)
+        }
+    )
+
+# 批量写入热点路径使用的参数化语句，避免逐行构造查询
+CLOSE_SESSION_SQL = (
+    'UPDATE game_sessions SET end_time = ?, duration_seconds = ? '
+    'WHERE id = ? AND end_time IS NULL'
+)
+INSERT_SESSION_SQL = (
+    'INSERT INTO game_sessions '
+    '(player_id, player_name, start_time, end_time, duration_seconds, created_at) '
+    'VALUES (?, ?, ?, ?, ?, ?)'
+)
+UPSERT_DAILY_USAGE_SQL = (
+    'INSERT INTO daily_device_usage '
+    '(date, player_id, player_name, total_seconds, session_count, last_activity, duration_sketch) '
+    'VALUES (?, ?, ?, ?, ?, ?, ?) '
+    'ON CONFLICT (date, player_id) DO UPDATE SET '
+    'player_name = excluded.player_name, '
+    'total_seconds = total_seconds + excluded.total_seconds, '
+    'session_count = session_count + excluded.session_count, '
+    'last_activity = MAX(COALESCE(last_activity, excluded.last_activity), excluded.last_activity), '
+    'duration_sketch = sketch_merge(duration_sketch, excluded.duration_sketch)'
+)
+
+UPSERT_HEARTBEAT_SQL = (
+    'INSERT INTO device_heartbeats (player_id, player_name, last_seen) VALUES (?, ?, ?) '
+    'ON CONFLICT (player_id) DO UPDATE SET '
+    'player_name = excluded.player_name, '
+    'last_seen = MAX(last_seen, excluded.last_seen)'
+)
+
+def record_session_usage(session):
+    """将一个已结束的会话累加到每日汇总"""
+    daily_usage_upsert(
+        session.start_time.date(),
+        session.player_id,
+        session.player_name,
+        session.duration_seconds,
+        1,
+        session.end_time,
+        DurationSketch.of([session.duration_seconds]).to_bytes()
+    ).execute()
+
+def _daily_usage_source():
+    """从会话表按 (日期, 设备) 汇总的查询"""
+    return GameSession.select(
+        fn.DATE(GameSession.start_time),
+        GameSession.player_id,
+        fn.MAX(GameSession.player_name),
+        fn.SUM(GameSession.duration_seconds),
+        fn.COUNT(GameSession.id),
+        fn.MAX(GameSession.end_time),
+        fn.sketch_agg(GameSession.duration_seconds)
+    ).where(
+        GameSession.duration_seconds.is_null(False)
+    ).group_by(
+        fn.DATE(GameSession.start_time),
+        GameSession.player_id
+    )
+
+_DAILY_USAGE_FIELDS = [
+    DailyDeviceUsage.date,
+    DailyDeviceUsage.player_id,
+    DailyDeviceUsage.player_name,
+    DailyDeviceUsage.total_seconds,
+    DailyDeviceUsage.session_count,
+    DailyDeviceUsage.last_activity,
+    DailyDeviceUsage.duration_sketch
+]
+
+def bump_session_generation():
+    """删除会话或把已结束的会话恢复为未结束之后调用"""
+    SessionGeneration.insert(id=1, generation=1).on_conflict(
+        conflict_target=[SessionGeneration.id],
+        update={SessionGeneration.generation: SessionGeneration.generation + 1}
+    ).execute()
+
+def session_generation():
+    """当前的会话改写次数"""
+    return SessionGeneration.select(SessionGeneration.generation).where(
+        SessionGeneration.id == 1).scalar() or 0
+
+def refresh_daily_usage(date, player_id):
+    """从会话表重新计算某设备某天的汇总（删除会话后使用）"""
+    with db.atomic():
+        DailyDeviceUsage.delete().where(
+            (DailyDeviceUsage.date == date) &
+            (DailyDeviceUsage.player_id == player_id)
+        ).execute()
+        source = _daily_usage_source().where(
+            (GameSession.player_id == player_id) &
+            (GameSession.start_time >= date) &
+            (GameSession.start_time < date + timedelta(days=1))
+        )
+        DailyDeviceUsage.insert_from(source, _DAILY_USAGE_FIELDS).execute()
+        _add_archived_daily_usage(date, date, player_id)
+
+def _add_archived_daily_usage(date_from=None, date_to=None, player_id=None):
+    """把归档文件中的会话累加到每日汇总（重建汇总时不丢失已归档日期的数据）"""
+    from archive import archived_daily_usage
+    rows = archived_daily_usage(date_from, date_to, player_id=player_id)
+    if rows:
+        cursor = db.cursor()
+        cursor.executemany(UPSERT_DAILY_USAGE_SQL, rows)
+        metrics.count_sql_statement()
+
+def rebuild_daily_usage(date_from=None, date_to=None):
+    """根据会话表重建每日汇总，可只重建日期范围内（含两端）的部分"""
+    target = DailyDeviceUsage.delete()
+    source = _daily_usage_source()
+    if date_from is not None:
+        target = target.where(DailyDeviceUsage.date >= date_from)
+        source = source.where(GameSession.start_time >= date_from)
+    if date_to is not None:
+        target = target.where(DailyDeviceUsage.date <= date_to)
+        source = source.where(GameSession.start_time < date_to + timedelta(days=1))
+    
+    with db.atomic():
+        target.execute()
+        DailyDeviceUsage.insert_from(source, _DAILY_USAGE_FIELDS).execute()
+        _add_archived_daily_usage(date_from, date_to)
+    return DailyDeviceUsage.select().count()
+
+# ---------------------------------------------------------------------------
+# 数据库迁移
+#
+# 数据库版本记录在 SQLite 的 PRAGMA user_version 中，启动时按顺序执行
+# 版本号大于当前版本的迁移，每个迁移在独立事务中完成，
+# 因此已有的 game_usage.db 可以原地升级。
+# ---------------------------------------------------------------------------
+
+def _migration_001_session_indexes(database):
+    """为会话表添加常用查询索引"""
+    # 按设备过滤并按开始时间排序/范围查询
+    database.execute_sql(
+        'CREATE INDEX IF NOT EXISTS idx_game_sessions_player_start '
+        'ON game_sessions (player_id, start_time)'
+    )
+    # 按日期范围统计
+    database.execute_sql(
+        'CREATE INDEX IF NOT EXISTS idx_game_sessions_start '
+        'ON game_sessions (start_time)'
+    )
+    # 未结束的会话（部分索引）
+    database.execute_sql(
+        'CREATE INDEX IF NOT EXISTS idx_game_sessions_open '
+        'ON game_sessions (player_id, start_time) WHERE end_time IS NULL'
+    )
+
+
+def _migration_002_daily_usage(database):
+    """创建每日汇总表并从历史会话回填"""
+    database.create_tables([DailyDeviceUsage], safe=True)
+    rebuild_daily_usage()
+
+
+def _migration_003_session_cursor_indexes(database):
+    """会话列表游标分页使用的索引"""
+    database.execute_sql(
+        'CREATE INDEX IF NOT EXISTS idx_game_sessions_created '
+        'ON game_sessions (created_at, id)'
+    )
+    database.execute_sql(
+        'CREATE INDEX IF NOT EXISTS idx_game_sessions_player_created '
+        'ON game_sessions (player_id, created_at, id)'
+    )
+
+
+def _migration_004_daily_usage_duration_sketch(database):
+    """每日汇总增加会话时长草图列，并只回填该列"""
+    # 新建的数据库在 create_tables 时已经包含该列，迁移 002 重建汇总时已经写入了草图
+    columns = [column.name for column in database.get_columns('daily_device_usage')]
+    if 'duration_sketch' in columns:
+        return
+    database.execute_sql('ALTER TABLE daily_device_usage ADD COLUMN duration_sketch BLOB')
+    database.execute_sql(
+        'UPDATE daily_device_usage SET duration_sketch = ('
+        'SELECT sketch_agg(duration_seconds) FROM game_sessions '
+        'WHERE game_sessions.player_id = daily_device_usage.player_id '
+        'AND start_time >= daily_device_usage.date '
+        "AND start_time < DATE(daily_device_usage.date, '+1 day') "
+        'AND duration_seconds IS NOT NULL)'
+    )
+    # 已归档日期的会话不在会话表中，合并归档文件中的草图
+    from archive import archived_daily_usage
+    rows = [(sketch, day, player_id)
+            for day, player_id, _, _, _, _, sketch in archived_daily_usage()]
+    if rows:
+        database.cursor().executemany(
+            'UPDATE daily_device_usage SET duration_sketch = sketch_merge(duration_sketch, ?) '
+            'WHERE date = ? AND player_id = ?', rows)
+
+
+def _migration_005_device_heartbeats(database):
+    """记录支持心跳的设备和最后收到消息的时间"""
+    database.create_tables([DeviceHeartbeat], safe=True)
+
+
+def _migration_006_session_generation(database):
+    """记录会话被删除或改写的次数"""
+    database.create_tables([SessionGeneration], safe=True)
+
+
+# (版本号, 说明, 迁移函数)，只能追加，不要修改已发布的迁移
+MIGRATIONS = [
+    (1, '会话表索引', _migration_001_session_indexes),
+    (2, '每日设备使用汇总表', _migration_002_daily_usage),
+    (3, '会话列表游标分页索引', _migration_003_session_cursor_indexes),
+    (4, '每日汇总会话时长分布', _migration_004_daily_usage_duration_sketch),
+    (5, '设备心跳记录', _migration_005_device_heartbeats),
+    (6, '会话改写次数', _migration_006_session_generation),
+]
+
+
+def get_schema_version(database=None):
+    """获取当前数据库版本"""
+    database = database or db
+    return database.pragma('user_version')
+
+
+def migrate(database=None):
+    """执行所有未应用的迁移"""
+    database = database or db
+    current_version = get_schema_version(database)
+
+    for version, description, migration in MIGRATIONS:
+        if version <= current_version:
+            continue
+        with database.atomic('IMMEDIATE'):
+            # 多个进程同时启动时，其他进程可能已经完成了该迁移
+            current_version = get_schema_version(database)
+            if version <= current_version:
+                continue
+            migration(database)
+            database.pragma('user_version', version)
+        print(f"数据库迁移 {version}: {description}")
+        current_version = version
+
+    return current_version
+
+
 def init_db():
     """初始化数据库"""
-    db.connect()
-    db.create_tables([GameSession], safe=True)
-    print("数据库初始化完成")
+    db.connect(reuse_if_open=True)
+    db.create_tables([GameSession, DailyDeviceUsage, DeviceHeartbeat, SessionGeneration], safe=True)
+    version = migrate()
+    print(f"数据库初始化完成（版本 {version}）")
 
 if __name__ == "__main__":
-    init_db()
\ No newline at end of file
+    init_db()
+    
+    if len(sys.argv) > 1 and sys.argv[1] == 'rebuild-daily-usage':
+        count = rebuild_daily_usage()
+        print(f"每日汇总重建完成，共 {count} 条记录")
@@ -1,18 +1,45 @@
-import json
 import paho.mqtt.client as mqtt
 from datetime import datetime
-from models import GameSession, db
+from models import (GameSession, DeviceHeartbeat, db, init_db, configure_database,
+                    record_session_usage, CLOSE_SESSION_SQL, INSERT_SESSION_SQL,
+                    UPSERT_DAILY_USAGE_SQL, UPSERT_HEARTBEAT_SQL)
+from device_registry import device_registry
+from response_cache import bump_data_version
+from ipc_bus import dump_states
+from event_journal import open_default_journal
+from liveness import LivenessTracker, HEARTBEAT_TIMEOUT_SECONDS
+from duration_sketch import DurationSketch
+import event_codec
+import metrics
 import logging
+import multiprocessing
 import requests
 import queue
 import threading
+import time
+import zlib
 
 # 配置日志
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# 写入线程/进程的停止信号（需要能跨进程传递）
+_STOP = None
+
+# 热点路径上使用的子指标
+_EVENTS_BY_TYPE = {
+    'game_start': metrics.INGEST_EVENTS.labels('game_start'),
+    'game_end': metrics.INGEST_EVENTS.labels('game_end'),
+    'heartbeat': metrics.INGEST_EVENTS.labels('heartbeat'),
+    'timeout': metrics.INGEST_EVENTS.labels('timeout'),
+}
+_EVENTS_UNKNOWN = metrics.INGEST_EVENTS.labels('unknown')
+_EVENTS_INVALID = metrics.INGEST_EVENTS.labels('invalid')
+
 class GameUsageTracker:
-    def __init__(self, update_queue=None):
+    def __init__(self, update_queue=None, batch_size=200, batch_wait=0.05,
+                 shards=1, shard_mode='thread', event_bus=None, journal=None,
+                 checkpoint_interval=5.0, heartbeat_timeout=HEARTBEAT_TIMEOUT_SECONDS):
         self.client = mqtt.Client()
         self.client.on_connect = self.on_connect
         self.client.on_message = self.on_message
@@ -24,17 +51,70 @@ class GameUsageTracker:
         self.username = "guest"
         self.password = "test"
         self.topic = "game"
+        # 带宽受限的设备可以在并行主题上发送 MessagePack 编码的消息
+        self.msgpack_topic = "game/msgpack"
+        self._topic_formats = {self.topic: event_codec.FORMAT_JSON}
+        if event_codec.msgpack_available():
+            self._topic_formats[self.msgpack_topic] = event_codec.FORMAT_MSGPACK
         self.reconnect_delay = 5
         self.max_reconnect_delay = 60
         
         # 实时更新队列
         self.update_queue = update_queue
+        # 多进程部署时的变更通知总线（ipc_bus.EventBusServer），设置后不再使用更新队列
+        self.event_bus = event_bus
+        
+        # 原始事件日志（event_journal.EventJournal）：处理前追加，每批 fsync 一次；
+        # 已追加但未提交的事件数归零时记录检查点
+        self.journal = journal
+        self.checkpoint_interval = checkpoint_interval
+        self._journal_lock = threading.Lock()
+        self._journal_inflight = 0
+        self._last_checkpoint = 0.0
+        # 分片进程模式下，事件先进入该队列，由主进程落盘日志后再交给分片进程
+        self._unsynced_events = queue.Queue()
+        self._journal_syncer = None
+        
+        # 支持心跳的设备超时未收到消息时，生成 timeout 事件结束其会话；
+        # 最后收到消息的时间定期保存，重启后由 restore_liveness 恢复截止时间
+        self.liveness = LivenessTracker(heartbeat_timeout, self._session_expired,
+                                        on_persist=self._persist_heartbeats)
+        metrics.LIVENESS_ARMED_DEVICES.set_function(self.liveness.armed_count)
+        
+        # 批量写入配置：每批最多事件数、凑批最长等待秒数
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        
+        # 按设备 ID 哈希分片，每个分片一个队列和写入线程（或进程），
+        # 同一设备的事件总是进入同一分片，保证设备内的顺序
+        self.shards = max(1, shards)
+        self.shard_mode = shard_mode
+        # 各分片串行提交事务的锁，避免在 SQLite 的忙等待中休眠
+        if shard_mode == 'process':
+            self._mp_context = multiprocessing.get_context('spawn')
+            self.event_queues = [self._mp_context.Queue() for _ in range(self.shards)]
+            self._shard_results = self._mp_context.Queue()
+            self._write_lock = self._mp_context.Lock()
+        else:
+            self.event_queues = [queue.Queue() for _ in range(self.shards)]
+            self._shard_results = None
+            self._write_lock = threading.Lock()
+        
+        # 每台设备只属于一个分片，分片可以安全地缓存设备未结束的会话：
+        # player_id -> 未结束的会话，None 表示已知没有未结束的会话
+        self._open_sessions = {}
+        self._writer_threads = []
+        self._shard_processes = []
+        self._result_collector = None
+        # 仅在分片写入进程中设置，用于把每批结果交回主进程
+        self._result_queue = None
         
     def on_connect(self, client, userdata, flags, rc):
         if rc == 0:
             logger.info("✅ 成功连接到 MQTT Broker")
-            result = client.subscribe(self.topic)
-            logger.info(f"✅ 订阅主题: {self.topic}, 结果: {result}")
+            topics = list(self._topic_formats)
+            result = client.subscribe([(topic, 0) for topic in topics])
+            logger.info(f"✅ 订阅主题: {', '.join(topics)}, 结果: {result}")
             # 重置重连延迟
             self.reconnect_delay = 5
         else:
@@ -55,92 +135,619 @@ class GameUsageTracker:
             logger.info("正常断开连接")
     
     def on_message(self, client, userdata, msg):
+        started = time.perf_counter()
         try:
-            # 解析 MQTT 消息
-            raw_message = msg.payload.decode()
-            logger.info(f"📨 收到原始消息: {raw_message}")
+            fmt = self._topic_formats.get(msg.topic, event_codec.FORMAT_JSON)
+            event, reason = event_codec.decode_event(msg.payload, fmt)
             
-            message = json.loads(raw_message)
-            logger.info(f"📋 解析后消息: {message}")
+            if reason:
+                # 畸形消息只计数，调试时才输出详情
+                if reason == event_codec.REJECT_UNKNOWN_EVENT:
+                    _EVENTS_UNKNOWN.inc()
+                else:
+                    _EVENTS_INVALID.inc()
+                metrics.INGEST_REJECTED.labels(reason).inc()
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug(f"⚠️ 拒绝消息（{reason}）: {msg.topic} {msg.payload[:200]!r}")
+                return
             
-            event = message.get("event")
-            player_id = message.get("playerId")
-            player_name = message.get("playerName")
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"📋 收到事件: {event}")
             
-            if not all([event, player_id, player_name]):
-                logger.warning("⚠️ 消息格式不完整")
+            # 只做解析和入队，数据库写入由写入线程批量完成
+            event['timestamp'] = datetime.now()
+            if event['event'] == 'heartbeat':
+                # 心跳只更新截止时间，不写日志也不进入写入队列
+                _EVENTS_BY_TYPE['heartbeat'].inc()
+                self.liveness.heartbeat(event['player_id'], event['player_name'], event['timestamp'])
                 return
-            
-            if event == "game_start":
-                logger.info(f"🎮 处理游戏开始事件: {player_name}")
-                self.handle_game_start(player_id, player_name)
-            elif event == "game_end":
-                logger.info(f"🏁 处理游戏结束事件: {player_name}")
-                self.handle_game_end(player_id, player_name)
+            if event['event'] == 'game_start':
+                self.liveness.session_started(event['player_id'], event['player_name'],
+                                              event['timestamp'])
             else:
-                logger.warning(f"❓ 未知事件类型: {event}")
+                self.liveness.session_ended(event['player_id'])
+            if self.journal is not None:
+                self._append_to_journal(event)
+            self.enqueue_event(event)
                 
-        except json.JSONDecodeError as e:
-            logger.error(f"❌ JSON 解析错误: {e}, 原始消息: {msg.payload.decode()}")
         except Exception as e:
             logger.error(f"❌ 处理消息时出错: {e}")
+        finally:
+            metrics.MQTT_MESSAGE_PARSE_SECONDS.observe(time.perf_counter() - started)
     
-    def handle_game_start(self, player_id, player_name):
-        """处理游戏开始事件"""
+    def _session_expired(self, player_id, player_name, last_seen):
+        """设备心跳超时：在最后一次收到消息的时间结束其未结束的会话"""
+        logger.info(f"⏱️ 设备 {player_name} 心跳超时，最后收到消息于 {last_seen}")
+        event = {
+            'event': 'timeout',
+            'player_id': player_id,
+            'player_name': player_name,
+            'timestamp': last_seen,
+            # 日志按生成时间记录该事件，重放起点不会早于已提交的事件
+            'ingested_at': datetime.now()
+        }
+        if self.journal is not None:
+            self._append_to_journal(event)
+        self.enqueue_event(event)
+    
+    def _persist_heartbeats(self, rows):
+        """保存支持心跳的设备最后收到消息的时间（由超时回收线程调用）"""
+        db.connect(reuse_if_open=True)
         try:
-            # 检查是否有未结束的会话
-            existing_session = GameSession.select().where(
-                (GameSession.player_id == player_id) & 
-                (GameSession.end_time.is_null())
-            ).first()
-            
-            if existing_session:
-                logger.warning(f"玩家 {player_name} 有未结束的会话，先结束之前的会话")
-                self.end_session(existing_session)
-            
-            # 创建新的游戏会话
-            session = GameSession.create(
-                player_id=player_id,
-                player_name=player_name,
-                start_time=datetime.now()
-            )
-            logger.info(f"玩家 {player_name} 开始游戏，会话ID: {session.id}")
-            
-            # 触发实时更新
-            self.trigger_realtime_update()
-            
+            with self._write_lock, db.atomic('IMMEDIATE'):
+                metrics.count_sql_statement()
+                db.cursor().executemany(UPSERT_HEARTBEAT_SQL, rows)
+        finally:
+            db.close()
+    
+    def restore_liveness(self):
+        """重启后为支持心跳的设备未结束的会话重新设定截止时间
+        
+        服务停止期间失联的设备不会再发来消息；按保存的最后收到消息的时间
+        （不早于会话开始时间）结束这些会话，仍在运行的设备会在超时前恢复心跳。
+        """
+        db.connect(reuse_if_open=True)
+        try:
+            capable_ids = [row.player_id for row in DeviceHeartbeat.select(DeviceHeartbeat.player_id)]
+            open_sessions = (GameSession
+                             .select(GameSession.player_id, GameSession.player_name,
+                                     GameSession.start_time, DeviceHeartbeat.last_seen)
+                             .join(DeviceHeartbeat,
+                                   on=(GameSession.player_id == DeviceHeartbeat.player_id))
+                             .where(GameSession.end_time.is_null())
+                             .tuples())
+            restored = [(player_id, player_name, max(start_time, last_seen))
+                        for player_id, player_name, start_time, last_seen in open_sessions]
+        finally:
+            db.close()
+        self.liveness.restore(capable_ids, restored)
+        if restored:
+            logger.info(f"⏱️ 已恢复 {len(restored)} 个支持心跳的设备未结束会话的超时检测")
+    
+    def _append_to_journal(self, event):
+        """处理前把事件追加到日志，由写入线程在写数据库前批量落盘"""
+        with self._journal_lock:
+            event['journal_seq'] = self.journal.append(event)
+            self._journal_inflight += 1
+    
+    def _journal_committed(self, events, force=False):
+        """一批事件处理完毕；所有已追加的事件都已提交时记录检查点"""
+        committed = sum(1 for event in events if 'journal_seq' in event)
+        now = time.monotonic()
+        with self._journal_lock:
+            self._journal_inflight -= committed
+            if self._journal_inflight or (not force and
+                                          now - self._last_checkpoint < self.checkpoint_interval):
+                return
+            # 没有未提交的事件，已落盘的位置之前的事件都已写入数据库
+            position = self.journal.synced_position()
+            if position is None:
+                return
+            self._last_checkpoint = now
+        try:
+            self.journal.write_checkpoint(position)
+        except OSError as e:
+            logger.error(f"写入日志检查点失败: {e}")
+    
+    def _journal_sync_loop(self):
+        """分片进程模式下由主进程把日志落盘后再把事件交给分片进程
+        
+        日志只在主进程中，分片进程无法在写数据库前落盘；这里每次取出所有已到达的事件、
+        fsync 一次后再转发，保证事件写入数据库之前已经在日志中落盘。
+        """
+        while True:
+            events = [self._unsynced_events.get()]
+            while True:
+                try:
+                    events.append(self._unsynced_events.get_nowait())
+                except queue.Empty:
+                    break
+            self.journal.sync()
+            for event in events:
+                if event is _STOP:
+                    return
+                self.event_queues[self.shard_for(event['player_id'])].put(event)
+    
+    def shard_for(self, player_id):
+        """设备所属的分片（跨进程稳定的哈希）"""
+        if self.shards == 1:
+            return 0
+        return zlib.crc32(player_id.encode('utf-8')) % self.shards
+    
+    def enqueue_event(self, event):
+        """将已解析的事件放入所属分片的写入队列"""
+        if self._journal_syncer is not None:
+            self._unsynced_events.put(event)
+            return
+        self.event_queues[self.shard_for(event['player_id'])].put(event)
+    
+    def pending_events(self):
+        """所有分片中等待写入的事件数"""
+        return sum(event_queue.qsize() for event_queue in self.event_queues)
+    
+    def start_writer(self):
+        """为每个分片启动批量写入线程（或进程）"""
+        metrics.INGEST_QUEUE_DEPTH.set_function(self.pending_events)
+        if self._writer_threads or self._shard_processes:
+            return
+        try:
+            self.restore_liveness()
         except Exception as e:
-            logger.error(f"处理游戏开始事件时出错: {e}")
+            logger.error(f"恢复心跳超时检测失败: {e}")
+        self.liveness.start()
+        
+        if self.shard_mode == 'process':
+            self._start_shard_processes()
+            if self.journal is not None:
+                self._journal_syncer = threading.Thread(target=self._journal_sync_loop, daemon=True)
+                self._journal_syncer.start()
+            return
+        
+        for shard, event_queue in enumerate(self.event_queues):
+            thread = threading.Thread(target=self._writer_loop, args=(event_queue,),
+                                      name=f"ingest-shard-{shard}", daemon=True)
+            thread.start()
+            self._writer_threads.append(thread)
     
-    def handle_game_end(self, player_id, player_name):
-        """处理游戏结束事件"""
+    def stop_writer(self, timeout=None):
+        """各分片写完队列中剩余的事件后停止写入线程（或进程）"""
+        # 先停止超时回收，之后不会再有事件入队
+        self.liveness.stop(timeout)
+        # 日志中已追加的事件落盘并转发给分片进程后，分片才能停止
+        if self._journal_syncer is not None:
+            self._unsynced_events.put(_STOP)
+            self._journal_syncer.join(timeout)
+            self._journal_syncer = None
+        for event_queue in self.event_queues:
+            event_queue.put(_STOP)
+        for thread in self._writer_threads:
+            thread.join(timeout)
+        self._writer_threads = []
+        
+        for process in self._shard_processes:
+            process.join(timeout)
+        self._shard_processes = []
+        if self._result_collector is not None:
+            self._result_collector.join(timeout)
+            self._result_collector = None
+        
+        if self.journal is not None:
+            self.journal.sync()
+            self._journal_committed([], force=True)
+    
+    def _start_shard_processes(self):
+        """启动分片写入进程以及在主进程中接收结果的线程"""
+        for shard, event_queue in enumerate(self.event_queues):
+            process = self._mp_context.Process(
+                target=_run_shard_process,
+                args=(event_queue, self._shard_results, self._write_lock, db.database,
+                      self.batch_size, self.batch_wait, logging.getLogger().level),
+                name=f"ingest-shard-{shard}",
+                daemon=True
+            )
+            process.start()
+            self._shard_processes.append(process)
+        
+        # 进程数在启动时传入：stop_writer 清空进程列表后仍要收完所有分片的结果
+        self._result_collector = threading.Thread(
+            target=self._collect_shard_results, args=(len(self._shard_processes),), daemon=True)
+        self._result_collector.start()
+    
+    def _collect_shard_results(self, process_count):
+        """把分片进程写入后的设备状态同步到主进程的注册表"""
+        finished = 0
+        while finished < process_count:
+            result = self._shard_results.get()
+            if result is _STOP:
+                finished += 1
+                continue
+            events, states = result
+            device_registry.import_states(states)
+            self._batch_committed(events)
+    
+    def run_shard_worker(self, event_queue, result_queue, write_lock):
+        """分片写入进程的主循环"""
+        self._result_queue = result_queue
+        self._write_lock = write_lock
         try:
-            # 查找最近的未结束会话
-            session = GameSession.select().where(
-                (GameSession.player_id == player_id) & 
-                (GameSession.end_time.is_null())
-            ).order_by(GameSession.start_time.desc()).first()
+            self._writer_loop(event_queue)
+        finally:
+            result_queue.put(_STOP)
+    
+    def _writer_loop(self, event_queue):
+        # 写入线程长期持有自己的连接
+        db.connect(reuse_if_open=True)
+        try:
+            while True:
+                batch, stop = self._next_batch(event_queue)
+                if batch:
+                    self.apply_batch(batch)
+                if stop:
+                    break
+        finally:
+            db.close()
+    
+    def _next_batch(self, event_queue):
+        """阻塞等待第一个事件，然后在等待时间内尽量凑满一批"""
+        first = event_queue.get()
+        if first is _STOP:
+            return [], True
+        
+        batch = [first]
+        deadline = time.monotonic() + self.batch_wait
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining > 0:
+                    event = event_queue.get(timeout=remaining)
+                else:
+                    event = event_queue.get_nowait()
+            except queue.Empty:
+                break
+            if event is _STOP:
+                return batch, True
+            batch.append(event)
+        return batch, False
+    
+    def apply_batch(self, events):
+        """在一个事务中按顺序处理一批事件（组提交）
+        
+        先在写锁之外按与 handle_game_start/handle_game_end 相同的规则
+        配对事件并生成 SQL，持有写锁时只执行语句，多个分片可以并行准备。
+        """
+        # 总线要求重新加载的设备：缓存只由写入线程（或进程）修改，在这里丢弃。
+        # 数据库中的删除已经提交，提前到整批之前丢弃也只是让规划时重新查询数据库
+        reloads = [event for event in events if event['event'] == 'reload']
+        if reloads:
+            for event in reloads:
+                self._open_sessions.pop(event['player_id'], None)
+            events = [event for event in events if event['event'] != 'reload']
+            if not events:
+                return
+        
+        metrics.INGEST_BATCH_SIZE.observe(len(events))
+        if self.journal is not None:
+            # 先让本批事件在日志中落盘，再写数据库
+            self.journal.sync()
+        started = time.perf_counter()
+        statements = metrics.sql_statement_count()
+        try:
+            plan = self._plan_batch(events)
+            with self._write_lock, db.atomic('IMMEDIATE'):
+                self._execute_plan(plan)
+            self._finish_plan(plan)
+        except Exception as e:
+            logger.error(f"批量写入失败，改为逐条处理: {e}")
+            self._apply_individually(events)
+        else:
+            per_event_seconds = (time.perf_counter() - started) / len(events)
+            per_event_statements = (metrics.sql_statement_count() - statements) / len(events)
+            for event in events:
+                _EVENTS_BY_TYPE[event['event']].inc()
+                metrics.INGEST_EVENT_HANDLE_SECONDS.observe(per_event_seconds)
+                metrics.SQL_STATEMENTS_PER_EVENT.observe(per_event_statements)
+        
+        self._batch_committed(events)
+    
+    def _plan_batch(self, events):
+        """配对一批事件，生成需要执行的语句参数（只读数据库）"""
+        # 一次查询补齐缓存中未知设备的未结束会话
+        unknown = {event['player_id'] for event in events} - self._open_sessions.keys()
+        if unknown:
+            for player_id in unknown:
+                self._open_sessions[player_id] = None
+            for session in GameSession.select().where(
+                GameSession.player_id.in_(list(unknown)) &
+                GameSession.end_time.is_null()
+            ).order_by(GameSession.start_time):
+                self._open_sessions[session.player_id] = session
+        
+        current = {}
+        closes = []
+        new_sessions = []
+        for event in events:
+            player_id = event['player_id']
+            player_name = event['player_name']
+            timestamp = event['timestamp']
+            session = current[player_id] if player_id in current else self._open_sessions[player_id]
             
-            if session:
-                self.end_session(session)
-                logger.info(f"玩家 {player_name} 结束游戏，游戏时长: {session.duration_seconds}秒")
+            if event['event'] == 'game_start':
+                if session is not None:
+                    logger.warning(f"玩家 {player_name} 有未结束的会话，先结束之前的会话")
+                    self._plan_close(session, timestamp, closes)
+                new_session = {
+                    'player_id': player_id,
+                    'player_name': player_name,
+                    'start_time': timestamp,
+                    'end_time': None,
+                    'duration_seconds': None,
+                    'created_at': datetime.now()
+                }
+                new_sessions.append(new_session)
+                current[player_id] = new_session
+            elif event['event'] == 'timeout':
+                # 超时前刚收到新的 game_start 时，新会话晚于最后收到消息的时间，不结束它
+                if session is not None and self._start_time(session) <= timestamp:
+                    self._plan_close(session, timestamp, closes)
+                    current[player_id] = None
+            elif session is not None:
+                self._plan_close(session, timestamp, closes)
+                current[player_id] = None
             else:
                 logger.warning(f"未找到玩家 {player_name} 的活跃会话")
-            
-            # 触发实时更新
+        
+        return {
+            'closes': closes,
+            'new_sessions': new_sessions,
+            'current': current
+        }
+    
+    @staticmethod
+    def _start_time(session):
+        return session['start_time'] if isinstance(session, dict) else session.start_time
+    
+    @staticmethod
+    def _plan_close(session, end_time, closes):
+        """结束会话：批内新建的会话直接补上结束时间，已有会话需要 UPDATE"""
+        if isinstance(session, dict):
+            session['end_time'] = end_time
+            session['duration_seconds'] = int((end_time - session['start_time']).total_seconds())
+        else:
+            duration = int((end_time - session.start_time).total_seconds())
+            closes.append((session, end_time, duration))
+    
+    @staticmethod
+    def _session_params(session):
+        return (session['player_id'], session['player_name'], session['start_time'],
+                session['end_time'], session['duration_seconds'], session['created_at'])
+    
+    @staticmethod
+    def _usage_params(closes, closed_in_batch):
+        """按 (日期, 设备) 合并本批结束的会话，生成每日汇总 upsert 参数"""
+        usage = {}
+        finished = [(s.start_time, s.player_id, s.player_name, duration, end_time)
+                    for s, end_time, duration in closes]
+        finished += [(s['start_time'], s['player_id'], s['player_name'],
+                      s['duration_seconds'], s['end_time']) for s in closed_in_batch]
+        
+        for start_time, player_id, player_name, duration, end_time in finished:
+            key = (start_time.date(), player_id)
+            entry = usage.get(key)
+            if entry is None:
+                entry = usage[key] = [player_name, duration, 1, end_time, DurationSketch()]
+            else:
+                entry[0] = player_name
+                entry[1] += duration
+                entry[2] += 1
+                entry[3] = max(entry[3], end_time)
+            entry[4].add(duration)
+        
+        return [(date, player_id, name, total, count, last, sketch.to_bytes())
+                for (date, player_id), (name, total, count, last, sketch) in usage.items()]
+    
+    def _execute_plan(self, plan):
+        """在事务中执行批量语句"""
+        cursor = db.cursor()
+        
+        applied_closes = []
+        for session, end_time, duration in plan['closes']:
+            metrics.count_sql_statement()
+            cursor.execute(CLOSE_SESSION_SQL, (end_time, duration, session.id))
+            if cursor.rowcount:
+                applied_closes.append((session, end_time, duration))
+        
+        # 批内已结束的新会话一次插入，批末仍未结束的逐条插入以取得 ID
+        closed_in_batch = [s for s in plan['new_sessions'] if s['end_time'] is not None]
+        if closed_in_batch:
+            metrics.count_sql_statement()
+            cursor.executemany(INSERT_SESSION_SQL,
+                               [self._session_params(s) for s in closed_in_batch])
+        for new_session in plan['new_sessions']:
+            if new_session['end_time'] is None:
+                metrics.count_sql_statement()
+                cursor.execute(INSERT_SESSION_SQL, self._session_params(new_session))
+                new_session['id'] = cursor.lastrowid
+        
+        usage = self._usage_params(applied_closes, closed_in_batch)
+        if usage:
+            metrics.count_sql_statement()
+            cursor.executemany(UPSERT_DAILY_USAGE_SQL, usage)
+        
+        plan['applied_closes'] = applied_closes
+    
+    def _finish_plan(self, plan):
+        """提交后更新分片缓存和设备状态注册表"""
+        for session, end_time, duration in plan['applied_closes']:
+            device_registry.session_ended(session.player_id, session.player_name,
+                                          session.id, session.start_time, end_time)
+        
+        for new_session in plan['new_sessions']:
+            device_registry.session_started(new_session['player_id'], new_session['player_name'],
+                                            new_session.get('id'), new_session['start_time'])
+            if new_session['end_time'] is not None:
+                device_registry.session_ended(new_session['player_id'], new_session['player_name'],
+                                              None, new_session['start_time'],
+                                              new_session['end_time'])
+        
+        # 批末仍未结束的新会话已取得 ID，放入缓存供后续事件结束
+        for player_id, session in plan['current'].items():
+            if isinstance(session, dict):
+                session = GameSession(**session)
+            self._open_sessions[player_id] = session
+    
+    def _batch_committed(self, events):
+        """一批事件提交后：使缓存失效并只触发一次实时更新"""
+        if self._result_queue is not None:
+            # 分片写入进程：把受影响设备的最新状态交回主进程处理
+            player_ids = {event['player_id'] for event in events}
+            self._result_queue.put((events, device_registry.export_states(player_ids)))
+            return
+        
+        if self.journal is not None:
+            self._journal_committed(events)
+        
+        bump_data_version()
+        if self.event_bus is not None:
+            player_ids = {event['player_id'] for event in events}
+            self.event_bus.publish({
+                'type': 'devices',
+                'devices': dump_states(device_registry.export_states(player_ids))
+            })
+        else:
             self.trigger_realtime_update()
-                
-        except Exception as e:
-            logger.error(f"处理游戏结束事件时出错: {e}")
+        self.on_batch_committed(events)
     
-    def end_session(self, session):
-        """结束游戏会话"""
-        end_time = datetime.now()
+    def handle_bus_message(self, message):
+        """处理 Web 进程经总线发来的变更（如删除设备或会话）"""
+        if message.get('type') != 'changed':
+            return
+        for player_id in message.get('reload', []):
+            # 缓存中的会话可能已被删除：交给设备所属分片的写入线程（或进程）丢弃缓存，
+            # 下次从数据库重新查找；总线接收线程不直接修改分片缓存
+            self.enqueue_event({'event': 'reload', 'player_id': player_id})
+            device_registry.reload_device(player_id)
+    
+    def on_batch_committed(self, events):
+        """一批事件已写入数据库（供基准测试等扩展使用）"""
+    
+    def _apply_individually(self, events):
+        """整批失败后逐条重试，跳过出错的事件"""
+        player_ids = {event['player_id'] for event in events}
+        
+        # 回滚后缓存中可能有未提交的会话，改为从数据库重新查找
+        for player_id in player_ids:
+            self._open_sessions.pop(player_id, None)
+        
+        for event in events:
+            try:
+                with self._write_lock, db.atomic('IMMEDIATE'):
+                    self.apply_event(event)
+            except Exception as e:
+                self._open_sessions.pop(event['player_id'], None)
+                logger.error(f"处理 {event['event']} 事件时出错: {e}")
+        
+        # 回滚可能让内存状态与数据库不一致，按数据库重新加载
+        for player_id in player_ids:
+            try:
+                device_registry.reload_device(player_id)
+            except Exception as e:
+                logger.error(f"刷新设备 {player_id} 状态失败: {e}")
+    
+    def apply_event(self, event):
+        """处理单个事件"""
+        started = time.perf_counter()
+        statements = metrics.sql_statement_count()
+        
+        if event['event'] == 'game_start':
+            self.handle_game_start(event['player_id'], event['player_name'], event['timestamp'])
+        elif event['event'] == 'timeout':
+            self.handle_timeout(event['player_id'], event['timestamp'])
+        else:
+            self.handle_game_end(event['player_id'], event['player_name'], event['timestamp'])
+        
+        _EVENTS_BY_TYPE[event['event']].inc()
+        metrics.SQL_STATEMENTS_PER_EVENT.observe(metrics.sql_statement_count() - statements)
+        metrics.INGEST_EVENT_HANDLE_SECONDS.observe(time.perf_counter() - started)
+    
+    def find_open_session(self, player_id, use_cache=True):
+        """查找设备最近的未结束会话，优先使用分片缓存"""
+        if use_cache and player_id in self._open_sessions:
+            return self._open_sessions[player_id]
+        
+        session = GameSession.select().where(
+            (GameSession.player_id == player_id) & 
+            (GameSession.end_time.is_null())
+        ).order_by(GameSession.start_time.desc()).first()
+        self._open_sessions[player_id] = session
+        return session
+    
+    def handle_game_start(self, player_id, player_name, timestamp=None):
+        """处理游戏开始事件"""
+        start_time = timestamp or datetime.now()
+        
+        # 检查是否有未结束的会话
+        existing_session = self.find_open_session(player_id)
+        
+        if existing_session:
+            logger.warning(f"玩家 {player_name} 有未结束的会话，先结束之前的会话")
+            if not self.end_session(existing_session, start_time):
+                # 缓存的会话已被删除，以数据库为准再查一次
+                existing_session = self.find_open_session(player_id, use_cache=False)
+                if existing_session:
+                    self.end_session(existing_session, start_time)
+        
+        # 创建新的游戏会话
+        session = GameSession.create(
+            player_id=player_id,
+            player_name=player_name,
+            start_time=start_time
+        )
+        self._open_sessions[player_id] = session
+        logger.info(f"玩家 {player_name} 开始游戏，会话ID: {session.id}")
+        device_registry.session_started(player_id, player_name, session.id, session.start_time)
+    
+    def handle_game_end(self, player_id, player_name, timestamp=None):
+        """处理游戏结束事件"""
+        # 查找最近的未结束会话
+        session = self.find_open_session(player_id)
+        
+        if session and not self.end_session(session, timestamp):
+            # 缓存的会话已被删除，以数据库为准再查一次
+            session = self.find_open_session(player_id, use_cache=False)
+            if session and not self.end_session(session, timestamp):
+                session = None
+        
+        if session:
+            logger.info(f"玩家 {player_name} 结束游戏，游戏时长: {session.duration_seconds}秒")
+        else:
+            logger.warning(f"未找到玩家 {player_name} 的活跃会话")
+    
+    def handle_timeout(self, player_id, last_seen):
+        """处理心跳超时：结束最后一次收到消息之前开始的会话"""
+        session = self.find_open_session(player_id, use_cache=False)
+        if session and session.start_time <= last_seen and self.end_session(session, last_seen):
+            logger.info(f"设备 {session.player_name} 心跳超时，会话在 {last_seen} 结束，"
+                        f"游戏时长: {session.duration_seconds}秒")
+    
+    def end_session(self, session, end_time=None):
+        """结束游戏会话，会话已不存在时返回 False"""
+        end_time = end_time or datetime.now()
         duration = int((end_time - session.start_time).total_seconds())
         
         session.end_time = end_time
         session.duration_seconds = duration
-        session.save()
+        with db.atomic():
+            if not session.save():
+                self._open_sessions.pop(session.player_id, None)
+                return False
+            record_session_usage(session)
+        
+        if self._open_sessions.get(session.player_id) is session:
+            self._open_sessions[session.player_id] = None
+        
+        device_registry.session_ended(session.player_id, session.player_name,
+                                      session.id, session.start_time, end_time)
+        return True
     
     def trigger_realtime_update(self):
         """触发前端实时更新"""
@@ -168,6 +775,8 @@ class GameUsageTracker:
     
     def start(self):
         """启动 MQTT 客户端"""
+        self.start_writer()
+        
         while True:
             try:
                 # 设置用户名和密码
@@ -186,7 +795,6 @@ class GameUsageTracker:
                 logger.error(f"MQTT 客户端出错: {e}")
                 logger.info(f"{self.reconnect_delay}秒后尝试重新连接...")
                 
-                import time
                 time.sleep(self.reconnect_delay)
                 
                 # 增加重连延迟，但不超过最大值
@@ -197,11 +805,25 @@ class GameUsageTracker:
             self.client.disconnect()
         except:
             pass
+        
+        # 写完已接收的事件
+        self.stop_writer()
+        if self.journal is not None:
+            self.journal.close()
+
+def _run_shard_process(event_queue, result_queue, write_lock, database_path,
+                       batch_size, batch_wait, log_level):
+    """分片写入进程入口，使用与主进程相同的数据库文件和日志级别"""
+    logging.getLogger().setLevel(log_level)
+    configure_database(database_path)
+    tracker = GameUsageTracker(batch_size=batch_size, batch_wait=batch_wait)
+    tracker.run_shard_worker(event_queue, result_queue, write_lock)
 
 if __name__ == "__main__":
     # 初始化数据库
-    db.connect()
+    init_db()
+    device_registry.load_from_db()
     
     # 启动游戏使用时长追踪器
-    tracker = GameUsageTracker()
+    tracker = GameUsageTracker(journal=open_default_journal())
     tracker.start()
\ No newline at end of file
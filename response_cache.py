@@ -0,0 +1,114 @@
+"""
+读接口响应缓存
+
+数据只会在 MQTT 事件写入或删除接口执行后变化，写入方调用
+bump_data_version() 使全局数据版本加一。缓存以 (接口, 规范化后的查询参数,
+数据版本) 为键保存序列化后的 JSON 字节，并通过 ETag 支持 304 响应。
+"""
+
+import threading
+import time
+import uuid
+import zlib
+from collections import OrderedDict
+from datetime import date
+from functools import wraps
+from flask import Response, request
+
+# 进程启动标识，避免重启后版本号重复导致客户端误用旧的 ETag
+BOOT_TOKEN = uuid.uuid4().hex[:8]
+
+
+class DataVersion:
+    """线程安全的全局数据版本号"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._value = 0
+
+    @property
+    def value(self):
+        return self._value
+
+    def bump(self):
+        with self._lock:
+            self._value += 1
+            return self._value
+
+
+class ResponseCache:
+    """按 LRU 淘汰的响应缓存"""
+
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            body, expires_at = entry
+            if expires_at is not None and expires_at <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return body
+
+    def put(self, key, body, ttl=None):
+        expires_at = time.monotonic() + ttl if ttl else None
+        with self._lock:
+            self._entries[key] = (body, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+data_version = DataVersion()
+response_cache = ResponseCache()
+
+
+def bump_data_version():
+    """数据发生变化时调用，旧的缓存和 ETag 随之失效"""
+    return data_version.bump()
+
+
+def cached_response(ttl=None):
+    """为返回 JSON 的 GET 接口加上缓存和 ETag 支持
+
+    ttl: 结果还依赖当前时间（如“最近5分钟在线”）时的最长缓存秒数
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            version = data_version.value
+            query_args = tuple(sorted(request.args.items(multi=True)))
+            # 默认日期范围依赖“今天”，跨天后自动失效
+            scope = (request.endpoint, query_args, date.today().isoformat())
+            if ttl:
+                scope += (int(time.time() // ttl),)
+
+            etag = f'{BOOT_TOKEN}-{version}-{zlib.crc32(repr(scope).encode()):08x}'
+            headers = {'ETag': f'"{etag}"', 'Cache-Control': 'no-cache'}
+
+            # 客户端已有最新数据，无需任何数据库操作
+            if request.if_none_match.contains_weak(etag):
+                return Response(status=304, headers=headers)
+
+            key = scope + (version,)
+            body = response_cache.get(key)
+            if body is None:
+                response = view(*args, **kwargs)
+                if isinstance(response, tuple) or response.status_code != 200:
+                    return response
+                body = response.get_data()
+                response_cache.put(key, body, ttl)
+
+            return Response(body, mimetype='application/json', headers=headers)
+        return wrapper
+    return decorator
@@ -1,52 +1,100 @@
 #!/usr/bin/env python3
 """
 游戏设备使用时长统计系统启动脚本
+
+    python run.py                 # 单进程：MQTT 客户端和 Web 服务器在同一进程
+    python run.py --role ingest   # 只运行 MQTT 写入进程，并提供变更通知总线
+    python run.py --role web      # 只运行 Web 服务器（开发服务器），订阅变更通知
+
+生产环境多进程部署见 DEPLOYMENT.md（写入进程 + gunicorn 运行 wsgi.py）。
 """
 
+import argparse
+import os
 import threading
 import time
 from models import init_db
 from mqtt_client import GameUsageTracker
-from api import app, update_queue
+from device_registry import device_registry
+from ipc_bus import EventBusServer
+from event_journal import open_default_journal
+from api import (app, update_queue, ensure_update_pump, start_event_bus_client,
+                 load_analytics_store)
 
 def start_mqtt_client():
     """启动 MQTT 客户端"""
     print("启动 MQTT 客户端...")
-    tracker = GameUsageTracker(update_queue=update_queue)
+    ensure_update_pump()
+    tracker = GameUsageTracker(update_queue=update_queue, journal=open_default_journal())
     tracker.start()
 
 def start_web_server():
     """启动 Web 服务器"""
-    import os
     port = int(os.environ.get('PORT', 5001))
     print(f"启动 Web 服务器，端口: {port}")
     app.run(debug=False, host='0.0.0.0', port=port, use_reloader=False)
 
-if __name__ == "__main__":
-    print("=== 游戏设备使用时长统计系统 ===")
-    
-    # 初始化数据库
-    print("初始化数据库...")
-    init_db()
-    
+def run_ingest(socket_path):
+    """独立的 MQTT 写入进程，通过 Unix Socket 通知所有 Web 进程"""
+    bus = EventBusServer(socket_path)
+    tracker = GameUsageTracker(event_bus=bus, journal=open_default_journal())
+    bus.on_message = tracker.handle_bus_message
+    bus.start()
+    print(f"变更通知总线: {bus.path}")
+    try:
+        tracker.start()
+    finally:
+        bus.close()
+
+def run_web(socket_path):
+    """独立的 Web 进程，订阅写入进程的变更通知"""
+    load_analytics_store()
+    start_event_bus_client(socket_path)
+    ensure_update_pump()
+    start_web_server()
+
+def run_all():
+    load_analytics_store()
     # 创建线程
     mqtt_thread = threading.Thread(target=start_mqtt_client, daemon=True)
     web_thread = threading.Thread(target=start_web_server, daemon=True)
-    
+
     # 启动线程
     mqtt_thread.start()
     time.sleep(2)  # 等待 MQTT 客户端启动
     web_thread.start()
-    
+
     print("系统启动完成!")
     print("Web 界面: http://localhost:5001/static/index.html")
     print("API 接口: http://localhost:5001/api/")
     print("按 Ctrl+C 退出")
-    
+
     try:
         # 保持主线程运行
         while True:
             time.sleep(1)
     except KeyboardInterrupt:
         print("\n正在关闭系统...")
-        print("系统已关闭")
\ No newline at end of file
+        print("系统已关闭")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='游戏设备使用时长统计系统')
+    parser.add_argument('--role', choices=['all', 'ingest', 'web'], default='all',
+                        help='all: 单进程运行全部组件；ingest: 只运行 MQTT 写入；web: 只运行 Web 服务器')
+    parser.add_argument('--bus-socket', default=None,
+                        help='变更通知总线的 Unix Socket 路径（默认读取 GAME_USAGE_BUS_SOCKET）')
+    args = parser.parse_args()
+
+    print("=== 游戏设备使用时长统计系统 ===")
+
+    # 初始化数据库
+    print("初始化数据库...")
+    init_db()
+    device_registry.load_from_db()
+
+    if args.role == 'ingest':
+        run_ingest(args.bus_socket)
+    elif args.role == 'web':
+        run_web(args.bus_socket)
+    else:
+        run_all()
@@ -0,0 +1,100 @@
+"""
+会话流式导出
+
+/api/sessions/export 使用的生成器：用独立的只读连接执行一次查询，fetchmany 分块读取，
+每块编码为 CSV 或 NDJSON 后立即输出（可选 gzip 压缩），内存占用与导出的行数无关。
+日期范围涉及已归档的月份时，先按月份输出归档中的会话，再输出会话表中的会话。
+"""
+
+import csv
+import io
+import json
+import sqlite3
+import zlib
+
+try:
+    import orjson
+    _dumps = orjson.dumps
+except ImportError:
+    def _dumps(value):
+        return json.dumps(value, ensure_ascii=False).encode('utf-8')
+
+from archive import iter_archived_sessions, iter_session_chunks
+
+FORMAT_CSV = 'csv'
+FORMAT_NDJSON = 'ndjson'
+CONTENT_TYPES = {
+    FORMAT_CSV: 'text/csv; charset=utf-8',
+    FORMAT_NDJSON: 'application/x-ndjson',
+}
+
+EXPORT_COLUMNS = ('id', 'player_id', 'player_name', 'start_time', 'end_time',
+                  'duration_seconds', 'created_at')
+_DATETIME_COLUMNS = (3, 4, 6)
+
+
+def _format_row(row):
+    """数据库中的时间文本转换为与 /api/sessions 一致的 ISO 格式"""
+    row = list(row)
+    for index in _DATETIME_COLUMNS:
+        if row[index]:
+            row[index] = row[index].replace(' ', 'T', 1)
+    return row
+
+
+def iter_session_chunks_from(database_path, date_from=None, date_to=None, player_id=None,
+                             chunk_size=5000):
+    """分块读取归档和会话表中的会话（原始行）"""
+    yield from iter_archived_sessions(date_from, date_to, player_id, chunk_size)
+
+    # 生成器可能在不同线程中被逐块读取（ASGI 模式），不使用连接池中的线程连接
+    connection = sqlite3.connect(f'file:{database_path}?mode=ro', uri=True,
+                                 check_same_thread=False)
+    try:
+        yield from iter_session_chunks(connection, date_from, date_to, player_id, chunk_size)
+    finally:
+        connection.close()
+
+
+def encode_csv(chunks):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    # 带 BOM，Excel 打开时能正确识别中文
+    buffer.write('﻿')
+    writer.writerow(EXPORT_COLUMNS)
+    yield buffer.getvalue().encode('utf-8')
+    for rows in chunks:
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows(_format_row(row) for row in rows)
+        yield buffer.getvalue().encode('utf-8')
+
+
+def encode_ndjson(chunks):
+    for rows in chunks:
+        yield b''.join(_dumps(dict(zip(EXPORT_COLUMNS, _format_row(row)))) + b'\n'
+                       for row in rows)
+
+
+_ENCODERS = {
+    FORMAT_CSV: encode_csv,
+    FORMAT_NDJSON: encode_ndjson,
+}
+
+
+def gzip_stream(blocks, level=6):
+    """逐块 gzip 压缩（wbits=31 输出 gzip 格式）"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    for block in blocks:
+        compressed = compressor.compress(block)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def export_stream(database_path, fmt=FORMAT_CSV, date_from=None, date_to=None, player_id=None,
+                  compress=False, chunk_size=5000):
+    """导出会话的字节流生成器"""
+    chunks = iter_session_chunks_from(database_path, date_from, date_to, player_id, chunk_size)
+    blocks = _ENCODERS[fmt](chunks)
+    return gzip_stream(blocks) if compress else blocks
@@ -0,0 +1,19 @@
+"""
+WSGI 入口，供 gunicorn 等多进程服务器使用
+
+    gunicorn -w 4 -k gthread --threads 32 -b 0.0.0.0:5001 wsgi:app
+
+每个工作进程导入本模块时初始化自己的数据库连接池和设备状态，并订阅
+MQTT 写入进程（python run.py --role ingest）的变更通知。不要使用
+--preload，否则后台线程会在 fork 之前启动。
+"""
+
+from models import init_db
+from device_registry import device_registry
+from api import app, ensure_update_pump, start_event_bus_client, load_analytics_store
+
+init_db()
+device_registry.load_from_db()
+load_analytics_store()
+start_event_bus_client()
+ensure_update_pump()